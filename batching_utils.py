@@ -1,17 +1,26 @@
 """Dynamic batching utilities."""
 
-from typing import Generator, Iterable, Iterator, Sequence, Tuple
+import itertools
+import sys
+from typing import (Generator, Iterable, Iterator, List, Optional, Sequence,
+                    Tuple)
 
+from absl import logging
 import jax.tree_util as tree
 import jraph
 import numpy as np
 
+# pylint: disable=g-bad-import-order
+import pipeline_metrics
+
 _NUMBER_FIELDS = ("n_node", "n_edge", "n_graph")
 
 
 def dynamically_batch(graphs_tuple_iterator: Iterator[jraph.GraphsTuple],
-                      n_node: int, n_edge: int,
-                      n_graph: int) -> Generator[jraph.GraphsTuple, None, None]:
+                      n_node: int, n_edge: int, n_graph: int,
+                      packing_lookahead: int = 0,
+                      num_padding_buckets: int = 1,
+                      ) -> Generator[jraph.GraphsTuple, None, None]:
   """Dynamically batches trees with `jraph.GraphsTuples` to `graph_batch_size`.
 
   Elements of the `graphs_tuple_iterator` will be incrementally added to a batch
@@ -22,11 +31,28 @@ def dynamically_batch(graphs_tuple_iterator: Iterator[jraph.GraphsTuple],
   have variable sized batches. This is especially the case if you have a loss
   defined on the variable shaped element (for example, nodes in a graph).
 
+  With `packing_lookahead > 0`, that many elements are buffered, and a batch
+  which cannot take the next element is completed with the buffered elements
+  which fit, rather than yielded with the space left.
+
+  Elements are written into padded buffers as they arrive, with the layout of
+  `jraph.pad_with_graphs`. Buffers of batches which are no longer referenced
+  are reused for later batches.
+
+  With `num_padding_buckets > 1`, batches are padded to the smallest of that
+  many sizes which fits them, see `get_padding_buckets`, rather than always to
+  `n_node` and `n_edge`. Functions of the batches are then compiled once per
+  padding size. The fraction of nodes and edges of every batch which are not
+  padding is recorded in `pipeline_metrics`.
+
   Args:
     graphs_tuple_iterator: An iterator of `jraph.GraphsTuples`.
     n_node: The maximum number of nodes in a batch.
     n_edge: The maximum number of edges in a batch.
     n_graph: The maximum number of graphs in a batch.
+    packing_lookahead: Number of elements buffered to complete batches, or 0
+      to batch elements in arrival order only.
+    num_padding_buckets: Number of sizes batches are padded to.
 
   Yields:
     A `jraph.GraphsTuple` batch of graphs.
@@ -40,70 +66,317 @@ def dynamically_batch(graphs_tuple_iterator: Iterator[jraph.GraphsTuple],
   if n_graph < 2:
     raise ValueError("The number of graphs in a batch size must be greater or "
                      f"equal to `2` for padding with graphs, got {n_graph}.")
-  valid_batch_size = (n_node - 1, n_edge, n_graph - 1)
-  accumulated_graphs = []
-  num_accumulated_nodes = 0
-  num_accumulated_edges = 0
-  num_accumulated_graphs = 0
+  builder = _PaddedBatchBuilder(
+      n_node, n_edge, n_graph,
+      padding_buckets=get_padding_buckets(n_node, n_edge, num_padding_buckets))
+  if packing_lookahead > 0:
+    yield from _batch_with_lookahead(graphs_tuple_iterator, builder,
+                                     packing_lookahead)
+  else:
+    yield from _batch_in_order(graphs_tuple_iterator, builder)
+
+
+def _batch_in_order(graphs_tuple_iterator, builder):
+  """Yields batches of consecutive elements."""
+  n_node, n_edge, n_graph = builder.batch_size
   for element in graphs_tuple_iterator:
-    element_nodes, element_edges, element_graphs = _get_graph_size(element)
-    if _is_over_batch_size(element, valid_batch_size):
-      graph_size = element_nodes, element_edges, element_graphs
-      graph_size = {k: v for k, v in zip(_NUMBER_FIELDS, graph_size)}
-      batch_size = {k: v for k, v in zip(_NUMBER_FIELDS, valid_batch_size)}
-      raise RuntimeError("Found graph bigger than batch size. Valid Batch "
-                         f"Size: {batch_size}, Graph Size: {graph_size}")
-
-    if not accumulated_graphs:
-      # If this is the first element of the batch, set it and continue.
-      accumulated_graphs = [element]
-      num_accumulated_nodes = element_nodes
-      num_accumulated_edges = element_edges
-      num_accumulated_graphs = element_graphs
-      continue
-    else:
-      # Otherwise check if there is space for the graph in the batch:
-      if ((num_accumulated_graphs + element_graphs > n_graph - 1) or
-          (num_accumulated_nodes + element_nodes > n_node - 1) or
-          (num_accumulated_edges + element_edges > n_edge)):
-        # If there is, add it to the batch
-        batched_graph = _batch_np(accumulated_graphs)
-        yield jraph.pad_with_graphs(batched_graph, n_node, n_edge, n_graph)
-        accumulated_graphs = [element]
-        num_accumulated_nodes = element_nodes
-        num_accumulated_edges = element_edges
-        num_accumulated_graphs = element_graphs
-      else:
-        # Otherwise, return the old batch and start a new batch.
-        accumulated_graphs.append(element)
-        num_accumulated_nodes += element_nodes
-        num_accumulated_edges += element_edges
-        num_accumulated_graphs += element_graphs
+    element_nodes, element_edges, element_graphs = _check_graph_size(
+        element, builder)
+    # If there is no space for the graph in the batch, return the batch and
+    # start a new batch.
+    if builder.num_graphs and (
+        (builder.num_graphs + element_graphs > n_graph - 1) or
+        (builder.num_nodes + element_nodes > n_node - 1) or
+        (builder.num_edges + element_edges > n_edge)):
+      yield _build_batch(builder)
+    builder.add(element)
 
   # We may still have data in batched graph.
-  if accumulated_graphs:
-    batched_graph = _batch_np(accumulated_graphs)
-    yield jraph.pad_with_graphs(batched_graph, n_node, n_edge, n_graph)
-
-
-def _batch_np(graphs: Sequence[jraph.GraphsTuple]) -> jraph.GraphsTuple:
-  # Calculates offsets for sender and receiver arrays, caused by concatenating
-  # the nodes arrays.
-  offsets = np.cumsum(np.array([0] + [np.sum(g.n_node) for g in graphs[:-1]]))
-
-  def _map_concat(nests):
-    concat = lambda *args: np.concatenate(args)
-    return tree.tree_map(concat, *nests)
-
-  return jraph.GraphsTuple(
-      n_node=np.concatenate([g.n_node for g in graphs]),
-      n_edge=np.concatenate([g.n_edge for g in graphs]),
-      nodes=_map_concat([g.nodes for g in graphs]),
-      edges=_map_concat([g.edges for g in graphs]),
-      globals=_map_concat([g.globals for g in graphs]),
-      senders=np.concatenate([g.senders + o for g, o in zip(graphs, offsets)]),
-      receivers=np.concatenate(
-          [g.receivers + o for g, o in zip(graphs, offsets)]))
+  if builder.num_graphs:
+    yield _build_batch(builder)
+
+
+def _batch_with_lookahead(graphs_tuple_iterator, builder, lookahead):
+  """Yields batches of elements in arrival order, completed best-fit.
+
+  When the next element does not fit in the batch, the batch is completed with
+  the buffered elements which fit, taking each time the one leaving the least
+  space in the batch. Elements which were skipped stay first in line, and fit
+  in the next batch since every element fits in an empty batch.
+
+  Args:
+    graphs_tuple_iterator: An iterator of `jraph.GraphsTuples`.
+    builder: `_PaddedBatchBuilder` of the batches.
+    lookahead: Number of elements buffered.
+
+  Yields:
+    A `jraph.GraphsTuple` batch of graphs.
+  """
+  iterator = iter(graphs_tuple_iterator)
+  capacity = np.array(_get_valid_batch_size(builder))
+  # Buffered elements, in slots which are refilled as elements leave, with
+  # their sizes and order of arrival, `np.inf` for empty slots.
+  elements = [None] * lookahead
+  sizes = np.zeros((lookahead, capacity.shape[0]), dtype=np.int64)
+  arrivals = np.full(lookahead, np.inf)
+  num_arrived = 0
+
+  def fill(slot):
+    nonlocal num_arrived
+    for element in itertools.islice(iterator, 1):
+      elements[slot] = element
+      sizes[slot] = _check_graph_size(element, builder)
+      arrivals[slot] = num_arrived
+      num_arrived += 1
+      return
+    elements[slot] = None
+    arrivals[slot] = np.inf
+
+  def add(slot):
+    builder.add(elements[slot])
+    fill(slot)
+
+  for slot in range(lookahead):
+    fill(slot)
+  while np.isfinite(arrivals).any():
+    while True:
+      first = int(np.argmin(arrivals))
+      if (np.isinf(arrivals[first]) or
+          not np.all(builder.size + sizes[first] <= capacity)):
+        break
+      add(first)
+    while True:
+      space = capacity - builder.size
+      fits = np.all(sizes <= space, axis=1)
+      fits &= np.isfinite(arrivals)
+      if not fits.any():
+        break
+      # Fraction of the batch left free, in its least filled dimension.
+      free_space = ((space - sizes) / capacity).max(axis=1)
+      free_space[~fits] = np.inf
+      # First arrived of the elements leaving the least space.
+      best = np.flatnonzero(free_space == free_space.min())
+      add(int(best[np.argmin(arrivals[best])]))
+    yield _build_batch(builder)
+
+
+def _build_batch(builder):
+  """Builds the batch, recording its fill in `pipeline_metrics`."""
+  n_node, n_edge = builder.get_padding_size()
+  node_fill = builder.num_nodes / n_node
+  edge_fill = builder.num_edges / n_edge
+  pipeline_metrics.get_distribution("batch_node_fill").record(node_fill)
+  pipeline_metrics.get_distribution("batch_edge_fill").record(edge_fill)
+  logging.vlog(1, "Batch of %d graphs padded to %d nodes and %d edges: node "
+               "fill %.3f, edge fill %.3f", builder.num_graphs, n_node, n_edge,
+               node_fill, edge_fill)
+  return builder.build(n_node, n_edge)
+
+
+def get_padding_buckets(n_node: int, n_edge: int,
+                        num_padding_buckets: int = 1,
+                        **unused_kwargs) -> List[Tuple[int, int]]:
+  """Returns the numbers of nodes and edges batches are padded to.
+
+  Args:
+    n_node: The maximum number of nodes in a batch.
+    n_edge: The maximum number of edges in a batch.
+    num_padding_buckets: Number of padding sizes, evenly spaced up to `n_node`
+      and `n_edge`.
+    **unused_kwargs: Other fields of the batch size config, for convenience.
+
+  Returns:
+    `(n_node, n_edge)` of every padding size, from the smallest.
+  """
+  return [(n_node * i // num_padding_buckets, n_edge * i // num_padding_buckets)
+          for i in range(1, num_padding_buckets + 1)]
+
+
+def _get_valid_batch_size(builder):
+  n_node, n_edge, n_graph = builder.batch_size
+  # Keep space for the padding graph.
+  return n_node - 1, n_edge, n_graph - 1
+
+
+def _check_graph_size(graph, builder):
+  """Returns the size of `graph`, raising an error if it does not fit."""
+  valid_batch_size = _get_valid_batch_size(builder)
+  graph_size = _get_graph_size(graph)
+  if _is_over_batch_size(graph, valid_batch_size):
+    graph_size = {k: v for k, v in zip(_NUMBER_FIELDS, graph_size)}
+    batch_size = {k: v for k, v in zip(_NUMBER_FIELDS, valid_batch_size)}
+    raise RuntimeError("Found graph bigger than batch size. Valid Batch "
+                       f"Size: {batch_size}, Graph Size: {graph_size}")
+  return graph_size
+
+
+class _PaddedBatchBuilder:
+  """Writes graphs into preallocated buffers padded to a fixed size.
+
+  Built batches are laid out as `jraph.pad_with_graphs` of the concatenated
+  graphs: a padding graph holds the remaining nodes and edges, with its edges
+  pointing at its first node, followed by empty graphs, and padded features
+  are zeros. Batches are padded to the smallest of the `padding_buckets` which
+  fits them, and to the size of the buffers otherwise.
+
+  The arrays of a built batch are the buffers themselves, so buffers are only
+  reused once nothing else references them, i.e. the batch and any views of
+  its arrays were released. Otherwise new buffers are allocated.
+  """
+
+  def __init__(self, n_node: int, n_edge: int, n_graph: int,
+               padding_buckets: Sequence[Tuple[int, int]] = (),
+               max_num_buffers: int = 16):
+    self.batch_size = (n_node, n_edge, n_graph)
+    # Smaller `(n_node, n_edge)` batches may be padded to, from the smallest.
+    self._padding_buckets = sorted(padding_buckets) + [(n_node, n_edge)]
+    self._sizes = dict(nodes=n_node, edges=n_edge, globals=n_graph)
+    self._max_num_buffers = max_num_buffers
+    # Buffer sets of built batches, with the reference counts of their arrays
+    # when nothing else referenced them.
+    self._buffer_pool = []
+    self._treedefs = None
+    self._buffers = None
+    self.num_nodes = 0
+    self.num_edges = 0
+    self.num_graphs = 0
+
+  def add(self, graph: jraph.GraphsTuple):
+    """Appends `graph`, which must fit in the remaining space."""
+    if self._buffers is None:
+      self._buffers = self._get_buffers(graph)
+    nodes, edges, graphs = self._buffers["fields"]
+    node_start, edge_start, graph_start = (self.num_nodes, self.num_edges,
+                                           self.num_graphs)
+    node_end = node_start + int(np.sum(graph.n_node))
+    edge_end = edge_start + len(graph.senders)
+    graph_end = graph_start + len(graph.n_node)
+
+    for buffer, leaf in zip(nodes, tree.tree_leaves(graph.nodes)):
+      buffer[node_start:node_end] = leaf
+    for buffer, leaf in zip(edges, tree.tree_leaves(graph.edges)):
+      buffer[edge_start:edge_end] = leaf
+    for buffer, leaf in zip(graphs, tree.tree_leaves(graph.globals)):
+      buffer[graph_start:graph_end] = leaf
+    # Offsets senders and receivers by the nodes of the previous graphs.
+    for name in ("senders", "receivers"):
+      np.add(getattr(graph, name), node_start,
+             out=self._buffers[name][edge_start:edge_end])
+    self._buffers["n_node"][graph_start:graph_end] = graph.n_node
+    self._buffers["n_edge"][graph_start:graph_end] = graph.n_edge
+
+    self.num_nodes, self.num_edges, self.num_graphs = (node_end, edge_end,
+                                                       graph_end)
+
+  @property
+  def size(self) -> np.ndarray:
+    """Numbers of nodes, edges and graphs added, as in `_NUMBER_FIELDS`."""
+    return np.array((self.num_nodes, self.num_edges, self.num_graphs))
+
+  def get_padding_size(self) -> Tuple[int, int]:
+    """Returns the smallest padding bucket which fits the added graphs."""
+    return next(
+        (n_node, n_edge) for n_node, n_edge in self._padding_buckets
+        if n_node > self.num_nodes and n_edge >= self.num_edges)
+
+  def build(self, n_node: Optional[int] = None,
+            n_edge: Optional[int] = None) -> jraph.GraphsTuple:
+    """Pads the added graphs and returns them as a batch.
+
+    Args:
+      n_node: Number of nodes of the batch, greater than the number of nodes
+        added. Defaults to the smallest padding bucket which fits.
+      n_edge: Number of edges of the batch, at least the number of edges
+        added. Defaults to the smallest padding bucket which fits.
+
+    Returns:
+      A `jraph.GraphsTuple` batch of graphs.
+    """
+    if n_node is None or n_edge is None:
+      n_node, n_edge = self.get_padding_size()
+    buffers = self._buffers
+    nodes, edges, graphs = buffers["fields"]
+    nodes = [buffer[:n_node] for buffer in nodes]
+    edges = [buffer[:n_edge] for buffer in edges]
+    for buffer in nodes:
+      buffer[self.num_nodes:] = 0
+    for buffer in edges:
+      buffer[self.num_edges:] = 0
+    for buffer in graphs:
+      buffer[self.num_graphs:] = 0
+    # The padding graph.
+    buffers["n_node"][self.num_graphs] = n_node - self.num_nodes
+    buffers["n_edge"][self.num_graphs] = n_edge - self.num_edges
+    buffers["n_node"][self.num_graphs + 1:] = 0
+    buffers["n_edge"][self.num_graphs + 1:] = 0
+    senders = buffers["senders"][:n_edge]
+    receivers = buffers["receivers"][:n_edge]
+    senders[self.num_edges:] = self.num_nodes
+    receivers[self.num_edges:] = self.num_nodes
+
+    nodes_treedef, edges_treedef, globals_treedef = self._treedefs
+    batch = jraph.GraphsTuple(
+        n_node=buffers["n_node"],
+        n_edge=buffers["n_edge"],
+        nodes=tree.tree_unflatten(nodes_treedef, nodes),
+        edges=tree.tree_unflatten(edges_treedef, edges),
+        globals=tree.tree_unflatten(globals_treedef, graphs),
+        senders=senders,
+        receivers=receivers)
+    self._buffers = None
+    self.num_nodes = self.num_edges = self.num_graphs = 0
+    return batch
+
+  def _get_buffers(self, graph):
+    """Returns unreferenced buffers of a previous batch, or new buffers."""
+    for buffers, refcounts in self._buffer_pool:
+      if _get_refcounts(buffers) == refcounts:
+        return buffers
+
+    buffers = self._allocate_buffers(graph)
+    if len(self._buffer_pool) >= self._max_num_buffers:
+      # Buffers still in use elsewhere are released with their last reference.
+      self._buffer_pool.pop(0)
+    self._buffer_pool.append((buffers, _get_refcounts(buffers)))
+    return buffers
+
+  def _allocate_buffers(self, graph):
+    """Allocates buffers for graphs with the structure and dtypes of `graph`."""
+    fields = []
+    treedefs = []
+    for name in ("nodes", "edges", "globals"):
+      leaves, treedef = tree.tree_flatten(getattr(graph, name))
+      fields.append([
+          np.zeros((self._sizes[name],) + leaf.shape[1:], dtype=leaf.dtype)
+          for leaf in leaves])
+      treedefs.append(treedef)
+    self._treedefs = tuple(treedefs)
+
+    # Same dtypes as offsetting and concatenating with the int32 padding.
+    offset = np.cumsum(np.array([0]))[0]
+    index_dtypes = {
+        name: np.result_type(
+            (np.asarray(getattr(graph, name))[:0] + offset).dtype, np.int32)
+        for name in ("senders", "receivers")}
+    count_dtypes = {
+        name: np.result_type(np.asarray(getattr(graph, name)).dtype, np.int32)
+        for name in ("n_node", "n_edge")}
+    buffers = dict(fields=tuple(fields))
+    for name, dtype in index_dtypes.items():
+      buffers[name] = np.zeros(self._sizes["edges"], dtype=dtype)
+    for name, dtype in count_dtypes.items():
+      buffers[name] = np.zeros(self._sizes["globals"], dtype=dtype)
+    return buffers
+
+
+def _flatten_buffers(buffers):
+  nodes, edges, graphs = buffers["fields"]
+  return nodes + edges + graphs + [
+      buffers[name] for name in ("senders", "receivers", "n_node", "n_edge")]
+
+
+def _get_refcounts(buffers):
+  return [sys.getrefcount(buffer) for buffer in _flatten_buffers(buffers)]
 
 
 def _get_graph_size(graph: jraph.GraphsTuple) -> Tuple[int, int, int]:
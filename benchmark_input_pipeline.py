@@ -0,0 +1,309 @@
+"""Benchmarks the input pipeline on synthetic power-law graphs.
+
+Runs on a single machine without the dataset, on graphs built by
+`synthetic_data.py` at the scale given by the flags:
+
+- `sampler`: `sub_sampler.subsample_graph` and `sub_sampler.subsample_graphs`.
+- `batching`: `batching_utils.dynamically_batch` of labelled subgraphs.
+- `iterator`: `datasets.build_dataset_iterator`, from sampling to post-processed
+  batches with their features. The profile of its stages, e.g. the batch
+  post-processing and feature gather times, is part of the results.
+
+Results are logged, and written as JSON to `--output_path`. With
+`--baseline_path`, throughputs are compared with the results of a previous
+run, and the benchmark fails if any dropped by more than `--max_regression`.
+
+Usage:
+
+python3 benchmark_input_pipeline.py --num_users=200000 \
+    --output_path=/tmp/input_pipeline_benchmark.json
+"""
+
+import json
+import os
+import pathlib
+import resource
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+from ml_collections import config_dict
+import numpy as np
+
+# pylint: disable=g-bad-import-order
+import batching_utils
+import data_utils
+import pipeline_metrics
+import sub_sampler
+import synthetic_data
+
+Path = pathlib.Path
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('benchmarks', ['sampler', 'batching', 'iterator'],
+                  'Benchmarks to run')
+flags.DEFINE_integer('num_users', 200_000, 'Number of synthetic users')
+flags.DEFINE_integer('num_groups', 20_000, 'Number of synthetic groups')
+flags.DEFINE_integer('num_user_user_edges', 2_000_000,
+                     'Number of synthetic user->user edges')
+flags.DEFINE_integer('num_group_user_edges', 4_000_000,
+                     'Number of synthetic group->user edges')
+flags.DEFINE_integer('num_roots', 2000,
+                     'Number of roots of the sampler and batching benchmarks')
+flags.DEFINE_integer('num_batches', 50,
+                     'Number of batches read from the iterator')
+flags.DEFINE_integer('sampler_batch_size', 128,
+                     'Roots per `subsample_graphs` call')
+flags.DEFINE_integer('n_graph', 64, 'Maximum number of graphs in a batch')
+flags.DEFINE_integer('packing_lookahead', 0,
+                     'Subgraphs buffered to complete batches')
+flags.DEFINE_integer('num_padding_buckets', 1,
+                     'Number of sizes batches are padded to')
+flags.DEFINE_integer('num_sampling_workers', 0,
+                     'Sampling worker processes of the iterator')
+flags.DEFINE_integer('num_sampling_shards', 1,
+                     'Sampling shards of the iterator')
+flags.DEFINE_integer('num_postprocessing_workers', 0,
+                     'Post-processing threads of the iterator')
+flags.DEFINE_integer('feature_cache_num_hot_nodes', 0,
+                     'Features of nodes pinned in memory by the iterator')
+flags.DEFINE_integer('feature_cache_lru_size', 0,
+                     'Feature rows of the LRU cache of the iterator')
+flags.DEFINE_boolean('compact_adjacencies', True,
+                     'Whether adjacencies use compact dtypes')
+flags.DEFINE_integer('seed', 0, 'Random seed')
+flags.DEFINE_string('output_path', None, 'If set, results are written here')
+flags.DEFINE_string('baseline_path', None,
+                    'Results of a previous run to compare throughputs with')
+flags.DEFINE_float('max_regression', 0.2,
+                   'Maximum relative drop of throughputs from the baseline')
+
+# Same sampling configuration and batch sizes as `config.py`.
+_ONLINE_SUBSAMPLING_KWARGS = dict(
+    max_nb_neighbours_per_type=[
+        [[40, 20, 0, 40], [0, 0, 0, 0], [0, 0, 0, 0]],
+        [[40, 20, 0, 40], [40, 0, 10, 0], [0, 0, 0, 0]],
+    ],
+    remove_future_nodes=True,
+    deduplicate_nodes=True,
+)
+_MAX_NODES_PER_GRAPH = 340
+_MAX_EDGES_PER_GRAPH = 720
+
+
+def _get_rss_bytes():
+  """Returns the current resident set size of this process."""
+  with open('/proc/self/statm') as fid:
+    resident_pages = int(fid.read().split()[1])
+  return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def _get_children_peak_rss_bytes():
+  """Returns the peak RSS of the largest terminated child, e.g. a worker."""
+  # Kilobytes on Linux.
+  return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def _get_batch_size_config():
+  return dict(
+      n_node=_MAX_NODES_PER_GRAPH * FLAGS.n_graph,
+      n_edge=_MAX_EDGES_PER_GRAPH * FLAGS.n_graph,
+      n_graph=FLAGS.n_graph,
+      num_padding_buckets=FLAGS.num_padding_buckets)
+
+
+def _get_sampler_kwargs(arrays):
+  batch_size_config = _get_batch_size_config()
+  # Same budgets as `datasets.build_dataset_iterator`.
+  return dict(
+      user_years=arrays['user_year'],
+      max_nodes=batch_size_config['n_node'] - 1,
+      max_edges=batch_size_config['n_edge'],
+      **synthetic_data.get_sampler_adjacencies(arrays),
+      **_ONLINE_SUBSAMPLING_KWARGS)
+
+
+def _sample_batched(roots, arrays):
+  graphs = []
+  for start in range(0, roots.shape[0], FLAGS.sampler_batch_size):
+    graphs.extend(sub_sampler.subsample_graphs(
+        roots[start:start + FLAGS.sampler_batch_size],
+        **_get_sampler_kwargs(arrays)))
+  return graphs
+
+
+def _benchmark_sampler(arrays, roots):
+  """Returns the throughput of the per-root and batched sub-samplers."""
+  results = {}
+  for name, sample_fn in (
+      ('subsample_graph', lambda: [  # pylint: disable=g-long-lambda
+          sub_sampler.subsample_graph(root, **_get_sampler_kwargs(arrays))
+          for root in roots]),
+      ('subsample_graphs', lambda: _sample_batched(roots, arrays))):
+    start_time = time.time()
+    graphs = sample_fn()
+    elapsed_time = time.time() - start_time
+    results[name] = dict(
+        roots_per_second=roots.shape[0] / elapsed_time,
+        nodes_per_subgraph=np.mean([np.sum(g.n_node) for g in graphs]),
+        edges_per_subgraph=np.mean([np.sum(g.n_edge) for g in graphs]))
+  return results
+
+
+def _benchmark_batching(arrays, roots):
+  """Returns the throughput of batching labelled subgraphs."""
+  graphs = [
+      data_utils.add_nodes_year(
+          data_utils.add_nodes_label(graph, arrays['user_label']),
+          arrays['user_year'])
+      for graph in _sample_batched(roots, arrays)]
+  start_time = time.time()
+  num_batches = 0
+  for _ in batching_utils.dynamically_batch(
+      iter(graphs), packing_lookahead=FLAGS.packing_lookahead,
+      **_get_batch_size_config()):
+    num_batches += 1
+  elapsed_time = time.time() - start_time
+  fill_stats = pipeline_metrics.get_distribution_stats()
+  return dict(
+      roots_per_second=len(graphs) / elapsed_time,
+      batches_per_second=num_batches / elapsed_time,
+      node_fill=fill_stats['batch_node_fill']['mean'],
+      edge_fill=fill_stats['batch_edge_fill']['mean'])
+
+
+def _benchmark_iterator(arrays):
+  """Returns the throughput of the full input pipeline."""
+  # Imports JAX and TensorFlow Datasets, which the other benchmarks do not
+  # need.
+  import datasets  # pylint: disable=g-import-not-at-top
+  synthetic_data.set_dataset_sizes(FLAGS.num_users, FLAGS.num_groups)
+  start_time = time.time()
+  iterator = datasets.build_dataset_iterator(
+      data_root='',
+      split='train',
+      dynamic_batch_size_config=config_dict.ConfigDict(
+          _get_batch_size_config()),
+      online_subsampling_kwargs=_ONLINE_SUBSAMPLING_KWARGS,
+      is_training=False,
+      sampler_batch_size=FLAGS.sampler_batch_size,
+      num_sampling_workers=FLAGS.num_sampling_workers,
+      num_sampling_shards=FLAGS.num_sampling_shards,
+      sampling_seed=FLAGS.seed,
+      num_postprocessing_workers=FLAGS.num_postprocessing_workers,
+      feature_cache_num_hot_nodes=FLAGS.feature_cache_num_hot_nodes,
+      feature_cache_lru_size=FLAGS.feature_cache_lru_size,
+      packing_lookahead=FLAGS.packing_lookahead,
+      array_dict=arrays)
+  next(iterator)
+  first_batch_time = time.time() - start_time
+
+  # Throughput after the first batch, which includes building the pipeline.
+  start_time = time.time()
+  num_batches = num_roots = 0
+  for batch in iterator:
+    num_batches += 1
+    num_roots += int(np.sum(batch.central_node_mask))
+    if num_batches == FLAGS.num_batches:
+      break
+  elapsed_time = time.time() - start_time
+  iterator.close()
+  return dict(
+      first_batch_time=first_batch_time,
+      roots_per_second=num_roots / elapsed_time,
+      batches_per_second=num_batches / elapsed_time,
+      profile=pipeline_metrics.get_report())
+
+
+def _get_throughputs(results, prefix=''):
+  """Returns the `*_per_second` values of nested results, by path."""
+  throughputs = {}
+  for key, value in results.items():
+    if isinstance(value, dict):
+      throughputs.update(_get_throughputs(value, f'{prefix}{key}/'))
+    elif key.endswith('_per_second'):
+      throughputs[prefix + key] = value
+  return throughputs
+
+
+def _get_regressions(results, baseline, max_regression):
+  """Returns the throughputs which dropped from the baseline."""
+  throughputs = _get_throughputs(results)
+  regressions = {}
+  for name, baseline_value in _get_throughputs(baseline).items():
+    # Stage throughputs of the profile depend on the run length.
+    if '/profile/' in name or name not in throughputs:
+      continue
+    if throughputs[name] < (1 - max_regression) * baseline_value:
+      regressions[name] = dict(value=throughputs[name],
+                               baseline=baseline_value)
+  return regressions
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  unknown_benchmarks = set(FLAGS.benchmarks) - {
+      'sampler', 'batching', 'iterator'}
+  if unknown_benchmarks:
+    raise app.UsageError(f'Unknown benchmarks: {sorted(unknown_benchmarks)}')
+
+  rand = np.random.RandomState(FLAGS.seed)
+  np.random.seed(FLAGS.seed)
+  logging.info('Building synthetic graph')
+  start_time = time.time()
+  arrays = synthetic_data.build_arrays(
+      rand, FLAGS.num_users, FLAGS.num_groups, FLAGS.num_user_user_edges,
+      FLAGS.num_group_user_edges,
+      compact_adjacencies=FLAGS.compact_adjacencies)
+  logging.info('Built synthetic graph in %.1fs', time.time() - start_time)
+  roots = rand.choice(arrays['train_indices'], size=FLAGS.num_roots)
+
+  results = dict(graph=dict(rss_bytes=_get_rss_bytes()))
+  for name in FLAGS.benchmarks:
+    logging.info('Running benchmark %s', name)
+    pipeline_metrics.reset()
+    rss_bytes_before = _get_rss_bytes()
+    if name == 'sampler':
+      benchmark_results = _benchmark_sampler(arrays, roots)
+    elif name == 'batching':
+      benchmark_results = _benchmark_batching(arrays, roots)
+    else:
+      benchmark_results = _benchmark_iterator(arrays)
+    benchmark_results.update(
+        rss_bytes_before=rss_bytes_before,
+        rss_bytes_after=_get_rss_bytes(),
+        children_peak_rss_bytes=_get_children_peak_rss_bytes())
+    results[name] = benchmark_results
+    for key, value in sorted(_get_throughputs(benchmark_results).items()):
+      if not key.startswith('profile/'):
+        logging.info('%s %s: %.1f', name, key, value)
+    logging.info(
+        '%s: RSS %.2f GiB before, %.2f GiB after, workers peak RSS %.2f GiB',
+        name, rss_bytes_before / 2**30,
+        benchmark_results['rss_bytes_after'] / 2**30,
+        benchmark_results['children_peak_rss_bytes'] / 2**30)
+
+  if FLAGS.output_path:
+    output_path = Path(FLAGS.output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with output_path.open('w') as fid:
+      json.dump(dict(flags=FLAGS.flag_values_dict(), results=results), fid,
+                indent=2, default=float)
+    logging.info('Wrote results to %s', output_path)
+
+  if FLAGS.baseline_path:
+    with open(FLAGS.baseline_path) as fid:
+      baseline = json.load(fid)['results']
+    regressions = _get_regressions(results, baseline, FLAGS.max_regression)
+    for name, values in regressions.items():
+      logging.error('Regression of %s: %.1f, baseline %.1f', name,
+                    values['value'], values['baseline'])
+    if regressions:
+      raise RuntimeError(f'Throughputs regressed: {sorted(regressions)}')
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,99 @@
+"""Benchmarks the batched sub-sampler against the per-root sub-sampler.
+
+Usage:
+
+python3 benchmark_sub_sampler.py --num_users=1000000 --num_roots=2000
+"""
+
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+
+# pylint: disable=g-bad-import-order
+import sub_sampler
+import synthetic_data
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('num_users', 1_000_000, 'Number of synthetic users')
+flags.DEFINE_integer('num_groups', 50_000, 'Number of synthetic groups')
+flags.DEFINE_integer('num_user_user_edges', 10_000_000,
+                     'Number of synthetic user->user edges')
+flags.DEFINE_integer('num_group_user_edges', 20_000_000,
+                     'Number of synthetic group->user edges')
+flags.DEFINE_integer('num_roots', 2000, 'Number of root users to sample')
+flags.DEFINE_integer('batch_size', 256, 'Roots per `subsample_graphs` call')
+flags.DEFINE_integer('seed', 0, 'Random seed')
+
+# Same sampling configuration as `config.py`.
+_MAX_NB_NEIGHBOURS_PER_TYPE = [
+    [[40, 20, 0, 40], [0, 0, 0, 0], [0, 0, 0, 0]],
+    [[40, 20, 0, 40], [40, 0, 10, 0], [0, 0, 0, 0]],
+]
+_MAX_NODES = 340 - 1
+_MAX_EDGES = 720
+
+
+def _build_arrays(rand):
+  """Builds synthetic adjacencies with skewed degree distributions."""
+  adjacencies = synthetic_data.build_adjacencies(
+      rand, FLAGS.num_users, FLAGS.num_groups, FLAGS.num_user_user_edges,
+      FLAGS.num_group_user_edges)
+  return dict(
+      user_years=rand.randint(
+          1950, 2021, size=FLAGS.num_users).astype(np.int16),
+      **synthetic_data.get_sampler_adjacencies(adjacencies))
+
+
+def _run(name, sample_fn, roots):
+  start_time = time.time()
+  num_nodes, num_edges = sample_fn(roots)
+  elapsed_time = time.time() - start_time
+  logging.info(
+      '%s: %d roots in %.2fs (%.1f roots/s), %.1f nodes and %.1f edges per '
+      'subgraph.', name, roots.shape[0], elapsed_time,
+      roots.shape[0] / elapsed_time, num_nodes / roots.shape[0],
+      num_edges / roots.shape[0])
+  return elapsed_time
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  rand = np.random.RandomState(FLAGS.seed)
+  logging.info('Building synthetic graph')
+  arrays = _build_arrays(rand)
+  roots = rand.randint(FLAGS.num_users, size=FLAGS.num_roots)
+  sampler_kwargs = dict(
+      max_nb_neighbours_per_type=_MAX_NB_NEIGHBOURS_PER_TYPE,
+      max_nodes=_MAX_NODES,
+      max_edges=_MAX_EDGES,
+      remove_future_nodes=True,
+      deduplicate_nodes=True,
+      **arrays)
+
+  def per_root(roots):
+    graphs = [sub_sampler.subsample_graph(root, **sampler_kwargs)
+              for root in roots]
+    return (sum(int(g.n_node[0]) for g in graphs),
+            sum(int(g.n_edge[0]) for g in graphs))
+
+  def batched(roots):
+    num_nodes = num_edges = 0
+    for i in range(0, roots.shape[0], FLAGS.batch_size):
+      graphs = sub_sampler.subsample_graphs(
+          roots[i:i + FLAGS.batch_size], **sampler_kwargs)
+      num_nodes += sum(int(g.n_node[0]) for g in graphs)
+      num_edges += sum(int(g.n_edge[0]) for g in graphs)
+    return num_nodes, num_edges
+
+  per_root_time = _run('subsample_graph', per_root, roots)
+  batched_time = _run('subsample_graphs', batched, roots)
+  logging.info('Speedup: %.2fx', per_root_time / batched_time)
+
+
+if __name__ == '__main__':
+  app.run(main)
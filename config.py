@@ -31,6 +31,41 @@ def get_config(debug: bool = True) -> config_dict.ConfigDict:
                   k_fold_split_id=config_dict.placeholder(int),
                   use_all_labels_when_not_training=False,
                   use_dummy_adjacencies=debug,
+                  # Memory-map adjacencies converted with `csr_converter.py`.
+                  use_mmap_adjacencies=False,
+                  # Store adjacencies with uint32 indices and no boolean data.
+                  compact_adjacencies=True,
+                  # Roots sub-sampled together by the batched sampler, or
+                  # `None` to sub-sample one root at a time.
+                  sampler_batch_size=128,
+                  # Worker processes sharing the arrays for sub-sampling
+                  # (0 samples in the input thread), and whether subgraphs
+                  # keep the order of the roots. Workers memory-map arrays,
+                  # so without `use_mmap_adjacencies` the adjacencies are
+                  # first copied once to a temporary directory.
+                  num_sampling_workers=0 if debug else 8,
+                  ordered_sampling=True,
+                  # Shards of roots sampled by their own generators (and
+                  # share of the workers), interleaved in parallel.
+                  num_sampling_shards=1 if debug else 4,
+                  # Seed of the roots and sub-sampling, which are then
+                  # reproducible with `ordered_sampling`, or `None` to draw it.
+                  sampling_seed=config_dict.placeholder(int),
+                  # Threads post-processing batches ahead of the training
+                  # loop (0 post-processes in the input thread), and how many
+                  # batches they may get ahead.
+                  num_postprocessing_workers=0 if debug else 4,
+                  postprocessing_queue_size=8,
+                  # Features of the nodes of highest degree kept in memory,
+                  # and size of the LRU cache of other feature rows.
+                  feature_cache_num_hot_nodes=0 if debug else 5_000_000,
+                  feature_cache_lru_size=0 if debug else 1_000_000,
+                  # Subgraphs buffered to fill the space left in batches
+                  # (0 batches subgraphs in sampling order).
+                  packing_lookahead=0 if debug else 256,
+                  # If set, the input pipeline profile is also written to
+                  # this JSON file when logged.
+                  profile_report_path=config_dict.placeholder(str),
               ),
               optimizer=dict(
                   name='adamw',
@@ -75,6 +110,10 @@ def get_config(debug: bool = True) -> config_dict.ConfigDict:
                       n_node=256 if debug else 340 * 256,
                       n_edge=512 if debug else 720 * 256,
                       n_graph=4 if debug else 256,
+                      # Batches are padded to the smallest of that many
+                      # sizes up to `n_node` and `n_edge` which fits them,
+                      # or to a single size with several processes.
+                      num_padding_buckets=1 if debug else 4,
                   ),
               ),
               eval=dict(
@@ -87,6 +126,7 @@ def get_config(debug: bool = True) -> config_dict.ConfigDict:
                       n_node=256 if debug else 340 * 128,
                       n_edge=512 if debug else 720 * 128,
                       n_graph=4 if debug else 128,
+                      num_padding_buckets=1 if debug else 4,
                   ),
               ))))
 
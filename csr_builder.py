@@ -1,6 +1,9 @@
 """Builds CSR matrices which store the MAG graphs."""
 
+import json
+import multiprocessing
 import pathlib
+import time
 
 from absl import app
 from absl import flags
@@ -18,7 +21,7 @@ FLAGS = flags.FLAGS
 
 # Имена преобразуемых матриц и сущности.
 _DATA_FILES_AND_PARAMETERS = {
-    'group_contains_user_edges.npy': {
+    data_utils.RAW_GROUP_USER_EDGES_FILENAME.name: {
         'content_names': ('group', 'user'),
         'use_boolean': False
     }
@@ -26,9 +29,33 @@ _DATA_FILES_AND_PARAMETERS = {
 
 flags.DEFINE_string('data_root', None, 'Data root directory')
 flags.DEFINE_boolean('skip_existing', True, 'Skips existing CSR files')
+flags.DEFINE_boolean(
+    'streaming', False,
+    'Builds the raw CSR layout out-of-core by streaming the edges in chunks, '
+    'instead of building `.npz` files in memory')
+flags.DEFINE_integer('chunk_size', 50_000_000,
+                     'Number of edges per chunk in streaming mode')
+flags.DEFINE_boolean(
+    'canonicalize', True,
+    'In streaming mode, sorts and deduplicates the indices of each row')
+flags.DEFINE_integer('num_workers', multiprocessing.cpu_count(),
+                     'Number of processes used to canonicalize rows')
+flags.DEFINE_integer(
+    'max_entries_per_partition', 4_000_000,
+    'Maximum number of entries of the rows canonicalized at a time by a '
+    'worker')
+flags.DEFINE_float(
+    'canonicalization_memory_budget_gb', 8.,
+    'Memory available to all canonicalization workers. Fewer than '
+    '`num_workers` workers are used if needed to stay under it')
 
 flags.mark_flags_as_required(['data_root'])
 
+# Peak memory of a canonicalization worker per entry of its partition, for
+# the temporary row ids, sort order and sorted copies of the entries. About
+# 70 bytes were measured with int64 data.
+_CANONICALIZATION_BYTES_PER_ENTRY = 96
+
 # Считывает файл.
 def _read_edge_data(path):
   try:
@@ -70,6 +97,275 @@ def _get_output_paths(directory, content_names, use_boolean):
   return output_path, output_path_t
 
 
+def _iterate_edge_chunks(edges_data, chunk_size, description):
+  """Yields chunks of (senders, receivers), logging progress and throughput."""
+  num_edges = edges_data.shape[1]
+  start_time = time.time()
+  for start in range(0, num_edges, chunk_size):
+    end = min(start + chunk_size, num_edges)
+    yield np.asarray(edges_data[0, start:end]), np.asarray(
+        edges_data[1, start:end])
+    elapsed_time = time.time() - start_time
+    logging.info('%s: %d / %d edges. Elapsed time %.1f (%.2fM edges/s)',
+                 description, end, num_edges, elapsed_time,
+                 end / max(elapsed_time, 1e-6) / 1e6)
+
+
+def _add_counts(counts, values):
+  """Adds the histogram of `values` to `counts`, growing it if needed."""
+  chunk_counts = np.bincount(values)
+  if chunk_counts.shape[0] > counts.shape[0]:
+    counts = np.pad(counts, (0, chunk_counts.shape[0] - counts.shape[0]))
+  counts[:chunk_counts.shape[0]] += chunk_counts
+  return counts
+
+
+def _scatter_chunk(rows, columns, values, cursor, indices, data):
+  """Writes a chunk of entries at the next free position of their rows."""
+  order = np.argsort(rows, kind='stable')
+  rows = rows[order]
+  rank = np.arange(rows.shape[0]) - np.searchsorted(rows, rows)
+  positions = cursor[rows] + rank
+  indices[positions] = columns[order]
+  if data is not None:
+    data[positions] = values[order]
+  unique_rows, counts = np.unique(rows, return_counts=True)
+  cursor[unique_rows] += counts
+
+
+class _StreamingCsrWriter:
+  """Writes one CSR matrix into memory-mapped raw CSR arrays."""
+
+  def __init__(self, directory, degrees, num_columns, data_dtype):
+    self._directory = Path(directory)
+    self._directory.mkdir(parents=True, exist_ok=True)
+    nnz = int(degrees.sum())
+    self._shape = (degrees.shape[0], num_columns)
+    indptr = np.zeros([degrees.shape[0] + 1], dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    self._cursor = indptr[:-1].copy()
+    self._dtypes = dict(
+        indptr=data_utils.get_compact_indptr_dtype(nnz),
+        indices=data_utils.get_compact_indices_dtype(num_columns))
+    if data_dtype is not None:
+      self._dtypes['data'] = np.dtype(data_dtype)
+    np.save(self._directory / 'indptr.npy',
+            indptr.astype(self._dtypes['indptr']))
+    del indptr
+    self._indices = self._open_memmap('indices', nnz)
+    self._data = self._open_memmap('data', nnz) if data_dtype else None
+
+  def _open_memmap(self, name, size):
+    return np.lib.format.open_memmap(
+        self._directory / f'{name}.npy', mode='w+', dtype=self._dtypes[name],
+        shape=(size,))
+
+  def add(self, rows, columns, values):
+    _scatter_chunk(rows, columns, values, self._cursor, self._indices,
+                   self._data)
+
+  def close(self):
+    self._indices.flush()
+    if self._data is not None:
+      self._data.flush()
+    data_utils.write_csr_manifest(
+        self._directory, self._shape, self._indices.shape[0],
+        {name: str(dtype) for name, dtype in self._dtypes.items()})
+    del self._indices
+    del self._data
+
+
+def _build_csr_streaming(edges_data, output_dir, output_dir_t, use_boolean,
+                         chunk_size):
+  """Builds a CSR matrix and its transpose with bounded memory.
+
+  The first pass over the edges counts the degrees of both matrices, the second
+  pass scatters every chunk into the memory-mapped `indices` of both. Memory
+  use is bounded by the chunk size and the number of rows, not the number of
+  edges. Entries keep the order of the edge file within each row, and
+  duplicate edges are kept.
+
+  Args:
+    edges_data: `[2, num_edges]` array of (sender, receiver) pairs, typically
+      memory-mapped.
+    output_dir: Raw CSR directory for the senders x receivers matrix.
+    output_dir_t: Raw CSR directory for the transposed matrix.
+    use_boolean: Whether the matrices are boolean (no data array is stored).
+      Otherwise, as with `_build_coo`, receivers are stored as data.
+    chunk_size: Number of edges per chunk.
+  """
+  degrees = np.zeros([0], dtype=np.int64)
+  degrees_t = np.zeros([0], dtype=np.int64)
+  for senders, receivers in _iterate_edge_chunks(
+      edges_data, chunk_size, 'Counting degrees'):
+    degrees = _add_counts(degrees, senders)
+    degrees_t = _add_counts(degrees_t, receivers)
+
+  data_dtype = None if use_boolean else edges_data.dtype
+  writer = _StreamingCsrWriter(output_dir, degrees, degrees_t.shape[0],
+                               data_dtype)
+  writer_t = _StreamingCsrWriter(output_dir_t, degrees_t, degrees.shape[0],
+                                 data_dtype)
+  del degrees, degrees_t
+  for senders, receivers in _iterate_edge_chunks(
+      edges_data, chunk_size, 'Scattering edges'):
+    writer.add(senders, receivers, receivers)
+    writer_t.add(receivers, senders, receivers)
+  writer.close()
+  writer_t.close()
+
+
+def _load_raw_array(directory, name, mmap_mode='r'):
+  path = Path(directory) / f'{name}.npy'
+  if not path.exists():
+    return None
+  return np.load(path, mmap_mode=mmap_mode)
+
+
+def _sort_and_deduplicate_rows(directory, row_start, row_end):
+  """Canonicalizes a range of rows in place, returning their unique counts.
+
+  Unique entries of each row are moved to the beginning of the row, in sorted
+  order. As with `scipy.sparse`, the data of duplicate entries is summed.
+
+  Args:
+    directory: Raw CSR directory.
+    row_start: First row of the range.
+    row_end: End (exclusive) of the range.
+
+  Returns:
+    Number of unique entries of each row in the range.
+  """
+  indptr = _load_raw_array(directory, 'indptr')
+  indices = _load_raw_array(directory, 'indices', mmap_mode='r+')
+  data = _load_raw_array(directory, 'data', mmap_mode='r+')
+  row_indptr = np.asarray(indptr[row_start:row_end + 1], dtype=np.int64)
+  lo = row_indptr[0]
+  hi = row_indptr[-1]
+  num_rows = row_end - row_start
+  rows = np.repeat(np.arange(num_rows), np.diff(row_indptr))
+  columns = np.asarray(indices[lo:hi])
+  order = np.lexsort((columns, rows))
+  rows = rows[order]
+  columns = columns[order]
+  is_first = np.ones(rows.shape[0], dtype=bool)
+  is_first[1:] = (rows[1:] != rows[:-1]) | (columns[1:] != columns[:-1])
+  unique_rows = rows[is_first]
+  rank = np.arange(unique_rows.shape[0]) - np.searchsorted(
+      unique_rows, unique_rows)
+  positions = row_indptr[unique_rows] + rank
+  indices[positions] = columns[is_first]
+  if data is not None and rows.shape[0]:
+    values = np.asarray(data[lo:hi])[order]
+    data[positions] = np.add.reduceat(values, np.nonzero(is_first)[0])
+  indices.flush()
+  if data is not None:
+    data.flush()
+  return np.bincount(unique_rows, minlength=num_rows)
+
+
+def _compact_rows(directory, row_start, row_end, new_row_start,
+                  new_row_end):
+  """Copies the unique prefix of each row in a range to the new arrays."""
+  indptr = _load_raw_array(directory, 'indptr')
+  new_indptr = np.load(Path(directory) / 'indptr.canonical.npy',
+                       mmap_mode='r')
+  row_indptr = np.asarray(indptr[row_start:row_end + 1], dtype=np.int64)
+  counts = np.diff(np.asarray(new_indptr[row_start:row_end + 1],
+                              dtype=np.int64))
+  rows = np.repeat(np.arange(row_end - row_start), counts)
+  positions = (np.arange(rows.shape[0]) - (np.cumsum(counts) - counts)[rows] +
+               row_indptr[rows])
+  for name in ['indices', 'data']:
+    array = _load_raw_array(directory, name)
+    if array is None:
+      continue
+    output = np.load(Path(directory) / f'{name}.canonical.npy',
+                     mmap_mode='r+')
+    output[new_row_start:new_row_end] = array[positions]
+    output.flush()
+
+
+def _get_num_canonicalization_workers(num_workers, max_entries_per_partition,
+                                      memory_budget_bytes):
+  """Caps `num_workers` so that their partitions fit the memory budget."""
+  worker_bytes = max_entries_per_partition * _CANONICALIZATION_BYTES_PER_ENTRY
+  max_workers = max(1, int(memory_budget_bytes // worker_bytes))
+  if num_workers > max_workers:
+    logging.info(
+        'Using %d canonicalization workers instead of %d, to keep %.1f GB per '
+        'worker under a budget of %.1f GB.', max_workers, num_workers,
+        worker_bytes / 1e9, memory_budget_bytes / 1e9)
+  return min(num_workers, max_workers)
+
+
+def _canonicalize_csr(directory, num_workers, max_entries_per_partition):
+  """Sorts and deduplicates the indices of each row of a raw CSR matrix.
+
+  Rows are partitioned into ranges of at most `max_entries_per_partition`
+  entries (or a single row) and processed by `num_workers` processes: a first
+  pass canonicalizes each range in place, a second pass compacts the unique
+  entries into new arrays. The manifest is then marked as canonical.
+
+  Args:
+    directory: Raw CSR directory.
+    num_workers: Number of worker processes.
+    max_entries_per_partition: Bounds the memory used by each worker, to
+      about `_CANONICALIZATION_BYTES_PER_ENTRY` bytes per entry, except for
+      partitions of a single larger row.
+  """
+  directory = Path(directory)
+  with (directory / data_utils.CSR_MANIFEST_FILENAME).open() as fid:
+    manifest = json.load(fid)
+  indptr = _load_raw_array(directory, 'indptr')
+  sizes = {name: _load_raw_array(directory, name).shape[0]
+           for name in manifest['dtypes'] if name != 'indptr'}
+  if indptr[-1] != manifest['nnz'] or any(
+      size != manifest['nnz'] for size in sizes.values()):
+    raise ValueError(
+        f'Arrays of {directory} do not match its manifest, maybe because a '
+        'previous canonicalization was interrupted. Use flag '
+        '`--skip_existing=False` to rebuild them.')
+  partitions = data_utils.partition_csr_rows(indptr, max_entries_per_partition)
+  start_time = time.time()
+  with multiprocessing.Pool(num_workers) as pool:
+    unique_counts = pool.starmap(
+        _sort_and_deduplicate_rows,
+        [(directory, start, end) for start, end in partitions])
+    new_indptr = np.zeros([indptr.shape[0]], dtype=np.int64)
+    np.cumsum(np.concatenate(unique_counts), out=new_indptr[1:])
+    del unique_counts
+    nnz = int(new_indptr[-1])
+    logging.info('Sorted rows of %s in %.1fs, %d / %d unique entries.',
+                 directory, time.time() - start_time, nnz, indptr[-1])
+
+    dtypes = dict(manifest['dtypes'])
+    dtypes['indptr'] = str(data_utils.get_compact_indptr_dtype(nnz))
+    np.save(directory / 'indptr.canonical.npy',
+            new_indptr.astype(dtypes['indptr']))
+    for name in ['indices', 'data']:
+      if name in dtypes:
+        np.lib.format.open_memmap(
+            directory / f'{name}.canonical.npy', mode='w+',
+            dtype=dtypes[name], shape=(nnz,))
+    pool.starmap(
+        _compact_rows,
+        [(directory, start, end, new_indptr[start], new_indptr[end])
+         for start, end in partitions])
+  del indptr
+  for name in dtypes:
+    (directory / f'{name}.canonical.npy').replace(directory / f'{name}.npy')
+  data_utils.write_csr_manifest(directory, manifest['shape'], nnz, dtypes,
+                                canonical=True)
+  logging.info('Canonicalized %s in %.1fs', directory,
+               time.time() - start_time)
+
+
+def _is_canonical(manifest_path):
+  with manifest_path.open() as fid:
+    return json.load(fid).get('canonical', False)
+
+
 def _write_csr(path, csr):
   path.parent.mkdir(parents=True, exist_ok=True)
   with path.open('wb') as fid:
@@ -87,6 +383,39 @@ def main(argv):
     input_path = raw_data_dir / input_filename
     output_path, output_path_t = _get_output_paths(preprocessed_dir,
                                                    **parameters)
+    if FLAGS.streaming:
+      output_dir = data_utils.get_csr_arrays_directory(output_path)
+      output_dir_t = data_utils.get_csr_arrays_directory(output_path_t)
+      manifests = [d / data_utils.CSR_MANIFEST_FILENAME
+                   for d in (output_dir, output_dir_t)]
+      if FLAGS.skip_existing and all(m.exists() for m in manifests):
+        # A run interrupted before canonicalization leaves raw matrices behind.
+        directories = [
+            d for d, m in zip((output_dir, output_dir_t), manifests)
+            if FLAGS.canonicalize and not _is_canonical(m)]
+        if not directories:
+          logging.info(
+              '%s and %s exist: skipping. Use flag `--skip_existing=False`'
+              'to force overwrite existing.', output_dir, output_dir_t)
+          continue
+        logging.info('%s exist but are not canonical: canonicalizing.',
+                     ' and '.join(str(d) for d in directories))
+      else:
+        logging.info('Streaming CSR matrices from %s to %s and %s',
+                     input_path, output_dir, output_dir_t)
+        _build_csr_streaming(
+            _read_edge_data(input_path), output_dir, output_dir_t,
+            use_boolean=parameters['use_boolean'],
+            chunk_size=FLAGS.chunk_size)
+        directories = [output_dir, output_dir_t] if FLAGS.canonicalize else []
+      if directories:
+        num_workers = _get_num_canonicalization_workers(
+            FLAGS.num_workers, FLAGS.max_entries_per_partition,
+            FLAGS.canonicalization_memory_budget_gb * 1e9)
+        for directory in directories:
+          _canonicalize_csr(directory, num_workers,
+                            FLAGS.max_entries_per_partition)
+      continue
     if FLAGS.skip_existing and output_path.exists() and output_path_t.exists():
       # If both files exist, skip. When only one exists, that's handled below.
       logging.info(
@@ -0,0 +1,70 @@
+"""Converts the `.npz` CSR matrices to the raw, memory-mappable CSR layout.
+
+Usage:
+
+python3 csr_converter.py --data_root="mag_data"
+"""
+
+import pathlib
+
+from absl import app
+from absl import flags
+from absl import logging
+
+# pylint: disable=g-bad-import-order
+import data_utils
+
+Path = pathlib.Path
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_root', None, 'Data root directory')
+flags.DEFINE_boolean('skip_existing', True, 'Skips existing raw CSR files')
+flags.DEFINE_boolean('compact', True,
+                     'Stores uint32 indices, int32 indptr when possible and '
+                     'no data for boolean matrices')
+flags.DEFINE_multi_string(
+    'matrices', None,
+    'Paths of the `.npz` matrices to convert, relative to `data_root`. '
+    'Defaults to all adjacencies and fused adjacencies')
+
+flags.mark_flags_as_required(['data_root'])
+
+_CSR_FILENAMES = (
+    data_utils.EDGES_USER_USER_B,
+    data_utils.EDGES_USER_USER_B_T,
+    data_utils.EDGES_GROUP_USER,
+    data_utils.EDGES_USER_GROUP,
+    data_utils.EDGES_GROUP_INSTITUTION,
+    data_utils.EDGES_INSTITUTION_GROUP,
+    data_utils.FUSED_USER_EDGES_FILENAME,
+    data_utils.FUSED_USER_EDGES_T_FILENAME,
+)
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+
+  data_root = Path(FLAGS.data_root)
+  filenames = FLAGS.matrices or _CSR_FILENAMES
+  # Some of the filenames alias the same matrix, convert each only once.
+  for filename in sorted(set(map(Path, filenames))):
+    input_path = data_root / filename
+    output_dir = data_utils.get_csr_arrays_directory(input_path)
+    if not input_path.exists():
+      logging.info('%s does not exist: skipping.', input_path)
+      continue
+    manifest_path = output_dir / data_utils.CSR_MANIFEST_FILENAME
+    if FLAGS.skip_existing and manifest_path.exists():
+      logging.info(
+          '%s exists: skipping. Use flag `--skip_existing=False`'
+          'to force overwrite existing.', output_dir)
+      continue
+    logging.info('Converting %s to %s', input_path, output_dir)
+    data_utils.convert_npz_to_csr_arrays(
+        input_path, output_dir, compact=FLAGS.compact)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -1,8 +1,16 @@
 """Dataset utilities."""
 
+import collections
 import functools
+import json
+import mmap
+import multiprocessing
 import pathlib
-from typing import Dict, Tuple
+import queue
+import tempfile
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
 
 from absl import logging
 from graph_nets import graphs as tf_graphs
@@ -10,9 +18,9 @@ from graph_nets import utils_tf
 import numpy as np
 import scipy.sparse as sp
 import tensorflow as tf
-import tqdm
 
 # pylint: disable=g-bad-import-order
+import pipeline_metrics
 import sub_sampler
 
 Path = pathlib.Path
@@ -50,6 +58,17 @@ PREPROCESSED_DIR = Path("preprocessed")
 RAW_NODE_FEATURES_FILENAME = RAW_DIR / "node_feat.npy"
 RAW_NODE_LABELS_FILENAME = RAW_DIR / "node_label.npy"
 RAW_NODE_YEAR_FILENAME = RAW_DIR / "node_year.npy"
+RAW_GROUP_USER_EDGES_FILENAME = RAW_DIR / "group_contains_user_edges.npy"
+# Same edges with the original VK ids, and the sorted VK ids of the users and
+# groups: the position of a VK id is its dense id.
+RAW_GROUP_USER_RAW_ID_EDGES_FILENAME = (
+    RAW_DIR / "group_contains_user_raw_id_edges.npy")
+RAW_USER_IDS_FILENAME = RAW_DIR / "user_raw_ids.npy"
+RAW_GROUP_IDS_FILENAME = RAW_DIR / "group_raw_ids.npy"
+# Node inputs of the VK dumps, with rows indexed by VK user id, or holding VK
+# user ids for the split indices, which `id_index_builder.py` remaps to dense
+# ids at the paths of the same names in `RAW_DIR`.
+RAW_ID_INPUTS_DIR = RAW_DIR / "raw_ids"
 
 # (!)
 TRAIN_INDEX_FILENAME = RAW_DIR / "train_idx.npy"
@@ -63,6 +82,7 @@ EDGES_INSTITUTION_GROUP = PREPROCESSED_DIR / "user_group.npz"
 EDGES_GROUP_USER = PREPROCESSED_DIR / "group_user.npz"
 EDGES_USER_GROUP = PREPROCESSED_DIR / "user_group.npz"
 
+PCA_BASIS_FILENAME = PREPROCESSED_DIR / "user_feat_pca_basis.npz"
 PCA_USER_FEATURES_FILENAME = PREPROCESSED_DIR / "user_feat_pca_129.npy"
 PCA_GROUP_FEATURES_FILENAME = (
     PREPROCESSED_DIR / "group_feat_from_user_feat_pca_129.npy")
@@ -73,6 +93,7 @@ PCA_MERGED_FEATURES_FILENAME = (
 
 NEIGHBOR_INDICES_FILENAME = PREPROCESSED_DIR / "neighbor_indices.npy"
 NEIGHBOR_DISTANCES_FILENAME = PREPROCESSED_DIR / "neighbor_distances.npy"
+CANONICAL_USER_IDS_FILENAME = PREPROCESSED_DIR / "canonical_user_ids.npy"
 
 FUSED_NODE_LABELS_FILENAME = PREPROCESSED_DIR / "fused_node_labels.npy"
 FUSED_USER_EDGES_FILENAME = PREPROCESSED_DIR / "fused_user_edges.npz"
@@ -80,6 +101,20 @@ FUSED_USER_EDGES_T_FILENAME = PREPROCESSED_DIR / "fused_user_edges_t.npz"
 
 K_FOLD_SPLITS_DIR = Path("k_fold_splits")
 
+# Raw CSR layout: a directory next to each `.npz` file (same name without the
+# suffix) holding `indptr.npy`, `indices.npy`, optionally `data.npy`, and a
+# manifest describing them.
+CSR_MANIFEST_FILENAME = "manifest.json"
+CSR_FORMAT_VERSION = 1
+
+# Roots per task sent to sampling workers, unless `sampler_batch_size` is set.
+_SAMPLING_WORKER_CHUNK_SIZE = 64
+# Arrays read by `_subsample_roots`, shared with sampling workers.
+_SAMPLING_ARRAY_KEYS = (
+    "user_year", "user_label", "group_institution_index",
+    "institution_group_index", "group_user_index", "user_group_index",
+    "user_user_index", "user_user_index_t")
+
 
 def get_raw_directory(data_root):
   return Path(data_root) / "raw"
@@ -98,11 +133,260 @@ def _log_path_decorator(fn):
   return _decorated_fn
 
 
+class CsrArrays(NamedTuple):
+  """CSR adjacency held as raw, possibly memory-mapped, arrays.
+
+  Exposes the `indptr`, `indices` and `shape` attributes used by `sub_sampler`
+  so it can be used in place of a `scipy.sparse.csr_matrix` for sampling.
+  `indptr` may be shorter than `shape[0] + 1`, in which case the trailing rows
+  are empty; see `_pad_to_shape`.
+  """
+  indptr: np.ndarray
+  indices: np.ndarray
+  data: Optional[np.ndarray]
+  shape: Tuple[int, int]
+  # Whether indices are sorted and unique within each row.
+  canonical: bool = False
+
+  @property
+  def nnz(self):
+    return self.indices.shape[0]
+
+  def row(self, row_id: int) -> np.ndarray:
+    """Returns the column indices of a row."""
+    if row_id + 1 >= self.indptr.shape[0]:
+      return self.indices[:0]
+    return self.indices[self.indptr[row_id]:self.indptr[row_id + 1]]
+
+  def to_scipy(self) -> sp.csr_matrix:
+    """Returns a `scipy.sparse.csr_matrix`, materializing any padding."""
+    data = self.data
+    if data is None:
+      data = np.ones(self.indices.shape[0], dtype=bool)
+    indptr = self.indptr
+    required_padding = self.shape[0] + 1 - indptr.shape[0]
+    if required_padding > 0:
+      indptr = np.concatenate(
+          [indptr, np.full([required_padding], indptr[-1], indptr.dtype)])
+    csr = sp.csr_matrix((data, self.indices, indptr), shape=self.shape)
+    if self.canonical:
+      # Lets scipy skip sorting and summing duplicates.
+      csr.has_canonical_format = True
+    return csr
+
+
+def to_scipy_csr(csr) -> sp.csr_matrix:
+  """Returns a `scipy.sparse.csr_matrix` from a scipy matrix or `CsrArrays`."""
+  if isinstance(csr, CsrArrays):
+    return csr.to_scipy()
+  return csr
+
+
+def get_compact_indices_dtype(num_columns):
+  """Smallest dtype able to hold column indices below `num_columns`."""
+  if num_columns <= np.iinfo(np.uint32).max + 1:
+    return np.dtype(np.uint32)
+  return np.dtype(np.int64)
+
+
+def get_compact_indptr_dtype(nnz):
+  """Smallest dtype able to hold row offsets up to `nnz`."""
+  if nnz <= np.iinfo(np.int32).max:
+    return np.dtype(np.int32)
+  return np.dtype(np.int64)
+
+
+def compact_csr(csr) -> CsrArrays:
+  """Returns a CSR adjacency with the smallest index dtypes that fit.
+
+  Indices become uint32 when the number of columns allows it, `indptr` is
+  only int64 when the number of entries requires it, and boolean matrices do
+  not keep a `data` array. Arrays already in the compact dtypes are not copied.
+
+  Args:
+    csr: A `scipy.sparse.csr_matrix` or `CsrArrays`.
+
+  Returns:
+    A `CsrArrays`.
+  """
+  data = csr.data
+  if data is not None and data.dtype == bool:
+    data = None
+  return CsrArrays(
+      indptr=csr.indptr.astype(get_compact_indptr_dtype(csr.nnz), copy=False),
+      indices=csr.indices.astype(get_compact_indices_dtype(csr.shape[1]),
+                                 copy=False),
+      data=data,
+      shape=tuple(csr.shape),
+      canonical=_is_canonical(csr))
+
+
+def _is_canonical(csr):
+  if isinstance(csr, CsrArrays):
+    return csr.canonical
+  return bool(csr.has_canonical_format)
+
+
+def partition_csr_rows(indptr, max_entries_per_partition):
+  """Splits rows into contiguous ranges with a bounded number of entries.
+
+  Rows with more than `max_entries_per_partition` entries get their own range.
+
+  Args:
+    indptr: CSR `indptr` array.
+    max_entries_per_partition: Maximum number of entries per range.
+
+  Returns:
+    A list of `(row_start, row_end)` ranges covering all rows.
+  """
+  num_rows = indptr.shape[0] - 1
+  targets = np.arange(max_entries_per_partition, int(indptr[-1]),
+                      max_entries_per_partition)
+  boundaries = np.searchsorted(indptr, targets, side="left")
+  boundaries = np.unique(np.concatenate([[0], boundaries, [num_rows]]))
+  return list(zip(boundaries[:-1].tolist(), boundaries[1:].tolist()))
+
+
+def get_raw_id_input_filename(filename):
+  """Returns the path of the VK id version of a node input in `RAW_DIR`."""
+  return RAW_ID_INPUTS_DIR / Path(filename).name
+
+
+def get_csr_arrays_directory(path):
+  """Returns the raw CSR directory corresponding to an `.npz` path."""
+  return Path(path).with_suffix("")
+
+
+def write_csr_manifest(directory, shape, nnz, dtypes, canonical=False):
+  """Writes the manifest of a raw CSR directory.
+
+  Args:
+    directory: Raw CSR directory.
+    shape: Shape of the matrix.
+    nnz: Number of stored entries.
+    dtypes: Mapping from array name to dtype name, for the stored arrays.
+    canonical: Whether indices are sorted and unique within each row.
+  """
+  manifest = dict(
+      format_version=CSR_FORMAT_VERSION,
+      shape=[int(x) for x in shape],
+      nnz=int(nnz),
+      dtypes=dtypes,
+      canonical=bool(canonical),
+  )
+  # Written last, the manifest marks the directory as complete.
+  with (Path(directory) / CSR_MANIFEST_FILENAME).open("w") as fid:
+    json.dump(manifest, fid, indent=2)
+
+
+def save_csr_arrays(directory, indptr, indices, shape, data=None,
+                    canonical=False):
+  """Writes CSR arrays as separate `.npy` files plus a manifest."""
+  directory = Path(directory)
+  directory.mkdir(parents=True, exist_ok=True)
+  arrays = dict(indptr=indptr, indices=indices)
+  if data is not None:
+    arrays["data"] = data
+  for name, array in arrays.items():
+    np.save(directory / f"{name}.npy", array)
+  write_csr_manifest(
+      directory, shape, indices.shape[0],
+      {name: str(array.dtype) for name, array in arrays.items()},
+      canonical=canonical)
+
+
+def convert_npz_to_csr_arrays(npz_path, directory=None, compact=True):
+  """Converts a `scipy.sparse.save_npz` CSR file to the raw CSR layout.
+
+  Arrays are read one at a time from the archive, without building the scipy
+  matrix, to keep peak memory at the size of the largest array.
+
+  Args:
+    npz_path: Path of the `.npz` file.
+    directory: Output directory, by default next to `npz_path`.
+    compact: Whether to store the arrays with the dtypes of `compact_csr`.
+
+  Returns:
+    The output directory.
+  """
+  if directory is None:
+    directory = get_csr_arrays_directory(npz_path)
+  directory = Path(directory)
+  directory.mkdir(parents=True, exist_ok=True)
+  with np.load(str(npz_path)) as npz:
+    matrix_format = npz["format"].item()
+    if isinstance(matrix_format, bytes):
+      matrix_format = matrix_format.decode("ascii")
+    if matrix_format != "csr":
+      raise ValueError(f"Expected a csr matrix in {npz_path}, "
+                       f"got {matrix_format}.")
+    shape = tuple(npz["shape"])
+    # Save arrays without holding several of them in memory.
+    dtypes = {}
+    for name in ["indptr", "indices", "data"]:
+      array = npz[name]
+      if compact and name == "indptr":
+        array = array.astype(get_compact_indptr_dtype(array[-1]), copy=False)
+      elif compact and name == "indices":
+        array = array.astype(get_compact_indices_dtype(shape[1]), copy=False)
+      elif compact and name == "data" and array.dtype == bool:
+        continue
+      np.save(directory / f"{name}.npy", array)
+      dtypes[name] = str(array.dtype)
+      if name == "indices":
+        nnz = array.shape[0]
+      del array
+  write_csr_manifest(directory, shape, nnz, dtypes)
+  return directory
+
+
+def _load_csr_arrays(directory, mmap_mode="r"):
+  directory = Path(directory)
+  with (directory / CSR_MANIFEST_FILENAME).open() as fid:
+    manifest = json.load(fid)
+  if manifest["format_version"] != CSR_FORMAT_VERSION:
+    raise ValueError(
+        f"Unsupported CSR format version {manifest['format_version']} in "
+        f"{directory}.")
+  arrays = {
+      name: np.load(directory / f"{name}.npy", mmap_mode=mmap_mode)
+      for name in manifest["dtypes"]
+  }
+  csr = CsrArrays(
+      indptr=arrays["indptr"],
+      indices=arrays["indices"],
+      data=arrays.get("data"),
+      shape=tuple(manifest["shape"]),
+      canonical=manifest.get("canonical", False))
+  assert csr.indptr.shape[0] == csr.shape[0] + 1
+  assert csr.nnz == manifest["nnz"]
+  return csr
+
+
+@_log_path_decorator
+def load_csr_arrays(path, mmap_mode="r"):
+  """Loads a CSR adjacency saved with `save_csr_arrays`.
+
+  With `mmap_mode="r"` nothing is read upfront, and processes loading the same
+  adjacency share its pages through the page cache.
+
+  Args:
+    path: Raw CSR directory.
+    mmap_mode: Passed to `np.load`, `None` loads the arrays in memory.
+
+  Returns:
+    A `CsrArrays`.
+  """
+  return _load_csr_arrays(path, mmap_mode=mmap_mode)
+
+
 @_log_path_decorator
-def load_csr(path, debug=False):
+def load_csr(path, debug=False, use_mmap=False):
   if debug:
     # Dummy matrix for debugging.
     return sp.csr_matrix(np.zeros([10, 10]))
+  if use_mmap:
+    return _load_csr_arrays(get_csr_arrays_directory(path))
   ret = sp.load_npz(str(path))
   print('load_csr ret shape', ret.shape)
   return ret
@@ -113,6 +397,62 @@ def load_npy(path):
   return np.load(str(path))
 
 
+class IdIndex(NamedTuple):
+  """Maps sparse raw (VK) ids to dense ids, the positions of the sorted ids."""
+  raw_ids: np.ndarray
+
+  @property
+  def size(self):
+    return self.raw_ids.shape[0]
+
+  def to_dense(self, raw_ids, missing=-1) -> np.ndarray:
+    """Returns the dense ids of raw ids, `missing` for unknown raw ids."""
+    raw_ids = np.asarray(raw_ids)
+    dense_ids = np.searchsorted(self.raw_ids, raw_ids)
+    if not self.size:
+      return np.full_like(dense_ids, missing)
+    is_known = self.raw_ids[np.minimum(dense_ids, self.size - 1)] == raw_ids
+    return np.where(is_known, dense_ids, missing)
+
+  def to_raw(self, dense_ids) -> np.ndarray:
+    """Returns the raw ids of dense ids."""
+    return np.asarray(self.raw_ids[dense_ids])
+
+
+@_log_path_decorator
+def load_id_index(path, mmap_mode="r") -> IdIndex:
+  return IdIndex(np.load(path, mmap_mode=mmap_mode))
+
+
+class SortedIdAccumulator:
+  """Accumulates the sorted unique ids of a stream of id blocks.
+
+  The unique ids of the blocks are merged once they outnumber the ids merged
+  so far, so every id is only merged a logarithmic number of times.
+  """
+
+  def __init__(self, dtype=np.int64):
+    self._ids = np.zeros(0, dtype=dtype)
+    self._pending = []
+    self._num_pending = 0
+
+  def add(self, ids):
+    ids = np.unique(ids)
+    self._pending.append(ids)
+    self._num_pending += ids.shape[0]
+    if self._num_pending > self._ids.shape[0]:
+      self._merge()
+
+  def _merge(self):
+    self._ids = np.unique(np.concatenate([self._ids] + self._pending))
+    self._pending = []
+    self._num_pending = 0
+
+  def result(self) -> np.ndarray:
+    self._merge()
+    return self._ids
+
+
 @functools.lru_cache()
 def get_arrays(data_root="/data/",
                use_fused_node_labels=True,
@@ -120,8 +460,15 @@ def get_arrays(data_root="/data/",
                return_pca_embeddings=True,
                k_fold_split_id=None,
                return_adjacencies=True,
-               use_dummy_adjacencies=False):
-  """Returns all arrays needed for training."""
+               use_dummy_adjacencies=False,
+               use_mmap_adjacencies=False,
+               compact_adjacencies=False):
+  """Returns all arrays needed for training.
+
+  With `use_mmap_adjacencies`, adjacencies are memory-mapped from the raw CSR
+  layout written by `csr_converter.py` instead of loaded from `.npz` files.
+  With `compact_adjacencies`, adjacencies are converted with `compact_csr`.
+  """
   logging.info("Starting to get files")
 
   data_root = Path(data_root)
@@ -150,18 +497,22 @@ def get_arrays(data_root="/data/",
     logging.info("Starting to get adjacencies.")
     if use_fused_node_adjacencies:
       user_user_index = load_csr(
-          data_root / FUSED_USER_EDGES_FILENAME, debug=use_dummy_adjacencies)
+          data_root / FUSED_USER_EDGES_FILENAME, debug=use_dummy_adjacencies,
+          use_mmap=use_mmap_adjacencies)
       user_user_index_t = load_csr(
-          data_root / FUSED_USER_EDGES_T_FILENAME, debug=use_dummy_adjacencies)
+          data_root / FUSED_USER_EDGES_T_FILENAME, debug=use_dummy_adjacencies,
+          use_mmap=use_mmap_adjacencies)
     array_dict.update(
         dict(
             # Всевозможные связи между автором и институтами,статьями
             group_institution_index=load_csr(
                 data_root / EDGES_GROUP_INSTITUTION, #"user_user_b.npz"
-                debug=use_dummy_adjacencies),
+                debug=use_dummy_adjacencies,
+                use_mmap=use_mmap_adjacencies),
             institution_group_index=load_csr(
                 data_root / EDGES_INSTITUTION_GROUP, #"institution_group.npz"
-                debug=use_dummy_adjacencies)
+                debug=use_dummy_adjacencies,
+                use_mmap=use_mmap_adjacencies)
         ))
 
   if return_pca_embeddings:
@@ -177,6 +528,8 @@ def get_arrays(data_root="/data/",
   # assert array_dict["user_label"].shape[0] == NUM_USERS
 
   if return_adjacencies and not use_dummy_adjacencies:
+    if compact_adjacencies:
+      array_dict = _compact_adjacencies(array_dict)
     array_dict = _fix_adjacency_shapes(array_dict)
 
     # Тесты на сохранение количества каждой сущности
@@ -226,66 +579,523 @@ def add_nodes_embedding_from_array(graph, array):
   return graph._replace(nodes=nodes)
 
 
-def get_graph_subsampling_dataset(
-    prefix, arrays, shuffle_indices, ratio_unlabeled_data_to_labeled_data,
-    max_nodes, max_edges,
-    **subsampler_kwargs):
-  """Returns tf_dataset for online sampling."""
-
-  def generator():
-    labeled_indices = arrays[f"{prefix}_indices"]
-    if ratio_unlabeled_data_to_labeled_data > 0:
-      num_unlabeled_data_to_add = int(ratio_unlabeled_data_to_labeled_data *
-                                      labeled_indices.shape[0])
-      unlabeled_indices = np.random.choice(
-          NUM_USERS, size=num_unlabeled_data_to_add, replace=False)
-      root_node_indices = np.concatenate([labeled_indices, unlabeled_indices])
-    else:
-      root_node_indices = labeled_indices
-    if shuffle_indices:
-      root_node_indices = root_node_indices.copy()
-      np.random.shuffle(root_node_indices)
-
-    for index in root_node_indices:
-      graph = sub_sampler.subsample_graph(
-          index,
-          arrays["group_institution_index"],
-          arrays["institution_group_index"],
-          arrays["group_user_index"],
-          arrays["user_group_index"],
-          arrays["user_user_index"],
-          arrays["user_user_index_t"],
+def _subsample_roots(root_node_indices, arrays, max_nodes, max_edges,
+                     sampler_batch_size, subsampler_kwargs, profile=None,
+                     rng=np.random):
+  """Yields labelled subgraphs around the given roots.
+
+  Args:
+    root_node_indices: Roots to sample around.
+    arrays: Arrays returned by `get_arrays`.
+    max_nodes: Maximum number of nodes of a subgraph.
+    max_edges: Maximum number of edges of a subgraph.
+    sampler_batch_size: Number of roots sub-sampled together, or `None`.
+    subsampler_kwargs: Other arguments of the sub-sampler.
+    profile: If set, a `collections.defaultdict(list)` to which the sampling
+      time per root, the size of the subgraphs and the time to label them are
+      appended, for `pipeline_metrics.record_values`.
+    rng: `np.random.RandomState` to sample with, the global one by default.
+
+  Yields:
+    Labelled subgraphs.
+  """
+  adjacencies = dict(
+      group_institution_csr=arrays["group_institution_index"],
+      institution_group_csr=arrays["institution_group_index"],
+      group_user_csr=arrays["group_user_index"],
+      user_group_csr=arrays["user_group_index"],
+      user_user_csr=arrays["user_user_index"],
+      user_user_transpose_csr=arrays["user_user_index_t"],
+  )
+
+  def sample_graphs():
+    """Yields subgraphs, with the sampling time per root."""
+    if not sampler_batch_size:
+      for index in root_node_indices:
+        start_time = time.time()
+        graph = sub_sampler.subsample_graph(
+            index,
+            user_years=arrays["user_year"],
+            max_nodes=max_nodes,
+            max_edges=max_edges,
+            rng=rng,
+            **adjacencies,
+            **subsampler_kwargs)
+        yield graph, time.time() - start_time
+      return
+    for start in range(0, root_node_indices.shape[0], sampler_batch_size):
+      start_time = time.time()
+      graphs = sub_sampler.subsample_graphs(
+          root_node_indices[start:start + sampler_batch_size],
           user_years=arrays["user_year"],
           max_nodes=max_nodes,
           max_edges=max_edges,
+          rng=rng,
+          **adjacencies,
           **subsampler_kwargs)
+      # Roots of a batch are sampled together.
+      root_time = (time.time() - start_time) / max(len(graphs), 1)
+      for graph in graphs:
+        yield graph, root_time
+
+  for graph, root_time in sample_graphs():
+    start_time = time.time()
+    graph = add_nodes_label(graph, arrays["user_label"])
+    label_time = time.time()
+    graph = add_nodes_year(graph, arrays["user_year"])
+    if profile is not None:
+      profile["root_sampling_time"].append(root_time)
+      profile["add_nodes_label_time"].append(label_time - start_time)
+      profile["add_nodes_year_time"].append(time.time() - label_time)
+      profile["subgraph_nodes"].append(int(np.sum(graph.n_node)))
+      profile["subgraph_edges"].append(len(graph.senders))
+    yield graph
+
+
+# Arguments of `_subsample_roots` in sampling worker processes.
+_SAMPLING_WORKER_ARGS = {}
+
+# Arrays smaller than this are sent to sampling workers instead of mapped.
+_MIN_MAPPED_ARRAY_BYTES = 1 << 20
+
+
+class _MappedArray(NamedTuple):
+  """Picklable reference to an array memory-mapped from a `.npy` file."""
+  path: str
+  dtype: str
+  shape: Tuple[int, ...]
+  offset: int
+
+  def open(self) -> np.ndarray:
+    return np.memmap(self.path, dtype=self.dtype, mode="r",
+                     offset=self.offset, shape=self.shape)
+
+
+# Arrays saved for sampling workers, by id along with the array so that the
+# id is not reused, and the directory they are saved to, removed at exit.
+_SAVED_WORKER_ARRAYS = {}
+_SAVED_WORKER_ARRAYS_LOCK = threading.Lock()
+_saved_worker_arrays_directory = None
+
+
+def _save_array(array, name):
+  """Returns a `_MappedArray` of a copy of `array`, saved once per process."""
+  global _saved_worker_arrays_directory
+  with _SAVED_WORKER_ARRAYS_LOCK:
+    if id(array) in _SAVED_WORKER_ARRAYS:
+      return _SAVED_WORKER_ARRAYS[id(array)][1]
+    if _saved_worker_arrays_directory is None:
+      _saved_worker_arrays_directory = tempfile.TemporaryDirectory(
+          prefix="sampling_arrays_")
+    logging.warning(
+        "Saving %s (%.2f GiB) for sampling workers to %s, since it is not "
+        "memory-mapped. Use `use_mmap_adjacencies` to avoid the copy.", name,
+        array.nbytes / 2**30, _saved_worker_arrays_directory.name)
+    start_time = time.time()
+    # Arrays of other `get_arrays` calls may have the same name.
+    path = (Path(_saved_worker_arrays_directory.name) /
+            f"{name}_{len(_SAVED_WORKER_ARRAYS)}.npy")
+    np.save(path, array)
+    mapped = np.load(path, mmap_mode="r")
+    mapped_array = _MappedArray(str(path), mapped.dtype.str, mapped.shape,
+                                mapped.offset)
+    logging.info("Saved %s in %.1fs", name, time.time() - start_time)
+    _SAVED_WORKER_ARRAYS[id(array)] = (array, mapped_array)
+    return mapped_array
+
+
+def _map_array(array, name):
+  """Returns a `_MappedArray` of `array`, saved if needed.
+
+  Arrays memory-mapped from a file are referenced as is. Other arrays are
+  saved once per process, and reused by later iterators over the same arrays,
+  so that workers share their pages through the page cache.
+  """
+  if array.nbytes < _MIN_MAPPED_ARRAY_BYTES:
+    return np.asarray(array)
+  if (isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and
+      array.flags.c_contiguous):
+    return _MappedArray(str(array.filename), array.dtype.str, array.shape,
+                        array.offset)
+  return _save_array(array, name)
+
+
+def _open_array(array):
+  return array.open() if isinstance(array, _MappedArray) else array
+
+
+class _WorkerArrays:
+  """Arrays used for sub-sampling, shared with worker processes.
+
+  Workers are started from a fork server, which does not inherit the memory
+  (nor the threads) of the training process, so arrays are memory-mapped by
+  the workers instead. Arrays which are not memory-mapped already, e.g.
+  adjacencies loaded without `use_mmap_adjacencies`, are saved once per
+  process to a temporary directory, see `_save_array`.
+  """
+
+  def __init__(self, arrays):
+    self.arrays = {}
+    for key in _SAMPLING_ARRAY_KEYS:
+      value = arrays[key]
+      if isinstance(value, np.ndarray):
+        self.arrays[key] = _map_array(value, key)
+      else:
+        # Only `indptr` and `indices` are used for sampling.
+        self.arrays[key] = CsrArrays(
+            indptr=_map_array(value.indptr, f"{key}_indptr"),
+            indices=_map_array(value.indices, f"{key}_indices"),
+            data=None,
+            shape=tuple(value.shape),
+            canonical=_is_canonical(value))
+
+
+def _open_worker_arrays(arrays):
+  return {
+      key: (_open_array(value) if not isinstance(value, CsrArrays) else
+            value._replace(indptr=_open_array(value.indptr),
+                           indices=_open_array(value.indices)))
+      for key, value in arrays.items()}
+
+
+def _init_sampling_worker(arrays, max_nodes, max_edges, sampler_batch_size,
+                          subsampler_kwargs):
+  _SAMPLING_WORKER_ARGS.update(
+      arrays=_open_worker_arrays(arrays),
+      max_nodes=max_nodes,
+      max_edges=max_edges,
+      sampler_batch_size=sampler_batch_size,
+      subsampler_kwargs=subsampler_kwargs)
+
+
+def _subsample_roots_in_worker(chunk_id, seed, root_node_indices):
+  """Returns the subgraphs of the roots, and the profile of the sampling."""
+  # Seed by chunk so that samples do not depend on the worker scheduling.
+  rng = np.random.RandomState([seed, chunk_id])
+  # Metrics recorded in the worker would stay in the worker.
+  profile = collections.defaultdict(list)
+  graphs = list(_subsample_roots(root_node_indices, profile=profile, rng=rng,
+                                 **_SAMPLING_WORKER_ARGS))
+  return graphs, dict(profile)
+
+
+def _subsample_roots_with_worker_pool(
+    root_node_indices, worker_arrays, num_workers, ordered, chunk_size, rng,
+    **subsample_roots_kwargs):
+  """Shards roots across worker processes and streams back their subgraphs.
+
+  Workers are forked from a fork server rather than from this process, which
+  runs TF and JAX threads, and memory-map the arrays of `worker_arrays`. At
+  most `2 * num_workers` chunks are in flight at any time, which bounds the
+  memory used by sampled graphs.
+
+  Args:
+    root_node_indices: Roots to sample around.
+    worker_arrays: `_WorkerArrays` of the arrays returned by `get_arrays`.
+    num_workers: Number of worker processes.
+    ordered: Whether to yield subgraphs in the order of `root_node_indices`,
+      or as soon as each chunk is ready.
+    chunk_size: Number of roots sent to a worker at a time.
+    rng: `np.random.RandomState` seeding the sampling of every chunk.
+    **subsample_roots_kwargs: Remaining arguments of `_subsample_roots`.
+
+  Yields:
+    Labelled subgraphs.
+  """
+  seed = rng.randint(2**31)
+
+  def record_profile(result):
+    graphs, profile = result
+    pipeline_metrics.record_values(profile, prefix="sampling/")
+    return graphs
+
+  max_chunks_in_flight = 2 * num_workers
+  chunks = (
+      (chunk_id, seed, root_node_indices[start:start + chunk_size])
+      for chunk_id, start in enumerate(
+          range(0, root_node_indices.shape[0], chunk_size)))
+  results = queue.Queue()
+
+  def next_result(pending):
+    if ordered:
+      return record_profile(pending.popleft().get())
+    pending.popleft()
+    result = results.get()
+    if isinstance(result, Exception):
+      raise result
+    return record_profile(result)
+
+  context = multiprocessing.get_context("forkserver")
+  # Workers share the modules imported once by the fork server, which only
+  # takes effect before the server starts.
+  context.set_forkserver_preload([__name__])
+  with context.Pool(
+      num_workers,
+      initializer=_init_sampling_worker,
+      initargs=(worker_arrays.arrays, subsample_roots_kwargs["max_nodes"],
+                subsample_roots_kwargs["max_edges"],
+                subsample_roots_kwargs["sampler_batch_size"],
+                subsample_roots_kwargs["subsampler_kwargs"])) as pool:
+    callbacks = {} if ordered else dict(
+        callback=results.put, error_callback=results.put)
+    pending = collections.deque()
+    for chunk in chunks:
+      pending.append(
+          pool.apply_async(_subsample_roots_in_worker, chunk, **callbacks))
+      if len(pending) >= max_chunks_in_flight:
+        yield from next_result(pending)
+    while pending:
+      yield from next_result(pending)
+
+
+def _record_sampling_profile(root_node_indices, arrays, rng, **kwargs):
+  """Yields the subgraphs of `_subsample_roots`, recording its profile."""
+  profile = collections.defaultdict(list)
+  for graph in _subsample_roots(root_node_indices, arrays, profile=profile,
+                                rng=rng, **kwargs):
+    pipeline_metrics.record_values(profile, prefix="sampling/")
+    profile.clear()
+    yield graph
 
-      graph = add_nodes_label(graph, arrays["user_label"])
-      graph = add_nodes_year(graph, arrays["user_year"])
-      graph = tf_graphs.GraphsTuple(*graph)
-      yield graph
 
-  sample_graph = next(generator())
-
-  return tf.data.Dataset.from_generator(
-      generator,
-      output_signature=utils_tf.specs_from_graphs_tuple(sample_graph))
+def get_graph_subsampling_dataset(
+    prefix, arrays, shuffle_indices, ratio_unlabeled_data_to_labeled_data,
+    max_nodes, max_edges, sampler_batch_size=None, num_sampling_workers=0,
+    ordered_sampling=True, num_sampling_shards=1, seed=None,
+    **subsampler_kwargs):
+  """Returns tf_dataset for online sampling.
+
+  When `sampler_batch_size` is set, roots are sub-sampled in batches of that
+  size with `sub_sampler.subsample_graphs` instead of one at a time. When
+  `num_sampling_workers` is positive, sub-sampling runs in that many worker
+  processes, which memory-map the arrays (see `_WorkerArrays`);
+  `ordered_sampling` controls whether subgraphs keep the order of the roots.
+
+  With `num_sampling_shards > 1`, roots are split into that many shards, each
+  sub-sampled by its own generator (and its share of the sampling workers),
+  and the shards are interleaved in parallel by `tf.data`. Subgraphs are then
+  deterministically interleaved only with `ordered_sampling`.
+
+  The roots of every epoch are drawn once for all shards, and each shard
+  shuffles and sub-samples them with its own `np.random.RandomState`, seeded
+  from `seed`, the epoch and the shard. Samples are therefore reproducible for
+  a given `seed`, with `ordered_sampling`, which is drawn from the global
+  `np.random` state if not set.
+  """
+
+  subsample_roots_kwargs = dict(
+      max_nodes=max_nodes,
+      max_edges=max_edges,
+      sampler_batch_size=sampler_batch_size,
+      subsampler_kwargs=subsampler_kwargs)
+  if num_sampling_workers > 0:
+    # Shared by the worker pools of all shards and epochs.
+    worker_arrays = _WorkerArrays(arrays)
+  if seed is None:
+    seed = np.random.randint(2**31)
+
+  def draw_roots(epoch):
+    labeled_indices = arrays[f"{prefix}_indices"]
+    if ratio_unlabeled_data_to_labeled_data <= 0:
+      return labeled_indices
+    num_unlabeled_data_to_add = int(ratio_unlabeled_data_to_labeled_data *
+                                    labeled_indices.shape[0])
+    unlabeled_indices = np.random.RandomState([seed, epoch]).choice(
+        NUM_USERS, size=num_unlabeled_data_to_add, replace=False)
+    return np.concatenate([labeled_indices, unlabeled_indices])
+
+  # Roots of the epochs not started by all shards yet, with the number of
+  # shards left to start them, and the next epoch of every shard.
+  epoch_roots = {}
+  shard_epochs = collections.Counter()
+  roots_lock = threading.Lock()
+
+  def get_epoch_roots(shard_id):
+    with roots_lock:
+      epoch = shard_epochs[shard_id]
+      shard_epochs[shard_id] += 1
+      if epoch not in epoch_roots:
+        epoch_roots[epoch] = [draw_roots(epoch), num_sampling_shards]
+      roots = epoch_roots[epoch]
+      roots[1] -= 1
+      if not roots[1]:
+        del epoch_roots[epoch]
+      return epoch, roots[0]
+
+  def generator(shard_id=0):
+    shard_id = int(shard_id)
+    epoch, root_node_indices = get_epoch_roots(shard_id)
+    rng = np.random.RandomState([seed, epoch, shard_id])
+    # Every shard samples around its own part of the roots.
+    root_node_indices = root_node_indices[shard_id::num_sampling_shards]
+    if shuffle_indices:
+      root_node_indices = root_node_indices.copy()
+      rng.shuffle(root_node_indices)
+
+    if num_sampling_workers > 0:
+      graphs = _subsample_roots_with_worker_pool(
+          root_node_indices, worker_arrays,
+          num_workers=max(1, num_sampling_workers // num_sampling_shards),
+          ordered=ordered_sampling,
+          chunk_size=sampler_batch_size or _SAMPLING_WORKER_CHUNK_SIZE,
+          rng=rng,
+          **subsample_roots_kwargs)
+    else:
+      graphs = _record_sampling_profile(
+          root_node_indices, arrays, rng=rng, **subsample_roots_kwargs)
+    if num_sampling_shards > 1:
+      graphs = pipeline_metrics.count_elements(
+          graphs, f"sampling/shard_{shard_id}")
+    for graph in pipeline_metrics.count_elements(graphs, "sampling"):
+      yield tf_graphs.GraphsTuple(*graph)
+
+  # Sampled in this process, without starting a worker pool.
+  sample_graph = next(_subsample_roots(
+      arrays[f"{prefix}_indices"][:1], arrays,
+      rng=np.random.RandomState(seed), **subsample_roots_kwargs))
+  output_signature = utils_tf.specs_from_graphs_tuple(
+      tf_graphs.GraphsTuple(*sample_graph))
+
+  if num_sampling_shards <= 1:
+    return tf.data.Dataset.from_generator(
+        generator, output_signature=output_signature)
+  return tf.data.Dataset.range(num_sampling_shards).interleave(
+      lambda shard_id: tf.data.Dataset.from_generator(
+          generator, args=(shard_id,), output_signature=output_signature),
+      cycle_length=num_sampling_shards,
+      block_length=1,
+      num_parallel_calls=num_sampling_shards,
+      deterministic=ordered_sampling)
+
+
+_AGGREGATION_MODES = ("mean", "sum", "normalized")
+
+# Arguments of `_aggregate_rows` in aggregation worker processes.
+_AGGREGATION_WORKER_ARGS = {}
+
+
+def _aggregate_rows(csr, features, output, row_start, row_end, mode,
+                    column_degrees):
+  """Aggregates the features of the columns of a range of rows."""
+  indptr = np.asarray(csr.indptr[row_start:row_end + 1], dtype=np.int64)
+  columns = np.asarray(csr.indices[indptr[0]:indptr[-1]])
+  degrees = np.diff(indptr)
+  # Gather each distinct column once, then reduce with a local sparse matmul.
+  unique_columns, local_columns = np.unique(columns, return_inverse=True)
+  rows = np.repeat(np.arange(row_end - row_start), degrees)
+  if mode == "normalized":
+    weights = 1. / np.sqrt(degrees[rows] *
+                           column_degrees[columns].astype(np.float64))
+  else:
+    weights = np.ones(columns.shape[0])
+  block = sp.csr_matrix(
+      (weights.astype(np.float32), local_columns.reshape(-1),
+       indptr - indptr[0]),
+      shape=(row_end - row_start, unique_columns.shape[0]))
+  aggregated = block @ features[unique_columns].astype(np.float32)
+  if mode == "mean":
+    with np.errstate(divide="ignore", invalid="ignore"):
+      aggregated /= degrees[:, None]
+  output[row_start:row_end] = aggregated
+
+
+def _init_aggregation_worker(csr, features, output_path, mode, column_degrees):
+  _AGGREGATION_WORKER_ARGS.update(
+      csr=csr, features=features, output=np.load(output_path, mmap_mode="r+"),
+      mode=mode, column_degrees=column_degrees)
+
+
+def _aggregate_rows_in_worker(block):
+  row_start, row_end = block
+  _aggregate_rows(row_start=row_start, row_end=row_end,
+                  **_AGGREGATION_WORKER_ARGS)
+  _AGGREGATION_WORKER_ARGS["output"].flush()
+
+
+def aggregate_csr_features(csr, features, output_path=None, mode="mean",
+                           max_entries_per_block=1 << 20, num_workers=0,
+                           column_degrees=None):
+  """Aggregates the features of the columns of each row of a CSR matrix.
+
+  Rows are processed in blocks of at most `max_entries_per_block` entries,
+  each reduced with a sparse x dense product over the distinct columns of the
+  block. With `output_path`, results are written incrementally to a
+  memory-mapped `.npy` file, so memory stays bounded by the block size.
+
+  Args:
+    csr: A `scipy.sparse.csr_matrix` or `CsrArrays`, rows past the end of
+      `indptr` are empty.
+    features: `[num_columns, feature_size]` array, typically memory-mapped.
+    output_path: Optional `.npy` path to write the output to.
+    mode: "mean" averages features (empty rows are NaN), "sum" sums them and
+      "normalized" sums them weighted by `1 / sqrt(d_row * d_column)`.
+    max_entries_per_block: Maximum number of entries per block of rows.
+    num_workers: If positive, blocks are processed by that many forked worker
+      processes, which requires `output_path`.
+    column_degrees: Number of entries of each column, for "normalized" mode.
+      Computed from `csr` when not given.
+
+  Returns:
+    The `[num_rows, feature_size]` aggregated features, memory-mapped when
+    `output_path` is given.
+  """
+  if mode not in _AGGREGATION_MODES:
+    raise ValueError(f"Invalid aggregation mode {mode}, expected one of "
+                     f"{_AGGREGATION_MODES}.")
+  if num_workers > 0 and output_path is None:
+    raise ValueError("`output_path` is required when using workers.")
+  if mode == "normalized" and column_degrees is None:
+    column_degrees = np.zeros([csr.shape[1]], dtype=np.int64)
+    for start in range(0, csr.indices.shape[0], max_entries_per_block):
+      column_degrees += np.bincount(
+          csr.indices[start:start + max_entries_per_block],
+          minlength=csr.shape[1])
+
+  output_shape = (csr.shape[0], features.shape[1])
+  if output_path is None:
+    output = np.zeros(output_shape, dtype=features.dtype)
+  else:
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    output = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=features.dtype, shape=output_shape)
+
+  # Rows past the end of `indptr` are empty.
+  num_physical_rows = min(csr.indptr.shape[0] - 1, csr.shape[0])
+  output[num_physical_rows:] = np.nan if mode == "mean" else 0
+  blocks = partition_csr_rows(csr.indptr[:num_physical_rows + 1],
+                              max_entries_per_block)
+  aggregate_kwargs = dict(csr=csr, features=features, mode=mode,
+                          column_degrees=column_degrees)
+  if num_workers > 0:
+    output.flush()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(
+        num_workers,
+        initializer=_init_aggregation_worker,
+        initargs=(csr, features, output_path, mode, column_degrees)) as pool:
+      for i, _ in enumerate(
+          pool.imap_unordered(_aggregate_rows_in_worker, blocks)):
+        if i % 100 == 0:
+          logging.info("%d/%d blocks", i, len(blocks))
+  else:
+    for i, (row_start, row_end) in enumerate(blocks):
+      _aggregate_rows(output=output, row_start=row_start, row_end=row_end,
+                      **aggregate_kwargs)
+      if i % 100 == 0:
+        logging.info("%d/%d blocks", i, len(blocks))
+  if output_path is not None:
+    output.flush()
+  return output
 
 
 def user_features_to_group_features(
-    group_user_index, user_features):
+    group_user_index, user_features, output_path=None, num_workers=0):
   """Averages user features to groups."""
   # assert user_features.shape[0] == NUM_USERS
   assert group_user_index.shape[0] == NUM_GROUPS
-  group_features = np.zeros(
-      [NUM_GROUPS, user_features.shape[1]], dtype=user_features.dtype)
-  for group_i in range(NUM_GROUPS):
-    user_indices = group_user_index[group_i].indices
-    group_features[group_i] = user_features[user_indices].mean(
-        axis=0, dtype=np.float32)
-    if group_i % 10000 == 0:
-      logging.info("%d/%d", group_i, NUM_GROUPS)
-  return group_features
+  return aggregate_csr_features(
+      group_user_index, user_features, output_path=output_path, mode="mean",
+      num_workers=num_workers)
 
 
 def group_features_to_institution_features(
@@ -304,67 +1114,103 @@ def group_features_to_institution_features(
   # return institution_features
 
 
+def get_identical_pairs_from_neighbors(neighbor_indices, neighbor_distances):
+  """Returns the (user, neighbor) pairs of identical users, in user order."""
+  eps = 0.0
+  mask = ((neighbor_indices != np.arange(neighbor_indices.shape[0])[:, None]) &
+          (neighbor_distances <= eps))
+  rows, positions = np.nonzero(mask)
+  return rows, np.asarray(neighbor_indices[rows, positions])
+
+
+def get_identical_pairs_from_canonical_ids(canonical_ids):
+  """Returns all ordered pairs of distinct users sharing a canonical id.
+
+  Args:
+    canonical_ids: For every user, the id of the first user with an identical
+      feature vector, as written by `neighbor_builder.py`.
+
+  Returns:
+    Arrays of first and second users of the pairs, sorted by first user.
+  """
+  canonical_ids = np.asarray(canonical_ids)
+  is_duplicate = canonical_ids != np.arange(canonical_ids.shape[0])
+  # Canonical users are the first member of their class.
+  is_member = is_duplicate.copy()
+  is_member[canonical_ids[is_duplicate]] = True
+  members = np.flatnonzero(is_member)
+  del is_duplicate, is_member
+  # Group members by class, keeping them sorted within each class.
+  members = members[np.argsort(canonical_ids[members], kind="stable")]
+  _, class_starts, class_sizes = np.unique(
+      canonical_ids[members], return_index=True, return_counts=True)
+  member_class_sizes = np.repeat(class_sizes, class_sizes)
+  # Each member is paired with every member of its class, itself included.
+  first = np.repeat(members, member_class_sizes)
+  pair_starts = np.repeat(np.repeat(class_starts, class_sizes),
+                          member_class_sizes)
+  pair_offsets = (np.arange(first.shape[0]) -
+                  np.repeat(np.cumsum(member_class_sizes) - member_class_sizes,
+                            member_class_sizes))
+  second = members[pair_starts + pair_offsets]
+  not_self = first != second
+  first, second = first[not_self], second[not_self]
+  order = np.argsort(first, kind="stable")
+  return first[order], second[order]
+
+
 def generate_fused_user_adjacency_matrix(neighbor_indices, neighbor_distances,
-                                          user_user_csr):
-  """Generates fused adjacency matrix for identical nodes."""
+                                          user_user_csr, canonical_ids=None,
+                                          max_rows_per_chunk=1 << 22):
+  """Generates fused adjacency matrix for identical nodes.
+
+  For every identical pair, each user of the pair gets the edges of the other,
+  both outgoing and incoming. With `S` the symmetric matrix of identical pairs
+  and `A` the adjacency, the fused adjacency is the boolean `A + S·A + A·S`,
+  computed over chunks of rows.
+
+  Args:
+    neighbor_indices: Nearest neighbors of every user.
+    neighbor_distances: Distances to the nearest neighbors.
+    user_user_csr: User to user adjacency.
+    canonical_ids: If given, identical users are taken from these duplicate
+      classes instead, and the neighbors are ignored (and may be None).
+    max_rows_per_chunk: Number of rows of the fused adjacency computed at once.
+
+  Returns:
+    Fused user to user adjacency.
+  """
   # First construct set of identical node indices.
-  # NOTE: Since we take only top K=26 identical pairs for each node, this is not
-  # actually exhaustive. Also, if A and B are equal, and B and C are equal,
-  # this method would not necessarily detect A and C being equal.
-  # However, this should capture almost all cases.
+  # NOTE: When using neighbors, since we take only top K=26 identical pairs for
+  # each node, this is not actually exhaustive. Also, if A and B are equal, and
+  # B and C are equal, this method would not necessarily detect A and C being
+  # equal. However, this should capture almost all cases.
   logging.info("Generating fused user adjacency matrix")
-  eps = 0.0
-  mask = ((neighbor_indices != np.mgrid[:neighbor_indices.shape[0], :1]) &
-          (neighbor_distances <= eps))
-  identical_pairs = list(map(tuple, np.nonzero(mask)))
-  del mask
-
-  # Have a csc version for fast column access.
-  user_user_csc = user_user_csr.tocsc()
-
-  # Construct new matrix as coo, starting off with original rows/cols.
-  user_user_coo = user_user_csr.tocoo()
-  new_rows = [user_user_coo.row]
-  new_cols = [user_user_coo.col]
-
-  for pair in tqdm.tqdm(identical_pairs):
-    # STEP ONE: First merge users being cited by the pair.
-    # Add edges from second user, to all users cited by first user.
-    cited_by_first = user_user_csr.getrow(pair[0]).nonzero()[1]
-    if cited_by_first.shape[0] > 0:
-      new_rows.append(pair[1] * np.ones_like(cited_by_first))
-      new_cols.append(cited_by_first)
-
-    # Add edges from first user, to all users cited by second user.
-    cited_by_second = user_user_csr.getrow(pair[1]).nonzero()[1]
-    if cited_by_second.shape[0] > 0:
-      new_rows.append(pair[0] * np.ones_like(cited_by_second))
-      new_cols.append(cited_by_second)
-
-    # STEP TWO: Then merge users that cite the pair.
-    # Add edges to second user, from all users citing the first user.
-    citing_first = user_user_csc.getcol(pair[0]).nonzero()[0]
-    if citing_first.shape[0] > 0:
-      new_rows.append(citing_first)
-      new_cols.append(pair[1] * np.ones_like(citing_first))
-
-    # Add edges to first user, from all users citing the second user.
-    citing_second = user_user_csc.getcol(pair[1]).nonzero()[0]
-    if citing_second.shape[0] > 0:
-      new_rows.append(citing_second)
-      new_cols.append(pair[0] * np.ones_like(citing_second))
-
-  logging.info("Done with adjacency loop")
-  user_user_coo_shape = user_user_coo.shape
-  del user_user_csr
-  del user_user_csc
-  del user_user_coo
-  # All done; now concatenate everything together and form new matrix.
-  new_rows = np.concatenate(new_rows)
-  new_cols = np.concatenate(new_cols)
-  return sp.coo_matrix(
-      (np.ones_like(new_rows, dtype=bool), (new_rows, new_cols)),
-      shape=user_user_coo_shape).tocsr()
+  if canonical_ids is not None:
+    first, second = get_identical_pairs_from_canonical_ids(canonical_ids)
+  else:
+    first, second = get_identical_pairs_from_neighbors(
+        neighbor_indices, neighbor_distances)
+  num_users = user_user_csr.shape[0]
+  identical_pairs = sp.csr_matrix(
+      (np.ones(2 * first.shape[0], dtype=bool),
+       (np.concatenate([first, second]), np.concatenate([second, first]))),
+      shape=(num_users, num_users))
+  del first, second
+  logging.info("%d identical pairs", identical_pairs.nnz // 2)
+
+  user_user_csr = user_user_csr.astype(bool)
+  chunks = []
+  for start in range(0, user_user_csr.shape[0], max_rows_per_chunk):
+    end = min(start + max_rows_per_chunk, user_user_csr.shape[0])
+    user_user_chunk = user_user_csr[start:end]
+    # Boolean products and sums are logical ors.
+    chunk = (user_user_chunk + identical_pairs[start:end] @ user_user_csr +
+             user_user_chunk @ identical_pairs)
+    chunk.sum_duplicates()
+    chunks.append(chunk)
+    logging.info("Fused rows %d / %d", end, user_user_csr.shape[0])
+  return sp.vstack(chunks, format="csr")
 
 # данные -> train, valid k раз
 def generate_k_fold_splits(
@@ -401,35 +1247,153 @@ def get_train_and_valid_idx_for_split(
   return new_train_idx, new_valid_idx
 
 # (?)
+def _get_label_writes(train_nodes, neighbor_indices, neighbor_distances,
+                      canonical_ids, is_writable):
+  """Returns the label writes of the sequential fusion, and the key of nodes.
+
+  Training node `train_nodes[t]` writes its label at time `t` to all nodes
+  identical to it which are writable. Writes are keyed by target node, or by
+  duplicate class with `canonical_ids`, whose writable members all receive
+  the write.
+  """
+  if canonical_ids is not None:
+    return (np.arange(train_nodes.shape[0]),
+            np.asarray(canonical_ids[train_nodes], dtype=np.int64),
+            lambda nodes: np.asarray(canonical_ids[nodes], dtype=np.int64))
+  neighbors = np.asarray(neighbor_indices[train_nodes], dtype=np.int64)
+  is_write = np.asarray(neighbor_distances[train_nodes]) == 0
+  is_write &= is_writable[neighbors]
+  times, positions = np.nonzero(is_write)
+  return times, neighbors[times, positions], lambda nodes: nodes
+
+
 def generate_fused_node_labels(neighbor_indices, neighbor_distances,
                                node_labels, train_indices, valid_indices,
-                               test_indices):
-  """Generates fused adjacency matrix for identical nodes."""
+                               test_indices, canonical_ids=None,
+                               return_stats=False):
+  """Generates fused node labels for identical nodes.
+
+  Reproduces the sequential fusion: training nodes are visited in the order
+  of `train_indices`, and each assigns its current label to the nodes at
+  distance zero in its neighbor list, other than validation and test nodes.
+  Later assignments overwrite earlier ones, and a training node relabelled
+  by an earlier one passes on its new label. Neighbor lists need not be
+  symmetric nor transitive.
+
+  Args:
+    neighbor_indices: Nearest neighbors of every node.
+    neighbor_distances: Distances to the nearest neighbors.
+    node_labels: Labels of the nodes, updated in place.
+    train_indices: Training nodes.
+    valid_indices: Validation nodes.
+    test_indices: Test nodes.
+    canonical_ids: If given, the neighbors of a node are all the nodes of its
+      duplicate class instead, and the neighbors are ignored (and may be
+      None).
+    return_stats: Whether to also return fusion statistics.
+
+  Returns:
+    Fused node labels, and if `return_stats` a dict with the numbers of
+    `fused` nodes (assigned a label), `changed` nodes (with a different label
+    than before), `conflicting` nodes (assigned different labels over the
+    fusion) and `relabelled_train` nodes.
+  """
   logging.info("Generating fused node labels")
-  valid_indices = set(valid_indices.tolist())
-  test_indices = set(test_indices.tolist())
-  valid_or_test_indices = valid_indices | test_indices
-
-  train_indices = train_indices[train_indices < neighbor_indices.shape[0]]
-  # Go through list of all pairs where one node is in training set, and
-  for i in tqdm.tqdm(train_indices):
-    for j in range(neighbor_indices.shape[1]):
-      other_index = neighbor_indices[i][j]
-      # if the other is not a validation or test node,
-      if other_index in valid_or_test_indices:
-        continue
-      # and they are identical,
-      if neighbor_distances[i][j] == 0:
-        # assign the label of the training node to the other node
-        node_labels[other_index] = node_labels[i]
-
+  if canonical_ids is not None:
+    num_nodes = canonical_ids.shape[0]
+  else:
+    num_nodes = neighbor_indices.shape[0]
+  train_nodes = np.asarray(train_indices, dtype=np.int64)
+  train_nodes = train_nodes[train_nodes < num_nodes]
+  num_times = train_nodes.shape[0]
+  is_writable = np.ones(num_nodes, dtype=bool)
+  for indices in (valid_indices, test_indices):
+    is_writable[indices[indices < num_nodes]] = False
+
+  times, keys, get_keys = _get_label_writes(
+      train_nodes, neighbor_indices, neighbor_distances, canonical_ids,
+      is_writable)
+  # Writes sorted by key, then by time.
+  write_order = np.sort(keys * (num_times + 1) + times)
+  del times, keys
+  write_keys = write_order // (num_times + 1)
+  write_times = write_order - write_keys * (num_times + 1)
+
+  def get_last_writes(nodes, before_times):
+    """Returns the last write to `nodes` before `before_times`, or -1."""
+    node_keys = get_keys(nodes)
+    positions = np.searchsorted(
+        write_order, node_keys * (num_times + 1) + before_times) - 1
+    has_write = positions >= 0
+    has_write[has_write] = (
+        write_keys[positions[has_write]] == node_keys[has_write])
+    has_write &= is_writable[nodes]
+    return np.where(has_write, write_times[np.maximum(positions, 0)], -1)
+
+  # The label written at time `t` is the label of its training node, as last
+  # written before `t`. Follow these earlier writes to the original label.
+  sources = get_last_writes(train_nodes, np.arange(num_times))
+  sources = np.where(sources >= 0, sources, np.arange(num_times))
+  while True:
+    next_sources = sources[sources]
+    if np.array_equal(next_sources, sources):
+      break
+    sources = next_sources
+  written_labels = node_labels[train_nodes[sources]]
+
+  # Nodes get the label of the last write to them.
+  if canonical_ids is not None:
+    targets = np.flatnonzero(
+        np.isin(canonical_ids, write_keys) & is_writable)
+  else:
+    targets = np.unique(write_keys)
+  last_writes = get_last_writes(targets, num_times)
+  fused_labels = written_labels[last_writes]
+
+  stats = {"fused": targets.shape[0]}
+  if write_order.shape[0]:
+    key_starts = np.flatnonzero(
+        np.concatenate([[True], write_keys[1:] != write_keys[:-1]]))
+    labels = written_labels[write_times]
+    is_conflicting_key = (np.minimum.reduceat(labels, key_starts) !=
+                          np.maximum.reduceat(labels, key_starts))
+    target_keys = np.searchsorted(write_keys[key_starts], get_keys(targets))
+    stats["conflicting"] = int(np.count_nonzero(
+        is_conflicting_key[target_keys]))
+  else:
+    stats["conflicting"] = 0
+  previous_labels = node_labels[targets]
+  is_changed = previous_labels != fused_labels
+  if np.issubdtype(node_labels.dtype, np.floating):
+    is_changed &= ~(np.isnan(previous_labels) & np.isnan(fused_labels))
+  stats["changed"] = int(np.count_nonzero(is_changed))
+  is_train = np.zeros(num_nodes, dtype=bool)
+  is_train[train_nodes] = True
+  stats["relabelled_train"] = int(np.count_nonzero(
+      is_changed & is_train[targets]))
+  logging.info("Fused labels: %s", stats)
+
+  node_labels[targets] = fused_labels
+  if return_stats:
+    return node_labels, stats
   return node_labels
 
 
 def _pad_to_shape(
     sparse_csr_matrix: sp.csr_matrix,
-    output_shape: Tuple[int, int]) -> sp.csr_matrix:
-  """Pads a csr sparse matrix to the given shape."""
+    output_shape: Tuple[int, int]) -> CsrArrays:
+  """Pads a csr sparse matrix to the given shape.
+
+  Padding is lazy: the returned `CsrArrays` shares the arrays of the input and
+  only reports the padded shape. Rows past the end of `indptr` are empty.
+
+  Args:
+    sparse_csr_matrix: A `scipy.sparse.csr_matrix` or `CsrArrays`.
+    output_shape: Shape to pad to.
+
+  Returns:
+    The input when it already has `output_shape`, a `CsrArrays` otherwise.
+  """
 
   # We should not try to expand anything smaller.
   print('output_shape', output_shape)
@@ -440,27 +1404,41 @@ def _pad_to_shape(
   if sparse_csr_matrix.shape == output_shape:
     return sparse_csr_matrix
 
-  # Append as many indptr elements as we need to match the leading size,
-  # This is achieved by just padding with copies of the last indptr element.
-  required_padding = output_shape[0] - sparse_csr_matrix.shape[0]
-  updated_indptr = np.concatenate(
-      [sparse_csr_matrix.indptr] +
-      [sparse_csr_matrix.indptr[-1:]] * required_padding,
-      axis=0)
-
-  # The change in trailing size does not have structural implications, it just
-  # determines the highest possible value for the indices, so it is sufficient
-  # to just pass the new output shape, with the correct trailing size.
-  return sp.csr.csr_matrix(
-      (sparse_csr_matrix.data,
-       sparse_csr_matrix.indices,
-       updated_indptr),
-      shape=output_shape)
+  # Rows past the end of `indptr` are treated as empty, and the change in
+  # trailing size does not have structural implications, it just determines
+  # the highest possible value for the indices, so it is sufficient to just
+  # pass the new output shape.
+  if isinstance(sparse_csr_matrix, CsrArrays):
+    return sparse_csr_matrix._replace(shape=output_shape)
+  return CsrArrays(
+      indptr=sparse_csr_matrix.indptr,
+      indices=sparse_csr_matrix.indices,
+      data=sparse_csr_matrix.data,
+      shape=output_shape,
+      canonical=_is_canonical(sparse_csr_matrix))
+
+
+def _compact_adjacencies(
+    arrays: Dict[str, sp.csr.csr_matrix],
+    ) -> Dict[str, CsrArrays]:
+  """Converts the adjacency matrices to compact dtypes."""
+  arrays = arrays.copy()
+  for key in [
+              "group_institution_index",
+              "institution_group_index",
+              "group_user_index",
+              "user_group_index",
+              "user_user_index",
+              "user_user_index_t",
+              ]:
+    if key in arrays:
+      arrays[key] = compact_csr(arrays[key])
+  return arrays
 
 
 def _fix_adjacency_shapes(
     arrays: Dict[str, sp.csr.csr_matrix],
-    ) -> Dict[str, sp.csr.csr_matrix]:
+    ) -> Dict[str, CsrArrays]:
   """Fixes the shapes of the adjacency matrices."""
   arrays = arrays.copy()
   for key in [
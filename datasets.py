@@ -1,7 +1,10 @@
 """MAG240M-LSC datasets."""
 
+import collections
+import concurrent.futures
 import threading
-from typing import NamedTuple, Optional
+from typing import (Callable, Iterable, Iterator, NamedTuple, Optional, Tuple,
+                    TypeVar, Union)
 
 
 import jax
@@ -15,14 +18,22 @@ import tensorflow_datasets as tfds
 # pytype: disable=import-error
 import batching_utils
 import data_utils
+import feature_store
+import pipeline_metrics
 
 
 # We only want to load these arrays once for all threads.
 # `get_arrays` uses an LRU cache which is not thread safe.
 LOADING_RAW_ARRAYS_LOCK = threading.Lock()
 
+# Feature stores shared by the iterators over the same features.
+_FEATURE_STORES = {}
+
 NUM_CLASSES = data_utils.NUM_CLASSES
 
+_T = TypeVar('_T')
+_U = TypeVar('_U')
+
 
 _MAX_DEPTH_IN_SUBGRAPH = 3
 
@@ -48,8 +59,49 @@ def build_dataset_iterator(
     ratio_unlabeled_data_to_labeled_data: float = 0.0,
     use_all_labels_when_not_training: bool = False,
     use_dummy_adjacencies: bool = False,
+    use_mmap_adjacencies: bool = False,
+    compact_adjacencies: bool = False,
+    sampler_batch_size: Optional[int] = None,
+    num_sampling_workers: int = 0,
+    ordered_sampling: bool = True,
+    num_sampling_shards: int = 1,
+    sampling_seed: Optional[int] = None,
+    num_postprocessing_workers: int = 0,
+    postprocessing_queue_size: int = 8,
+    feature_cache_num_hot_nodes: int = 0,
+    feature_cache_lru_size: int = 0,
+    packing_lookahead: int = 0,
+    profile_report_path: Optional[str] = None,
+    array_dict: Optional[dict] = None,  # pylint: disable=g-bare-generic
 ):
-  """Returns an iterator over Batches from the dataset."""
+  """Returns an iterator over Batches from the dataset.
+
+  With `num_postprocessing_workers > 0`, batches are post-processed (label
+  features, one-hot encodings and embedding gathers) by that many threads,
+  at most `postprocessing_queue_size` batches ahead of the consumer.
+
+  Roots and subgraphs are sampled from `sampling_seed`, drawn if not set, see
+  `data_utils.get_graph_subsampling_dataset`.
+
+  With `feature_cache_num_hot_nodes` or `feature_cache_lru_size`, node
+  features are gathered through a `feature_store.FeatureStore` pinning the
+  features of that many nodes of highest degree, with an LRU cache of that
+  many other rows.
+
+  With `packing_lookahead > 0`, that many subgraphs are buffered to complete
+  batches with the ones which fit. With `num_padding_buckets` in
+  `dynamic_batch_size_config`, batches are padded to the smallest of that many
+  sizes which fits them, see `batching_utils.dynamically_batch`, and batches
+  for the local devices are grouped by padding size.
+
+  `array_dict` are the arrays of `data_utils.get_arrays`, loaded from
+  `data_root` if not given.
+
+  Throughput of the input stages is recorded with `pipeline_metrics`, with
+  the time spent in sampling, labelling, post-processing and feature gathers,
+  and logged periodically, as well as written as a JSON report to
+  `profile_report_path` if set.
+  """
 
   if split == 'test':
     use_all_labels_when_not_training = True
@@ -58,10 +110,20 @@ def build_dataset_iterator(
     ratio_unlabeled_data_to_labeled_data = 0.0
 
   # Load the master data arrays.
-  with LOADING_RAW_ARRAYS_LOCK:
-    array_dict = data_utils.get_arrays(
-        data_root, k_fold_split_id=k_fold_split_id,
-        use_dummy_adjacencies=use_dummy_adjacencies)
+  if array_dict is None:
+    with LOADING_RAW_ARRAYS_LOCK:
+      array_dict = data_utils.get_arrays(
+          data_root, k_fold_split_id=k_fold_split_id,
+          use_dummy_adjacencies=use_dummy_adjacencies,
+          use_mmap_adjacencies=use_mmap_adjacencies,
+          compact_adjacencies=compact_adjacencies)
+
+  if feature_cache_num_hot_nodes or feature_cache_lru_size:
+    with LOADING_RAW_ARRAYS_LOCK:
+      embeddings = _get_feature_store(
+          array_dict, feature_cache_num_hot_nodes, feature_cache_lru_size)
+  else:
+    embeddings = array_dict['bert_pca_129']
 
   node_labels = array_dict['user_label'].reshape(-1)
   train_indices = array_dict['train_indices'].astype(np.int32)
@@ -126,6 +188,11 @@ def build_dataset_iterator(
       ratio_unlabeled_data_to_labeled_data=ratio_unlabeled_data_to_labeled_data,
       max_nodes=dynamic_batch_size_config.n_node - 1,  # Keep space for pads.
       max_edges=dynamic_batch_size_config.n_edge,
+      sampler_batch_size=sampler_batch_size,
+      num_sampling_workers=num_sampling_workers,
+      ordered_sampling=ordered_sampling,
+      num_sampling_shards=num_sampling_shards,
+      seed=sampling_seed,
       **online_subsampling_kwargs)
   if debug:
     ds = ds.take(50)
@@ -135,14 +202,16 @@ def build_dataset_iterator(
 
   if is_training:
     ds = ds.shard(jax.process_count(), jax.process_index())
-    ds = ds.shuffle(buffer_size=1 if debug else 128)
+    ds = ds.shuffle(buffer_size=1 if debug else 128, seed=sampling_seed)
     ds = ds.repeat()
   ds = ds.prefetch(1 if debug else tf.data.experimental.AUTOTUNE)
-  np_ds = iter(tfds.as_numpy(ds))
+  np_ds = pipeline_metrics.count_elements(tfds.as_numpy(ds), 'tf_data')
   batched_np_ds = batching_utils.dynamically_batch(
       np_ds,
+      packing_lookahead=packing_lookahead,
       **dynamic_batch_size_config,
   )
+  batched_np_ds = pipeline_metrics.count_elements(batched_np_ds, 'batching')
 
   def intermediate_graph_to_batch(graph):
     central_node_mask = graph.nodes['is_central_node']
@@ -212,21 +281,130 @@ def build_dataset_iterator(
     batch = _add_one_hot_features_to_batch(batch)
 
     # Gather PCA features.
-    return _add_embeddings_to_batch(batch, array_dict['bert_pca_129'])
-
-  batch_list = []
-  for batch in batched_np_ds:
-    with jax.profiler.StepTraceAnnotation('batch_postprocessing'):
-      batch = intermediate_graph_to_batch(batch)
+    with pipeline_metrics.timer('feature_gather_time'):
+      return _add_embeddings_to_batch(batch, embeddings)
+
+  if num_postprocessing_workers > 0:
+    def postprocess(batch):
+      with jax.profiler.TraceAnnotation('batch_postprocessing'), (
+          pipeline_metrics.timer('postprocessing_time')):
+        return intermediate_graph_to_batch(batch)
+    batches = _map_with_worker_pool(
+        postprocess, batched_np_ds, num_postprocessing_workers,
+        postprocessing_queue_size, 'postprocessing_queue')
+  else:
+    def serial_postprocess():
+      for batch in batched_np_ds:
+        with jax.profiler.StepTraceAnnotation('batch_postprocessing'), (
+            pipeline_metrics.timer('postprocessing_time')):
+          batch = intermediate_graph_to_batch(batch)
+        yield batch
+    batches = serial_postprocess()
+
+  # Batches stacked for the devices need the same padding size.
+  batch_lists = collections.defaultdict(list)
+  for batch in batches:
+    pipeline_metrics.get_stage('postprocessing').record()
+    pipeline_metrics.maybe_log_stats(report_path=profile_report_path)
     if is_training:
+      batch_list = batch_lists[get_padding_size(batch)]
       batch_list.append(batch)
       if len(batch_list) == jax.local_device_count():
         yield jax.device_put_sharded(batch_list, jax.local_devices())
-        batch_list = []
+        batch_list.clear()
     else:
       yield batch
 
 
+def get_padding_size(batch: Batch) -> Tuple[int, int]:
+  """Returns the numbers of nodes and edges `batch` is padded to."""
+  return batch.node_indices.shape[-1], batch.graph.senders.shape[-1]
+
+
+def get_dummy_batch(batch: Batch, n_node: int, n_edge: int) -> Batch:
+  """Returns a batch of zeros like `batch`, padded to `n_node` and `n_edge`.
+
+  Used to compile functions of batches for every padding size. `batch` may
+  have a leading device axis.
+  """
+  axis = batch.graph.n_node.ndim - 1
+
+  def zeros(size):
+    return lambda x: np.zeros(  # pylint: disable=g-long-lambda
+        x.shape[:axis] + (size,) + x.shape[axis + 1:], dtype=x.dtype)
+
+  # All nodes and edges are in the padding graph.
+  n_node_array = np.zeros(batch.graph.n_node.shape,
+                          dtype=batch.graph.n_node.dtype)
+  n_node_array[..., 0] = n_node
+  n_edge_array = np.zeros(batch.graph.n_edge.shape,
+                          dtype=batch.graph.n_edge.dtype)
+  n_edge_array[..., 0] = n_edge
+  graph = batch.graph._replace(
+      n_node=n_node_array,
+      n_edge=n_edge_array,
+      nodes=jax.tree_map(zeros(n_node), batch.graph.nodes),
+      edges=jax.tree_map(zeros(n_edge), batch.graph.edges),
+      senders=zeros(n_edge)(batch.graph.senders),
+      receivers=zeros(n_edge)(batch.graph.receivers))
+  return Batch(graph=graph, **{
+      field: zeros(n_node)(getattr(batch, field))
+      for field in Batch._fields if field != 'graph'})
+
+
+def _get_feature_store(array_dict, num_hot_nodes, lru_size):
+  """Returns a feature store over the PCA features, built once."""
+  key = (id(array_dict['bert_pca_129']), num_hot_nodes, lru_size)
+  if key not in _FEATURE_STORES:
+    store = feature_store.FeatureStore.from_degrees(
+        array_dict['bert_pca_129'],
+        feature_store.get_node_degrees(array_dict),
+        num_hot_nodes=num_hot_nodes,
+        lru_size=lru_size)
+    pipeline_metrics.register_stats_fn('feature_cache', store.get_stats)
+    _FEATURE_STORES[key] = store
+  return _FEATURE_STORES[key]
+
+
+def _map_with_worker_pool(
+    fn: Callable[[_T], _U],
+    iterable: Iterable[_T],
+    num_workers: int,
+    max_pending: int,
+    queue_name: str,
+) -> Iterator[_U]:
+  """Applies `fn` in worker threads, yielding results in order.
+
+  At most `max_pending` elements are processed ahead of the consumer. Every
+  time a result is read, the number of ready results is recorded as the depth
+  of queue `queue_name` in `pipeline_metrics`.
+
+  Args:
+    fn: Function to apply.
+    iterable: Input elements.
+    num_workers: Number of worker threads.
+    max_pending: Maximum number of elements processed or waiting to be read.
+    queue_name: Name of the queue in `pipeline_metrics`.
+
+  Yields:
+    `fn` of every element, in order.
+  """
+  queue_metrics = pipeline_metrics.get_queue(queue_name, max_pending)
+
+  def next_result(pending):
+    queue_metrics.record(sum(future.done() for future in pending))
+    return pending.popleft().result()
+
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    pending = collections.deque()
+    for element in iterable:
+      pending.append(executor.submit(fn, element))
+      if len(pending) >= max_pending:
+        yield next_result(pending)
+    while pending:
+      yield next_result(pending)
+
+
 def _get_bitstring_year_representation(year: np.ndarray):
   """Return year as bitstring."""
   min_year = 1900
@@ -276,7 +454,9 @@ def _add_one_hot_features_to_batch(batch: Batch) -> Batch:
   return batch._replace(graph=batch.graph._replace(nodes=nodes))
 
 
-def _add_embeddings_to_batch(batch: Batch, embeddings: np.ndarray) -> Batch:
+def _add_embeddings_to_batch(
+    batch: Batch, embeddings: Union[np.ndarray, feature_store.FeatureStore],
+) -> Batch:
   nodes = batch.graph.nodes.copy()
   nodes['features'] = embeddings[batch.absolute_node_indices]
   graph = batch.graph._replace(nodes=nodes)
@@ -183,6 +183,26 @@ def save_test_submission_file(test_predictions, output_dir):
   logging.info('Test submission file generated at %s', output_dir)
 
 
+def save_raw_id_predictions(predictions, data_root, output_path):
+  """Saves the predictions with the VK ids of the nodes, if they are known."""
+  user_ids_path = os.path.join(data_root, data_utils.RAW_USER_IDS_FILENAME)
+  if not os.path.exists(user_ids_path):
+    return
+  # Only written once the node inputs are remapped to the same dense ids.
+  user_index = data_utils.load_id_index(user_ids_path)
+  node_indices = predictions.node_indices.astype(np.int64)
+  if node_indices.size and (node_indices.min() < 0 or
+                            node_indices.max() >= user_index.size):
+    raise ValueError(
+        f'Node indices are not dense ids of the {user_index.size} users of '
+        f'{user_ids_path}.')
+  np.savez(
+      output_path,
+      raw_ids=user_index.to_raw(node_indices),
+      predictions=predictions.predictions)
+  logging.info('Predictions with VK ids stored at %s', output_path)
+
+
 def main(argv):
   del argv
 
@@ -207,6 +227,9 @@ def main(argv):
     dill.dump(ensembled_predictions, f)
   logging.info(
       '%s predictions stored at %s', split, ensembled_predictions_path)
+  save_raw_id_predictions(
+      ensembled_predictions, _DATA_ROOT.value,
+      os.path.join(output_dir, f'{split}_raw_ids.npz'))
 
 
 if __name__ == '__main__':
@@ -91,6 +91,7 @@ import functools
 import os
 import signal
 import threading
+import time
 from typing import Tuple
 
 from absl import app
@@ -112,14 +113,20 @@ import optax
 import tensorflow.compat.v2 as tf
 
 # pylint: disable=g-bad-import-order
+import batching_utils
 import datasets
 import losses
 import models
+import pipeline_metrics
 import schedules
 
 
 FLAGS = flags.FLAGS
 
+# Minimum time between computations of the input pipeline scalars, the
+# `log_tensors_interval` of `config.py`.
+_INPUT_SCALARS_INTERVAL_SECS = 10.
+
 
 class Experiment(experiment.AbstractExperiment):
   """MAG240M-LSC Jaxline experiment."""
@@ -163,6 +170,8 @@ class Experiment(experiment.AbstractExperiment):
     # Track what has started.
     self._training = False
     self._evaluating = False
+    self._compiled_eval_forward = False
+    self._last_step_start_time = None
 
   def _train_init(self):
     iterator = self._build_numpy_dataset_iterator('train', is_training=True)
@@ -176,8 +185,35 @@ class Experiment(experiment.AbstractExperiment):
         axis_name='i',
         donate_argnums=3,
     )
+    self._compile_update_func(dummy_batch)
+    pipeline_metrics.register_stats_fn('training_loop',
+                                       self._get_input_bound_stats)
     self._training = True
 
+  def _compile_update_func(self, dummy_batch: datasets.Batch):
+    """Compiles the update for every padding size of the training batches."""
+    padding_buckets = self._get_padding_buckets(is_training=True)
+    if len(padding_buckets) < 2:
+      return
+    global_step = utils.bcast_local_devices(jnp.zeros([], jnp.int32))
+    rng = utils.bcast_local_devices(jax.random.PRNGKey(0))
+    # Copies the state on the devices, without going through the host.
+    copy_state = jax.pmap(lambda state: jax.tree_map(jnp.copy, state))
+    for n_node, n_edge in padding_buckets:
+      logging.info('Compiling update for batches of %d nodes and %d edges.',
+                   n_node, n_edge)
+      # Outputs are discarded, and the donated state is a copy.
+      self._update_func(
+          self._params,
+          self._ema_params,
+          self._network_state,
+          copy_state(self._ema_network_state),
+          self._opt_state,
+          global_step,
+          rng,
+          datasets.get_dummy_batch(dummy_batch, n_node, n_edge),
+      )
+
   def _eval_init(self):
 
     split = self.config.eval.split
@@ -206,8 +242,10 @@ class Experiment(experiment.AbstractExperiment):
     if not self._training:
       self._train_init()
 
+    step_start_time = time.time()
     with jax.profiler.StepTraceAnnotation('next_train_input'):
       batch = next(self._train_input)
+    self._record_input_wait(step_start_time, time.time() - step_start_time)
 
     with jax.profiler.StepTraceAnnotation('update_step'):
       (self._params, self._ema_params, self._network_state,
@@ -225,16 +263,54 @@ class Experiment(experiment.AbstractExperiment):
 
     with jax.profiler.StepTraceAnnotation('get_stats'):
       stats = utils.get_first(stats)
+      stats.update(pipeline_metrics.maybe_get_scalars(
+          interval_secs=_INPUT_SCALARS_INTERVAL_SECS))
     return stats
 
+  def _record_input_wait(self, step_start_time: float, wait_time: float):
+    """Records how long the step waited for its batch, and the step time.
+
+    Steps are dispatched asynchronously, so the time between step starts is
+    the time of the slowest of the input pipeline and the device.
+    """
+    pipeline_metrics.get_distribution('consumer_wait_time').record(wait_time)
+    if self._last_step_start_time is not None:
+      pipeline_metrics.get_distribution('step_time').record(
+          step_start_time - self._last_step_start_time)
+    self._last_step_start_time = step_start_time
+
+  def _get_input_bound_stats(self):
+    """Returns the fraction of the step time spent waiting for batches."""
+    wait_stats = pipeline_metrics.get_distribution(
+        'consumer_wait_time').get_stats()
+    step_stats = pipeline_metrics.get_distribution('step_time').get_stats()
+    return dict(input_wait_fraction=(
+        wait_stats['total'] / step_stats['total']
+        if step_stats['total'] > 0 else 0.))
+
+  def _get_dynamic_batch_size_config(self, is_training: bool):
+    if not is_training:
+      return self.config.eval.dynamic_batch_size_config
+    batch_size_config = self.config.training.dynamic_batch_size_config
+    if (jax.process_count() > 1 and
+        batch_size_config.get('num_padding_buckets', 1) > 1):
+      # Hosts batch their own shards, so they could enter the pmapped update
+      # with batches of different padding sizes at the same step.
+      logging.warning('Padding training batches to a single size, since %d '
+                      'processes share the update.', jax.process_count())
+      batch_size_config = batch_size_config.copy_and_resolve_references()
+      batch_size_config.num_padding_buckets = 1
+    return batch_size_config
+
+  def _get_padding_buckets(self, is_training: bool):
+    return batching_utils.get_padding_buckets(
+        **self._get_dynamic_batch_size_config(is_training))
+
   def _build_numpy_dataset_iterator(self, split: str, is_training: bool):
-    if is_training:
-      dynamic_batch_size_config = self.config.training.dynamic_batch_size_config
-    else:
-      dynamic_batch_size_config = self.config.eval.dynamic_batch_size_config
     return datasets.build_dataset_iterator(
         split=split,
-        dynamic_batch_size_config=dynamic_batch_size_config,
+        dynamic_batch_size_config=self._get_dynamic_batch_size_config(
+            is_training),
         debug=self.config.debug,
         is_training=is_training,
         **self.config.dataset_kwargs)
@@ -555,6 +631,8 @@ class Experiment(experiment.AbstractExperiment):
     logits_list = []
     indices_list = []
     for i, batch in enumerate(self._make_eval_dataset_iterator()):
+      if not self._compiled_eval_forward:
+        self._compile_eval_forward(params, state, rng, batch)
       model_output, _ = self.eval_forward(
           params,
           state,
@@ -590,6 +668,24 @@ class Experiment(experiment.AbstractExperiment):
 
     return results, predictions
 
+  def _compile_eval_forward(
+      self,
+      params: hk.Params,
+      state: hk.State,
+      rng: jnp.ndarray,
+      dummy_batch: datasets.Batch,
+  ):
+    """Compiles the forward for every padding size of the eval batches."""
+    padding_buckets = self._get_padding_buckets(is_training=False)
+    if len(padding_buckets) > 1:
+      for n_node, n_edge in padding_buckets:
+        logging.info('Compiling eval forward for batches of %d nodes and %d '
+                     'edges.', n_node, n_edge)
+        self.eval_forward(
+            params, state, rng,
+            datasets.get_dummy_batch(dummy_batch, n_node, n_edge).graph)
+    self._compiled_eval_forward = True
+
   def _log_results(self, prefix, results):
     logging_str = ', '.join(
         ['{}={:.4f}'.format(k, float(results[k]))
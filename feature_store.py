@@ -0,0 +1,335 @@
+"""Cached access to node features memory-mapped from disk."""
+
+import threading
+from typing import Dict
+
+from absl import logging
+import numpy as np
+
+# pylint: disable=g-bad-import-order
+import data_utils
+
+# Adjacencies whose rows count towards the degree of users and groups.
+_DEGREE_ADJACENCIES = {
+    'user': ('user_group_index', 'user_user_index', 'user_user_index_t'),
+    'group': ('group_user_index',),
+}
+
+
+# Rows of the degree computations processed at once, bounding temporaries.
+_DEGREE_BLOCK_SIZE = 1 << 24
+# Bins of the degree histogram selecting the nodes of highest degree.
+_MAX_DEGREE_BINS = 1 << 20
+
+
+def _add_row_degrees(csr, degrees):
+  """Adds the number of entries of every row to `degrees`, block by block."""
+  indptr = csr.indptr
+  num_stored_rows = min(indptr.shape[0] - 1, degrees.shape[0])
+  for start in range(0, num_stored_rows, _DEGREE_BLOCK_SIZE):
+    end = min(start + _DEGREE_BLOCK_SIZE, num_stored_rows)
+    degrees[start:end] += np.diff(np.asarray(indptr[start:end + 1])).astype(
+        degrees.dtype)
+
+
+def get_node_degrees(arrays) -> np.ndarray:
+  """Returns the int32 degrees of all nodes, indexed by absolute node index.
+
+  Args:
+    arrays: Arrays returned by `data_utils.get_arrays`.
+
+  Returns:
+    Degrees of users followed by groups, as laid out in `data_utils.OFFSETS`.
+  """
+  degrees = np.zeros(data_utils.NUM_NODES, dtype=np.int32)
+  for node_type, keys in _DEGREE_ADJACENCIES.items():
+    offset = data_utils.OFFSETS[node_type]
+    size = data_utils.SIZES[node_type]
+    for key in keys:
+      if key in arrays:
+        _add_row_degrees(arrays[key], degrees[offset:offset + size])
+  return degrees
+
+
+def get_top_indices(degrees, num_indices) -> np.ndarray:
+  """Returns the sorted indices of the `num_indices` highest degrees.
+
+  Selects them from a histogram of the degrees, block by block, instead of
+  partitioning a negated copy of `degrees` and an index array of its size.
+  Degrees past the histogram are few, and sorted. Ties at the lowest selected
+  degree are broken by index.
+  """
+  num_indices = min(num_indices, degrees.shape[0])
+  if not num_indices:
+    return np.zeros(0, dtype=np.int64)
+  counts = np.zeros(_MAX_DEGREE_BINS + 1, dtype=np.int64)
+  high_degrees = []
+  for start in range(0, degrees.shape[0], _DEGREE_BLOCK_SIZE):
+    block = degrees[start:start + _DEGREE_BLOCK_SIZE]
+    counts += np.bincount(np.minimum(block, _MAX_DEGREE_BINS),
+                          minlength=counts.shape[0])
+    high_degrees.append(block[block >= _MAX_DEGREE_BINS])
+  # Number of degrees at or above every degree of the histogram.
+  num_at_least = np.cumsum(counts[::-1])[::-1]
+  if num_at_least[-1] >= num_indices:
+    high_degrees = np.sort(np.concatenate(high_degrees))
+    threshold = high_degrees[high_degrees.shape[0] - num_indices]
+    num_above = np.count_nonzero(high_degrees > threshold)
+  else:
+    threshold = np.flatnonzero(num_at_least >= num_indices)[-1]
+    num_above = num_at_least[threshold + 1]
+  num_ties = num_indices - num_above
+  indices = []
+  for start in range(0, degrees.shape[0], _DEGREE_BLOCK_SIZE):
+    block = degrees[start:start + _DEGREE_BLOCK_SIZE]
+    indices.append(start + np.flatnonzero(block > threshold))
+    if num_ties:
+      ties = start + np.flatnonzero(block == threshold)[:num_ties]
+      num_ties -= ties.shape[0]
+      indices.append(ties)
+  return np.sort(np.concatenate(indices))
+
+
+class _NodeSlotTable:
+  """Maps node indices to cache slots, sized to the cache, not to the nodes.
+
+  An open addressing hash table with linear probing, whose lookups and updates
+  are vectorized over arrays of nodes. It has at least twice as many buckets
+  as slots. Removed nodes leave tombstones, skipped by lookups and reused by
+  inserts, and the table is rebuilt once they fill a quarter of it. Not
+  thread safe.
+  """
+
+  _EMPTY = -1
+  _REMOVED = -2
+
+  def __init__(self, num_slots):
+    self._num_bits = max(1, (2 * num_slots - 1).bit_length())
+    self._mask = (1 << self._num_bits) - 1
+    self._nodes = np.full(1 << self._num_bits, self._EMPTY, dtype=np.int64)
+    self._slots = np.zeros(1 << self._num_bits, dtype=np.int32)
+    self._num_removed = 0
+
+  def _hash(self, nodes):
+    # Fibonacci hashing, keeping the high bits of the product.
+    with np.errstate(over='ignore'):
+      hashes = nodes.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return (hashes >> np.uint64(64 - self._num_bits)).astype(np.int64)
+
+  def _find(self, nodes):
+    """Returns the buckets of `nodes`, -1 for nodes not in the table."""
+    buckets = np.full(nodes.shape[0], -1, dtype=np.int64)
+    pending = np.arange(nodes.shape[0])
+    probes = self._hash(nodes)
+    while pending.shape[0]:
+      probed_nodes = self._nodes[probes]
+      is_found = probed_nodes == nodes[pending]
+      buckets[pending[is_found]] = probes[is_found]
+      is_pending = ~is_found & (probed_nodes != self._EMPTY)
+      pending = pending[is_pending]
+      probes = (probes[is_pending] + 1) & self._mask
+    return buckets
+
+  def get(self, nodes) -> np.ndarray:
+    """Returns the slots of `nodes`, -1 for nodes not in the table."""
+    buckets = self._find(nodes)
+    return np.where(buckets >= 0, self._slots[buckets], -1)
+
+  def remove(self, nodes):
+    buckets = self._find(nodes)
+    buckets = buckets[buckets >= 0]
+    self._nodes[buckets] = self._REMOVED
+    self._num_removed += buckets.shape[0]
+
+  def insert(self, nodes, slots):
+    """Inserts distinct `nodes` which are not in the table."""
+    if self._num_removed > self._nodes.shape[0] // 4:
+      self._rebuild()
+    pending = np.arange(nodes.shape[0])
+    probes = self._hash(nodes)
+    while pending.shape[0]:
+      is_free = self._nodes[probes] < 0
+      # Only the first of the nodes probing the same free bucket takes it.
+      _, first = np.unique(probes[is_free], return_index=True)
+      takes = np.flatnonzero(is_free)[first]
+      taken = probes[takes]
+      self._num_removed -= int(np.count_nonzero(
+          self._nodes[taken] == self._REMOVED))
+      self._nodes[taken] = nodes[pending[takes]]
+      self._slots[taken] = slots[pending[takes]]
+      is_pending = np.ones(pending.shape[0], dtype=bool)
+      is_pending[takes] = False
+      pending = pending[is_pending]
+      probes = (probes[is_pending] + 1) & self._mask
+
+  def _rebuild(self):
+    is_used = self._nodes >= 0
+    nodes = self._nodes[is_used]
+    slots = self._slots[is_used]
+    self._nodes[:] = self._EMPTY
+    self._num_removed = 0
+    self.insert(nodes, slots)
+
+
+class FeatureStore:
+  """Gathers feature rows through an in-memory cache.
+
+  Rows of the `num_hot_nodes` nodes with the highest degree are pinned in
+  memory, since sampled subgraphs are skewed towards them. Other rows go
+  through a cache of `lru_size` rows, evicted with the clock (second chance)
+  approximation of LRU. Its slots are looked up through a hash table of the
+  cached nodes, so that lookups and evictions are array operations, and
+  memory only depends on `lru_size`. Both are thread safe, and reading missed
+  rows from `features` does not hold the lock.
+  """
+
+  def __init__(self, features, hot_node_indices, lru_size=0):
+    self._features = features
+    self._hot_node_indices = np.sort(hot_node_indices)
+    logging.info('Pinning features of %d nodes',
+                 self._hot_node_indices.shape[0])
+    self._hot_features = np.asarray(features[self._hot_node_indices])
+    self._lru_size = lru_size
+    self._lru_features = np.empty((lru_size,) + features.shape[1:],
+                                  dtype=features.dtype)
+    # Slots of the nodes in `_lru_features`, and node of every slot.
+    self._node_slots = _NodeSlotTable(lru_size)
+    self._slot_nodes = np.full(lru_size, -1, dtype=np.int64)
+    # Whether slots were read since the clock hand last passed them.
+    self._is_referenced = np.zeros(lru_size, dtype=bool)
+    self._num_used_slots = 0
+    self._clock_hand = 0
+    self._lock = threading.Lock()
+    self._num_hot_hits = 0
+    self._num_lru_hits = 0
+    self._num_misses = 0
+
+  @classmethod
+  def from_degrees(cls, features, degrees, num_hot_nodes, lru_size=0):
+    """Pins the `num_hot_nodes` nodes with the highest `degrees`."""
+    return cls(features, get_top_indices(degrees, num_hot_nodes),
+               lru_size=lru_size)
+
+  @property
+  def shape(self):
+    return self._features.shape
+
+  @property
+  def dtype(self):
+    return self._features.dtype
+
+  def __getitem__(self, indices):
+    return self.gather(indices)
+
+  def gather(self, indices) -> np.ndarray:
+    """Returns the feature rows of `indices`, an integer array."""
+    indices = np.asarray(indices)
+    flat_indices = indices.reshape(-1)
+    output = np.empty((flat_indices.shape[0],) + self._features.shape[1:],
+                      dtype=self._features.dtype)
+    if self._hot_node_indices.shape[0]:
+      hot_positions = np.minimum(
+          np.searchsorted(self._hot_node_indices, flat_indices),
+          self._hot_node_indices.shape[0] - 1)
+      is_hot = self._hot_node_indices[hot_positions] == flat_indices
+      output[is_hot] = self._hot_features[hot_positions[is_hot]]
+    else:
+      is_hot = np.zeros(flat_indices.shape[0], dtype=bool)
+    output[~is_hot] = self._gather_cold(flat_indices[~is_hot])
+    with self._lock:
+      self._num_hot_hits += int(np.count_nonzero(is_hot))
+    return output.reshape(indices.shape + self._features.shape[1:])
+
+  def _gather_cold(self, indices):
+    """Gathers rows of nodes which are not pinned, through the LRU cache."""
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+    if unique_indices.shape[0] > self._lru_size:
+      # Would evict rows of this same gather.
+      with self._lock:
+        self._num_misses += indices.shape[0]
+      return self._features[indices]
+
+    rows = np.empty((unique_indices.shape[0],) + self._features.shape[1:],
+                    dtype=self._features.dtype)
+    with self._lock:
+      slots = self._node_slots.get(unique_indices)
+      is_hit = slots >= 0
+      hit_slots = slots[is_hit]
+      rows[is_hit] = self._lru_features[hit_slots]
+      self._is_referenced[hit_slots] = True
+      self._num_lru_hits += int(np.count_nonzero(is_hit[inverse]))
+      self._num_misses += int(np.count_nonzero(~is_hit[inverse]))
+
+    # Indices are sorted, which helps reading from memory-mapped features.
+    missed_indices = unique_indices[~is_hit]
+    missed_rows = np.asarray(self._features[missed_indices])
+    rows[~is_hit] = missed_rows
+
+    with self._lock:
+      # Some may have been inserted by another gather meanwhile.
+      is_new = self._node_slots.get(missed_indices) < 0
+      missed_indices = missed_indices[is_new]
+      slots = self._allocate_slots(missed_indices.shape[0])
+      self._node_slots.insert(missed_indices, slots)
+      self._slot_nodes[slots] = missed_indices
+      self._lru_features[slots] = missed_rows[is_new]
+    return rows[inverse.reshape(-1)]
+
+  def _allocate_slots(self, num_slots):
+    """Returns `num_slots` slots for new rows, evicting the rows they hold.
+
+    Free slots are used first. The clock hand then sweeps the slots which were
+    in use before this call from where it stopped, evicting rows which were
+    not read since it last passed them, and clearing the reference of the
+    others. Must hold the lock.
+    """
+    # Slots handed out free by this call must not be evicted by it too.
+    num_swept_slots = self._num_used_slots
+    num_free_slots = min(num_slots, self._lru_size - self._num_used_slots)
+    free_slots = np.arange(self._num_used_slots,
+                           self._num_used_slots + num_free_slots)
+    self._num_used_slots += num_free_slots
+    num_evicted = num_slots - num_free_slots
+    if not num_evicted:
+      return free_slots.astype(np.int32)
+
+    # Only sweeps as far as needed, from a window of a few times the number
+    # of evicted slots.
+    window_size = min(num_swept_slots, 4 * num_evicted)
+    while True:
+      positions = (self._clock_hand + np.arange(window_size)) % num_swept_slots
+      is_referenced = self._is_referenced[positions]
+      unreferenced = np.flatnonzero(~is_referenced)
+      if (unreferenced.shape[0] >= num_evicted or
+          window_size == num_swept_slots):
+        break
+      window_size = min(num_swept_slots, 2 * window_size)
+    if unreferenced.shape[0] >= num_evicted:
+      num_swept = unreferenced[num_evicted - 1] + 1
+      evicted_slots = positions[unreferenced[:num_evicted]]
+    else:
+      # After a full sweep, every reference is cleared, and the second sweep
+      # evicts the rows which were referenced.
+      second_sweep = np.flatnonzero(is_referenced)[
+          :num_evicted - unreferenced.shape[0]]
+      self._is_referenced[:num_swept_slots] = False
+      num_swept = second_sweep[-1] + 1
+      evicted_slots = np.concatenate(
+          [positions[unreferenced], positions[second_sweep]])
+    self._is_referenced[positions[:num_swept]] = False
+    self._is_referenced[evicted_slots] = False
+    self._clock_hand = int(self._clock_hand + num_swept) % num_swept_slots
+    evicted_nodes = self._slot_nodes[evicted_slots]
+    self._node_slots.remove(evicted_nodes[evicted_nodes >= 0])
+    return np.concatenate([free_slots, evicted_slots]).astype(np.int32)
+
+  def get_stats(self) -> Dict[str, float]:
+    """Returns the numbers of gathered rows and hit rates of the caches."""
+    with self._lock:
+      num_rows = self._num_hot_hits + self._num_lru_hits + self._num_misses
+      return dict(
+          num_rows=num_rows,
+          hot_hit_rate=self._num_hot_hits / max(num_rows, 1),
+          lru_hit_rate=self._num_lru_hits / max(num_rows, 1),
+          hit_rate=(self._num_hot_hits + self._num_lru_hits) /
+          max(num_rows, 1))
@@ -0,0 +1,86 @@
+"""Tests for feature_store."""
+
+import threading
+
+from absl.testing import absltest
+import numpy as np
+
+# pylint: disable=g-bad-import-order
+import feature_store
+
+
+def _get_features(num_nodes=1000, feature_size=4):
+  return np.arange(num_nodes * feature_size, dtype=np.float32).reshape(
+      num_nodes, feature_size)
+
+
+class FeatureStoreTest(absltest.TestCase):
+
+  def test_gather_after_filling_free_slots_and_evicting(self):
+    features = _get_features()
+    store = feature_store.FeatureStore(
+        features, np.zeros(0, dtype=np.int64), lru_size=10)
+    for indices in ([np.arange(8)] * 2 + [np.array([50, 51, 52, 53])] * 2):
+      np.testing.assert_array_equal(store.gather(indices), features[indices])
+
+  def test_gather_under_eviction_pressure(self):
+    features = _get_features()
+    store = feature_store.FeatureStore.from_degrees(
+        features, np.arange(1000, dtype=np.int32), num_hot_nodes=20,
+        lru_size=64)
+    rng = np.random.RandomState(0)
+    for _ in range(500):
+      indices = rng.zipf(1.5, size=rng.randint(1, 100)) % 1000
+      np.testing.assert_array_equal(store.gather(indices), features[indices])
+    stats = store.get_stats()
+    self.assertGreater(stats['lru_hit_rate'], 0)
+    self.assertLess(stats['hit_rate'], 1)
+
+  def test_gather_from_threads(self):
+    features = _get_features()
+    store = feature_store.FeatureStore(
+        features, np.zeros(0, dtype=np.int64), lru_size=128)
+    errors = []
+
+    def gather(seed):
+      rng = np.random.RandomState(seed)
+      try:
+        for _ in range(300):
+          indices = rng.zipf(1.3, size=rng.randint(1, 100)) % 1000
+          np.testing.assert_array_equal(store.gather(indices),
+                                        features[indices])
+      except AssertionError as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=gather, args=(seed,))
+               for seed in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEmpty(errors)
+
+  def test_node_slot_table(self):
+    table = feature_store._NodeSlotTable(100)
+    nodes = np.arange(0, 500, 5, dtype=np.int64)
+    table.insert(nodes, np.arange(100, dtype=np.int32))
+    table.remove(nodes[:80])
+    # Enough tombstones to rebuild the table.
+    new_nodes = np.arange(10**9, 10**9 + 80, dtype=np.int64)
+    table.insert(new_nodes, np.arange(100, 180, dtype=np.int32))
+    np.testing.assert_array_equal(table.get(nodes[80:]), np.arange(80, 100))
+    np.testing.assert_array_equal(table.get(new_nodes), np.arange(100, 180))
+    np.testing.assert_array_equal(table.get(nodes[:80]), np.full(80, -1))
+
+  def test_get_top_indices(self):
+    degrees = np.array([3, 1, 4, 1, 5, 9, 2, 6, 5, 3], dtype=np.int32)
+    np.testing.assert_array_equal(
+        feature_store.get_top_indices(degrees, 4), [4, 5, 7, 8])
+    # Ties are broken by index.
+    np.testing.assert_array_equal(
+        feature_store.get_top_indices(degrees, 6), [0, 2, 4, 5, 7, 8])
+    self.assertEmpty(feature_store.get_top_indices(degrees, 0))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,235 @@
+"""Parses the raw VK group membership dumps into the raw edges layout.
+
+Every line of a dump lists the members of a group:
+
+http://vk.com/club123;456,789,...
+
+Each dump is parsed in chunks by its own process, which appends the group and
+user ids to part files, so memory does not depend on the dump sizes. The parts
+are then merged into a `[2, num_edges]` int64 `edge_index` array, with group
+ids in the first row and user ids in the second. These are VK ids, which
+`id_index_builder.py` maps to the dense ids read by `csr_builder.py`.
+Group lines with malformed member lists are skipped and counted, and parsing a
+dump fails if more than `--max_malformed_fraction` of them are. Dumps parsed
+since they were last modified are not parsed again when re-running.
+
+Usage:
+
+python3 group_dump_parser.py --groups_dir="groups" --data_root="mag_data"
+"""
+
+import json
+import multiprocessing
+import pathlib
+import re
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+
+# pylint: disable=g-bad-import-order
+import data_utils
+
+Path = pathlib.Path
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('groups_dir', None, 'Directory of the raw group dumps')
+flags.DEFINE_string('data_root', None, 'Data root directory')
+flags.DEFINE_integer('num_workers', multiprocessing.cpu_count(),
+                     'Number of dumps parsed at the same time')
+flags.DEFINE_integer('chunk_size', 1 << 26,
+                     'Number of bytes of a dump parsed at once')
+flags.DEFINE_integer('merge_block_size', 50_000_000,
+                     'Number of edges copied at once when merging the parts')
+flags.DEFINE_boolean('skip_existing', True,
+                     'Skips dumps parsed since they were last modified')
+flags.DEFINE_float(
+    'max_malformed_fraction', 1e-3,
+    'Parsing a dump fails if more than this fraction of its group lines have '
+    'malformed member lists. Other malformed lines are skipped')
+
+flags.mark_flags_as_required(['groups_dir', 'data_root'])
+
+_GROUP_URL_PATTERN = re.compile(rb'(?:https?://)?vk\.com/(?:public|club|event)'
+                                rb'(\d+)')
+_UTF8_BOM = b'\xef\xbb\xbf'
+
+
+def _get_parts_directory(data_root):
+  return (Path(data_root) /
+          data_utils.RAW_GROUP_USER_RAW_ID_EDGES_FILENAME.with_suffix('.parts'))
+
+
+def _get_part_paths(parts_dir, dump_name):
+  return (parts_dir / f'{dump_name}.groups.bin',
+          parts_dir / f'{dump_name}.users.bin',
+          parts_dir / f'{dump_name}.json')
+
+
+def _iterate_chunks(fid, chunk_size):
+  """Yields chunks of complete lines."""
+  remainder = b''
+  while True:
+    data = fid.read(chunk_size)
+    if not data:
+      break
+    data = remainder + data
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+      # No complete line yet.
+      remainder = data
+      continue
+    remainder = data[end:]
+    yield data[:end]
+  if remainder:
+    yield remainder
+
+
+def _parse_user_ids(members):
+  """Returns the user ids of member lists, or None if any is malformed."""
+  try:
+    user_ids = np.fromstring(members, dtype=np.int64, sep=',')
+  except ValueError:
+    return None
+  # Trailing separators are silently ignored, hence the count check.
+  if (user_ids.shape[0] != members.count(b',') + 1 or
+      (user_ids.shape[0] and user_ids.min() < 0)):
+    return None
+  return user_ids
+
+
+def _parse_chunk(chunk):
+  """Returns the group and user ids of every edge, and line counts.
+
+  Lines which are not group lines are skipped. Group lines with a malformed
+  member list, e.g. with a trailing comma or a stray token, are skipped and
+  counted separately.
+  """
+  group_ids = []
+  num_users = []
+  users = []
+  num_skipped_lines = 0
+  for line in chunk.split(b'\n'):
+    group, _, members = line.strip().partition(b';')
+    match = _GROUP_URL_PATTERN.fullmatch(group)
+    if not members or match is None:
+      num_skipped_lines += bool(line.strip())
+      continue
+    group_ids.append(int(match.group(1)))
+    num_users.append(members.count(b',') + 1)
+    users.append(members)
+  num_malformed_lines = 0
+  user_ids = _parse_user_ids(b','.join(users)) if users else np.zeros(
+      0, dtype=np.int64)
+  if user_ids is None:
+    # Parse line by line, to only skip the malformed ones.
+    line_user_ids = [_parse_user_ids(members) for members in users]
+    is_valid = [ids is not None for ids in line_user_ids]
+    num_malformed_lines = is_valid.count(False)
+    group_ids = [g for g, valid in zip(group_ids, is_valid) if valid]
+    line_user_ids = [ids for ids in line_user_ids if ids is not None]
+    num_users = [ids.shape[0] for ids in line_user_ids]
+    user_ids = (np.concatenate(line_user_ids) if line_user_ids else
+                np.zeros(0, dtype=np.int64))
+  group_ids = np.repeat(np.array(group_ids, dtype=np.int64),
+                        np.array(num_users, dtype=np.int64))
+  return (group_ids, user_ids, len(users), num_skipped_lines,
+          num_malformed_lines)
+
+
+def _parse_dump(dump_path, parts_dir, chunk_size, max_malformed_fraction):
+  """Parses a dump, appending its edges to its part files."""
+  groups_path, users_path, done_path = _get_part_paths(parts_dir,
+                                                       dump_path.name)
+  done_path.unlink(missing_ok=True)
+  num_edges = num_group_lines = num_skipped_lines = num_malformed_lines = 0
+  with dump_path.open('rb') as fid, groups_path.open(
+      'wb') as groups_fid, users_path.open('wb') as users_fid:
+    for i, chunk in enumerate(_iterate_chunks(fid, chunk_size)):
+      if i == 0 and chunk.startswith(_UTF8_BOM):
+        chunk = chunk[len(_UTF8_BOM):]
+      (group_ids, user_ids, num_chunk_group_lines, num_chunk_skipped_lines,
+       num_chunk_malformed_lines) = _parse_chunk(chunk)
+      group_ids.tofile(groups_fid)
+      user_ids.tofile(users_fid)
+      num_edges += group_ids.shape[0]
+      num_group_lines += num_chunk_group_lines
+      num_skipped_lines += num_chunk_skipped_lines
+      num_malformed_lines += num_chunk_malformed_lines
+  if num_malformed_lines > max_malformed_fraction * num_group_lines:
+    raise ValueError(
+        f'{dump_path}: {num_malformed_lines} / {num_group_lines} group lines '
+        'have malformed member lists, more than `--max_malformed_fraction`.')
+  # Only mark the dump as parsed once its parts are complete.
+  with done_path.open('w') as fid:
+    json.dump(dict(num_edges=num_edges, num_skipped_lines=num_skipped_lines,
+                   num_malformed_lines=num_malformed_lines), fid)
+  logging.info('Parsed %d edges from %s, skipped %d lines and %d / %d group '
+               'lines with malformed members', num_edges, dump_path,
+               num_skipped_lines, num_malformed_lines, num_group_lines)
+  return num_edges
+
+
+def _parse_dump_in_worker(args):
+  return _parse_dump(*args)
+
+
+def _merge_parts(parts_dir, dump_names, output_path, block_size):
+  """Concatenates the parts of all dumps into one `edge_index` array."""
+  num_edges = []
+  for dump_name in dump_names:
+    with _get_part_paths(parts_dir, dump_name)[2].open() as fid:
+      num_edges.append(json.load(fid)['num_edges'])
+  logging.info('Merging %d edges into %s', sum(num_edges), output_path)
+  edge_index = np.lib.format.open_memmap(
+      output_path, mode='w+', dtype=np.int64, shape=(2, sum(num_edges)))
+  offset = 0
+  for dump_name, num_dump_edges in zip(dump_names, num_edges):
+    if not num_dump_edges:
+      continue
+    groups_path, users_path, _ = _get_part_paths(parts_dir, dump_name)
+    for row, path in enumerate((groups_path, users_path)):
+      part = np.memmap(path, dtype=np.int64, mode='r', shape=(num_dump_edges,))
+      for start in range(0, num_dump_edges, block_size):
+        end = min(start + block_size, num_dump_edges)
+        edge_index[row, offset + start:offset + end] = part[start:end]
+      del part
+    offset += num_dump_edges
+  edge_index.flush()
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+
+  dump_paths = sorted(p for p in Path(FLAGS.groups_dir).iterdir()
+                      if p.is_file())
+  parts_dir = _get_parts_directory(FLAGS.data_root)
+  parts_dir.mkdir(parents=True, exist_ok=True)
+  tasks = []
+  for dump_path in dump_paths:
+    done_path = _get_part_paths(parts_dir, dump_path.name)[2]
+    if (FLAGS.skip_existing and done_path.exists() and
+        done_path.stat().st_mtime >= dump_path.stat().st_mtime):
+      logging.info('%s was parsed: skipping. Use flag `--skip_existing=False`'
+                   'to force overwrite existing.', dump_path)
+      continue
+    tasks.append((dump_path, parts_dir, FLAGS.chunk_size,
+                  FLAGS.max_malformed_fraction))
+  logging.info('Parsing %d / %d dumps', len(tasks), len(dump_paths))
+
+  if tasks:
+    with multiprocessing.Pool(min(FLAGS.num_workers, len(tasks))) as pool:
+      for _ in pool.imap_unordered(_parse_dump_in_worker, tasks):
+        pass
+
+  output_path = (
+      Path(FLAGS.data_root) / data_utils.RAW_GROUP_USER_RAW_ID_EDGES_FILENAME)
+  _merge_parts(parts_dir, [p.name for p in dump_paths], output_path,
+               FLAGS.merge_block_size)
+
+
+if __name__ == '__main__':
+  app.run(main)
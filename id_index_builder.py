@@ -0,0 +1,149 @@
+"""Maps the sparse VK user and group ids of the edges to dense ids.
+
+VK ids are large and sparse, so arrays indexed by them would be far larger
+than the number of users and groups. In one pass over the edges parsed by
+`group_dump_parser.py`, this collects the sorted unique VK ids of the users
+and of the groups, the memory-mappable `data_utils.IdIndex` arrays mapping VK
+ids to dense ids and back. The edges are then written with dense ids for
+`csr_builder.py`.
+
+The node inputs in `raw/raw_ids`, i.e. the features, labels and years with rows
+indexed by VK user id, and the train/valid/test indices holding VK user ids,
+are remapped through the same index to their usual paths in `raw`, from which
+the k-fold splits are generated. The rest of the pipeline assumes
+`data_utils.NUM_USERS` users and `data_utils.NUM_GROUPS` groups, so building
+fails if the dumps hold other numbers. The id indices are written last, so they
+only exist once all node ids are dense.
+
+Usage:
+
+python3 id_index_builder.py --data_root="mag_data"
+"""
+
+import pathlib
+
+from absl import app
+from absl import flags
+from absl import logging
+import numpy as np
+
+# pylint: disable=g-bad-import-order
+import data_utils
+
+Path = pathlib.Path
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_root', None, 'Data root directory')
+flags.DEFINE_integer('block_size', 100_000_000,
+                     'Number of edges, or node input values, read at once')
+
+flags.mark_flags_as_required(['data_root'])
+
+
+def _iterate_blocks(num_edges, block_size):
+  for start in range(0, num_edges, block_size):
+    yield start, min(start + block_size, num_edges)
+
+
+def build_id_indices(raw_id_edges, block_size):
+  """Returns the group and user id indices of `[2, num_edges]` raw id edges."""
+  num_edges = raw_id_edges.shape[1]
+  group_ids = data_utils.SortedIdAccumulator(raw_id_edges.dtype)
+  user_ids = data_utils.SortedIdAccumulator(raw_id_edges.dtype)
+  for start, end in _iterate_blocks(num_edges, block_size):
+    group_ids.add(raw_id_edges[0, start:end])
+    user_ids.add(raw_id_edges[1, start:end])
+    logging.info('Collecting ids: %d / %d edges', end, num_edges)
+  return (data_utils.IdIndex(group_ids.result()),
+          data_utils.IdIndex(user_ids.result()))
+
+
+def map_edges_to_dense_ids(raw_id_edges, group_index, user_index, output_path,
+                           block_size):
+  """Writes the edges with dense ids, block by block."""
+  num_edges = raw_id_edges.shape[1]
+  output_path.parent.mkdir(parents=True, exist_ok=True)
+  edges = np.lib.format.open_memmap(
+      output_path, mode='w+', dtype=np.int64, shape=(2, num_edges))
+  for start, end in _iterate_blocks(num_edges, block_size):
+    edges[0, start:end] = group_index.to_dense(raw_id_edges[0, start:end])
+    edges[1, start:end] = user_index.to_dense(raw_id_edges[1, start:end])
+    logging.info('Mapping ids: %d / %d edges', end, num_edges)
+  edges.flush()
+
+
+def remap_node_rows(raw_id_rows, user_index, output_path, block_size):
+  """Writes the rows of an array indexed by VK user id in dense id order."""
+  if user_index.size and user_index.raw_ids[-1] >= raw_id_rows.shape[0]:
+    raise ValueError(
+        f'{output_path}: VK user id {user_index.raw_ids[-1]} has no row, '
+        f'the input only has {raw_id_rows.shape[0]} rows.')
+  output_path.parent.mkdir(parents=True, exist_ok=True)
+  rows = np.lib.format.open_memmap(
+      output_path, mode='w+', dtype=raw_id_rows.dtype,
+      shape=(user_index.size,) + raw_id_rows.shape[1:])
+  # Same number of values read at once, whatever the row size.
+  num_block_rows = max(1, block_size // max(1, np.prod(rows.shape[1:])))
+  for start, end in _iterate_blocks(user_index.size, num_block_rows):
+    rows[start:end] = raw_id_rows[user_index.raw_ids[start:end]]
+    logging.info('Remapping %s: %d / %d rows', output_path, end,
+                 user_index.size)
+  rows.flush()
+
+
+def remap_node_ids(raw_ids, user_index, output_path):
+  """Writes VK user ids as dense ids, failing on users with no edges."""
+  dense_ids = user_index.to_dense(raw_ids)
+  num_unknown_ids = np.count_nonzero(dense_ids < 0)
+  if num_unknown_ids:
+    raise ValueError(f'{output_path}: {num_unknown_ids} / {dense_ids.shape[0]}'
+                     ' VK user ids are not in any group.')
+  output_path.parent.mkdir(parents=True, exist_ok=True)
+  np.save(output_path, dense_ids.astype(raw_ids.dtype))
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+
+  data_root = Path(FLAGS.data_root)
+  raw_id_edges = np.load(
+      data_root / data_utils.RAW_GROUP_USER_RAW_ID_EDGES_FILENAME,
+      mmap_mode='r')
+  group_index, user_index = build_id_indices(raw_id_edges, FLAGS.block_size)
+  logging.info('Found %d groups and %d users', group_index.size,
+               user_index.size)
+  if (group_index.size, user_index.size) != (data_utils.NUM_GROUPS,
+                                             data_utils.NUM_USERS):
+    raise ValueError(
+        f'Found {group_index.size} groups and {user_index.size} users, but '
+        f'`data_utils` has NUM_GROUPS = {data_utils.NUM_GROUPS} and NUM_USERS '
+        f'= {data_utils.NUM_USERS}.')
+
+  for path in (data_utils.RAW_NODE_FEATURES_FILENAME,
+               data_utils.RAW_NODE_LABELS_FILENAME,
+               data_utils.RAW_NODE_YEAR_FILENAME):
+    remap_node_rows(
+        np.load(data_root / data_utils.get_raw_id_input_filename(path),
+                mmap_mode='r'),
+        user_index, data_root / path, FLAGS.block_size)
+  # Some splits share their index file.
+  for path in dict.fromkeys((data_utils.TRAIN_INDEX_FILENAME,
+                             data_utils.VALID_INDEX_FILENAME,
+                             data_utils.TEST_INDEX_FILENAME)):
+    remap_node_ids(
+        np.load(data_root / data_utils.get_raw_id_input_filename(path)),
+        user_index, data_root / path)
+  map_edges_to_dense_ids(
+      raw_id_edges, group_index, user_index,
+      data_root / data_utils.RAW_GROUP_USER_EDGES_FILENAME, FLAGS.block_size)
+
+  # Written last: predictions are only mapped back to VK ids through them.
+  for path, index in ((data_utils.RAW_GROUP_IDS_FILENAME, group_index),
+                      (data_utils.RAW_USER_IDS_FILENAME, user_index)):
+    (data_root / path).parent.mkdir(parents=True, exist_ok=True)
+    np.save(data_root / path, index.raw_ids)
+
+if __name__ == '__main__':
+  app.run(main)
@@ -1,6 +1,9 @@
 """Find neighborhoods around user feature embeddings."""
 
+import json
+import multiprocessing
 import pathlib
+import time
 
 from absl import app
 from absl import flags
@@ -17,8 +20,32 @@ Path = pathlib.Path
 
 _USER_USER_B_PATH = 'ogb_mag_adjacencies/user_user_b.npz'
 
+# Neighbours searched for each user, including itself.
+_K = 20
+_PAD_K = 5
+_SEARCH_K = -1
+_NUM_NEIGHBORS = _K + _PAD_K + 1
+
 FLAGS = flags.FLAGS
 flags.DEFINE_string('data_root', None, 'Data root directory')
+flags.DEFINE_integer(
+    'num_workers', 0,
+    'If positive, number of processes searching neighbors, each writing its '
+    'shards directly to the output files')
+flags.DEFINE_integer('shard_size', 1000000,
+                     'Number of users per neighbor search shard')
+flags.DEFINE_enum(
+    'duplicate_detection', 'hashing', ['hashing', 'annoy'],
+    'How identical users are found: `hashing` groups users with identical '
+    'feature vectors exactly, `annoy` searches approximate nearest neighbors')
+flags.DEFINE_enum('duplicate_features', 'pca', ['pca', 'raw'],
+                  'Features hashed to find identical users')
+flags.DEFINE_integer(
+    'max_duplicate_class_size', 1000,
+    'Larger classes of identical users (e.g. users without features) are not '
+    'fused. Non-positive for no limit')
+flags.DEFINE_integer('hash_block_size', 1000000,
+                     'Number of feature rows hashed or compared at once')
 
 # Считывает "preprocessed/user_feat_pca_129.npy"
 def _read_user_pca_features():
@@ -28,6 +55,15 @@ def _read_user_pca_features():
     return np.load(fid)
 
 
+def _read_user_features_for_hashing():
+  data_root = Path(FLAGS.data_root)
+  if FLAGS.duplicate_features == 'pca':
+    path = data_root / data_utils.PCA_USER_FEATURES_FILENAME
+  else:
+    path = data_root / data_utils.RAW_NODE_FEATURES_FILENAME
+  return np.load(path, mmap_mode='r')
+
+
 def _read_adjacency_indices():
   # Get adjacencies.
   return data_utils.get_arrays(
@@ -57,11 +93,35 @@ def _get_annoy_index_path():
   return Path(FLAGS.data_root) / data_utils.PREPROCESSED_DIR / 'annoy_index.ann'
 
 
+def _get_annoy_stamp_path():
+  return _get_annoy_index_path().with_suffix('.json')
+
+
+def _get_features_stamp():
+  """Identifies the user features the annoy index is built from."""
+  path = Path(FLAGS.data_root) / data_utils.PCA_USER_FEATURES_FILENAME
+  stat = path.stat()
+  return dict(path=str(path.resolve()), size=stat.st_size,
+              mtime_ns=stat.st_mtime_ns)
+
+
+def _is_annoy_index_up_to_date():
+  """Whether the saved annoy index was built from the current features."""
+  stamp_path = _get_annoy_stamp_path()
+  if not (_get_annoy_index_path().exists() and stamp_path.exists()):
+    return False
+  with stamp_path.open() as fid:
+    return json.load(fid) == _get_features_stamp()
+
+
 def save_annoy_index(annoy_index):
   logging.info('Saving annoy index')
   index_path = _get_annoy_index_path()
   index_path.parent.mkdir(parents=True, exist_ok=True)
   annoy_index.save(str(index_path))
+  # Written last, the stamp marks the index as complete.
+  with _get_annoy_stamp_path().open('w') as fid:
+    json.dump(_get_features_stamp(), fid)
 
 
 def read_annoy_index(features):
@@ -78,18 +138,255 @@ def compute_neighbor_indices_and_distances(features):
   annoy_index = read_annoy_index(features)
   num_vectors = features.shape[0]
 
-  k = 20
-  pad_k = 5
-  search_k = -1
-  neighbor_indices = np.zeros([num_vectors, k + pad_k + 1], dtype=np.int32)
-  neighbor_distances = np.zeros([num_vectors, k + pad_k + 1], dtype=np.float32)
+  neighbor_indices = np.zeros([num_vectors, _NUM_NEIGHBORS], dtype=np.int32)
+  neighbor_distances = np.zeros([num_vectors, _NUM_NEIGHBORS], dtype=np.float32)
   for i in range(num_vectors):
     neighbor_indices[i], neighbor_distances[i] = annoy_index.get_nns_by_item(
-        i, k + pad_k + 1, search_k=search_k, include_distances=True)
+        i, _NUM_NEIGHBORS, search_k=_SEARCH_K, include_distances=True)
     if i % 10000 == 0:
       logging.info('Finding neighbors %d / %d', i, num_vectors)
   return neighbor_indices, neighbor_distances
 
+
+# State of neighbor search worker processes.
+_WORKER_STATE = {}
+
+
+def _init_neighbor_worker(index_path, vector_size, indices_path,
+                          distances_path):
+  # Annoy memory-maps the index, so workers share it through the page cache.
+  annoy_index = annoy.AnnoyIndex(vector_size, 'euclidean')
+  annoy_index.load(str(index_path))
+  _WORKER_STATE.update(
+      annoy_index=annoy_index,
+      neighbor_indices=np.load(indices_path, mmap_mode='r+'),
+      neighbor_distances=np.load(distances_path, mmap_mode='r+'))
+
+
+def _search_neighbor_shard(shard):
+  """Searches the neighbors of a range of users, writing them in place."""
+  start, end, done_path = shard
+  annoy_index = _WORKER_STATE['annoy_index']
+  neighbor_indices = _WORKER_STATE['neighbor_indices']
+  neighbor_distances = _WORKER_STATE['neighbor_distances']
+  for i in range(start, end):
+    neighbor_indices[i], neighbor_distances[i] = annoy_index.get_nns_by_item(
+        i, _NUM_NEIGHBORS, search_k=_SEARCH_K, include_distances=True)
+  neighbor_indices.flush()
+  neighbor_distances.flush()
+  # Only mark the shard as done once its results are on disk.
+  done_path.touch()
+  return end - start
+
+
+def _open_neighbor_output(path, dtype, shape):
+  """Opens an existing output file to resume, or creates a new one."""
+  if path.exists():
+    array = np.load(path, mmap_mode='r+')
+    if array.shape == shape and array.dtype == dtype:
+      return array, True
+    del array
+  path.parent.mkdir(parents=True, exist_ok=True)
+  return np.lib.format.open_memmap(
+      path, mode='w+', dtype=dtype, shape=shape), False
+
+
+def compute_neighbor_indices_and_distances_sharded(features, num_workers,
+                                                   shard_size):
+  """Searches neighbors in parallel, writing them to memory-mapped outputs.
+
+  Users are split into contiguous shards, searched by `num_workers` processes
+  which write their results directly to `neighbor_indices.npy` and
+  `neighbor_distances.npy`. A marker file is written for every completed
+  shard, so an interrupted run resumes with the remaining shards, as long as
+  the annoy index was built from the same features (see `_find_neighbors`).
+
+  Args:
+    features: User features the annoy index was built from.
+    num_workers: Number of worker processes.
+    shard_size: Number of users per shard.
+
+  Returns:
+    Memory-mapped neighbor indices and distances.
+  """
+  logging.info('Computing neighbors and distances with %d workers',
+               num_workers)
+  num_vectors, vector_size = features.shape
+  data_root = Path(FLAGS.data_root)
+  indices_path = data_root / data_utils.NEIGHBOR_INDICES_FILENAME
+  distances_path = data_root / data_utils.NEIGHBOR_DISTANCES_FILENAME
+  shards_dir = _get_neighbor_shards_directory()
+  shape = (num_vectors, _NUM_NEIGHBORS)
+  neighbor_indices, indices_resumed = _open_neighbor_output(
+      indices_path, np.dtype(np.int32), shape)
+  neighbor_distances, distances_resumed = _open_neighbor_output(
+      distances_path, np.dtype(np.float32), shape)
+  if not (indices_resumed and distances_resumed):
+    # Markers of a previous run do not apply to new output files.
+    _clear_neighbor_shards()
+  shards_dir.mkdir(parents=True, exist_ok=True)
+
+  shards = []
+  for start in range(0, num_vectors, shard_size):
+    end = min(start + shard_size, num_vectors)
+    done_path = shards_dir / f'{start}_{end}.done'
+    if not done_path.exists():
+      shards.append((start, end, done_path))
+  logging.info('%d / %d users left to search',
+               sum(end - start for start, end, _ in shards), num_vectors)
+
+  start_time = time.time()
+  num_searched = 0
+  with multiprocessing.Pool(
+      num_workers,
+      initializer=_init_neighbor_worker,
+      initargs=(_get_annoy_index_path(), vector_size, indices_path,
+                distances_path)) as pool:
+    for num_shard_vectors in pool.imap_unordered(_search_neighbor_shard,
+                                                 shards):
+      num_searched += num_shard_vectors
+      elapsed_time = time.time() - start_time
+      logging.info('Finding neighbors %d searched. Elapsed time %.1f '
+                   '(%.1f users/s)', num_searched, elapsed_time,
+                   num_searched / elapsed_time)
+  return neighbor_indices, neighbor_distances
+
+
+def _get_neighbor_shards_directory():
+  return Path(FLAGS.data_root) / data_utils.PREPROCESSED_DIR / 'neighbor_shards'
+
+
+def _clear_neighbor_shards():
+  for done_path in _get_neighbor_shards_directory().glob('*.done'):
+    done_path.unlink()
+
+
+def _clear_neighbor_search():
+  """Deletes the annoy index, shard markers and outputs of a previous run."""
+  data_root = Path(FLAGS.data_root)
+  for path in [_get_annoy_stamp_path(), _get_annoy_index_path(),
+               data_root / data_utils.NEIGHBOR_INDICES_FILENAME,
+               data_root / data_utils.NEIGHBOR_DISTANCES_FILENAME]:
+    if path.exists():
+      path.unlink()
+  _clear_neighbor_shards()
+
+def _get_row_words(rows):
+  """Views feature rows as unsigned integers, for exact comparisons."""
+  rows = np.ascontiguousarray(rows)
+  if np.issubdtype(rows.dtype, np.floating):
+    # Makes -0. and 0. identical, as they are for distances.
+    rows = rows + rows.dtype.type(0)
+  return rows.view(f'u{rows.dtype.itemsize}')
+
+
+def _hash_rows(rows, multipliers):
+  words = _get_row_words(rows).astype(np.uint64)
+  hashes = (words * multipliers).sum(axis=1, dtype=np.uint64)
+  # Mixes the high bits into the low bits.
+  return hashes ^ (hashes >> np.uint64(29))
+
+
+def _split_colliding_group(features, group_ids, canonical_ids):
+  """Groups the rows of a hash group with an exact comparison."""
+  rows = _get_row_words(features[group_ids])
+  rows = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1])))
+  _, first_positions, inverse = np.unique(
+      rows.ravel(), return_index=True, return_inverse=True)
+  canonical_ids[group_ids] = group_ids[first_positions[inverse.ravel()]]
+
+
+def find_duplicate_rows(features, block_size, max_class_size=0):
+  """Groups rows with identical features into classes of duplicates.
+
+  Rows are hashed block by block and sorted by hash, so that identical rows
+  end up next to each other. Rows sharing a hash are then compared to the
+  first row of their hash group, and the rare hash collisions are resolved
+  with an exact grouping. Unlike a nearest neighbor search, this finds all
+  the duplicates of every row.
+
+  Args:
+    features: Feature rows, possibly memory-mapped.
+    block_size: Number of rows hashed or compared at once.
+    max_class_size: If positive, rows of larger classes are not considered
+      duplicates.
+
+  Returns:
+    Canonical ids, the index of the first row identical to every row.
+  """
+  num_rows = features.shape[0]
+  logging.info('Hashing %d feature rows', num_rows)
+  rand = np.random.RandomState(0)
+  multipliers = rand.randint(
+      np.iinfo(np.int64).max, size=features.shape[1], dtype=np.int64)
+  multipliers = multipliers.astype(np.uint64) | np.uint64(1)
+  hashes = np.empty(num_rows, dtype=np.uint64)
+  for start in range(0, num_rows, block_size):
+    end = min(start + block_size, num_rows)
+    hashes[start:end] = _hash_rows(features[start:end], multipliers)
+    logging.info('Hashing: %d / %d', end, num_rows)
+
+  logging.info('Sorting hashes')
+  # A stable sort keeps the rows of a hash group in increasing order.
+  order = np.argsort(hashes, kind='stable')
+  hashes = hashes[order]
+  group_starts = np.flatnonzero(
+      np.concatenate([[True], hashes[1:] != hashes[:-1]]))
+  del hashes
+  group_sizes = np.diff(np.append(group_starts, num_rows))
+  is_candidate = np.repeat(group_sizes > 1, group_sizes)
+  candidate_positions = np.flatnonzero(is_candidate)
+  del is_candidate
+  head_positions = np.repeat(group_starts[group_sizes > 1],
+                             group_sizes[group_sizes > 1])
+  del group_starts, group_sizes
+  logging.info('%d rows share their hash with another row',
+               candidate_positions.shape[0])
+
+  canonical_ids = np.arange(num_rows, dtype=np.int32)
+  colliding_heads = [np.zeros(0, dtype=head_positions.dtype)]
+  for start in range(0, candidate_positions.shape[0], block_size):
+    ids = order[candidate_positions[start:start + block_size]]
+    head_ids = order[head_positions[start:start + block_size]]
+    is_identical = np.all(
+        _get_row_words(features[ids]) == _get_row_words(features[head_ids]),
+        axis=1)
+    canonical_ids[ids[is_identical]] = head_ids[is_identical]
+    colliding_heads.append(head_positions[start:start + block_size][
+        ~is_identical])
+  colliding_heads = np.unique(np.concatenate(colliding_heads))
+  logging.info('Resolving %d hash collisions', colliding_heads.shape[0])
+  for head_position in colliding_heads:
+    group_end = np.searchsorted(head_positions, head_position, side='right')
+    group_start = np.searchsorted(head_positions, head_position)
+    group_ids = order[candidate_positions[group_start:group_end]]
+    _split_colliding_group(features, group_ids, canonical_ids)
+  del order, candidate_positions, head_positions
+
+  is_duplicate = canonical_ids != np.arange(num_rows)
+  classes, class_sizes = np.unique(
+      canonical_ids[is_duplicate], return_counts=True)
+  class_sizes += 1
+  logging.info('Found %d rows in %d classes of duplicates',
+               np.sum(class_sizes), classes.shape[0])
+  if max_class_size > 0 and np.any(class_sizes > max_class_size):
+    large_classes = classes[class_sizes > max_class_size]
+    logging.info('Ignoring %d classes larger than %d rows (%d rows)',
+                 large_classes.shape[0], max_class_size,
+                 np.sum(class_sizes[class_sizes > max_class_size]))
+    in_large_class = np.flatnonzero(
+        is_duplicate & np.isin(canonical_ids, large_classes))
+    canonical_ids[in_large_class] = in_large_class
+  return canonical_ids
+
+
+def _write_canonical_ids(canonical_ids):
+  logging.info('Writing canonical ids')
+  path = Path(FLAGS.data_root) / data_utils.CANONICAL_USER_IDS_FILENAME
+  path.parent.mkdir(parents=True, exist_ok=True)
+  with open(path, 'wb') as fid:
+    np.save(fid, canonical_ids)
+
 # Сохранение готовых соседей
 def _write_neighbors(neighbor_indices, neighbor_distances):
   """Write neighbor indices and distances."""
@@ -126,19 +423,44 @@ def _write_fused_nodes(fused_node_labels):
     np.save(fid, fused_node_labels)
 
 # 
-def main(unused_argv):
+def _find_neighbors():
+  """Finds and writes nearest neighbors of the user features."""
   user_pca_features = _read_user_pca_features()
   # Find neighbors.
-  annoy_index = build_annoy_index(user_pca_features)
-  save_annoy_index(annoy_index)
+  if FLAGS.num_workers > 0 and _is_annoy_index_up_to_date():
+    # Resume with the same index, searched shards depend on it.
+    logging.info('Reusing annoy index %s', _get_annoy_index_path())
+  else:
+    # Searched shards of other features or another index are stale.
+    _clear_neighbor_search()
+    annoy_index = build_annoy_index(user_pca_features)
+    save_annoy_index(annoy_index)
+    del annoy_index
   # Распределение статей по соседству
-  neighbor_indices, neighbor_distances = compute_neighbor_indices_and_distances(
-      user_pca_features)
+  if FLAGS.num_workers > 0:
+    # Written directly to the output files.
+    return compute_neighbor_indices_and_distances_sharded(
+        user_pca_features, FLAGS.num_workers, FLAGS.shard_size)
+  neighbor_indices, neighbor_distances = (
+      compute_neighbor_indices_and_distances(user_pca_features))
   del user_pca_features
   _write_neighbors(neighbor_indices, neighbor_distances)
+  return neighbor_indices, neighbor_distances
+
+
+def main(unused_argv):
+  if FLAGS.duplicate_detection == 'hashing':
+    neighbor_indices = neighbor_distances = None
+    canonical_ids = find_duplicate_rows(
+        _read_user_features_for_hashing(), FLAGS.hash_block_size,
+        FLAGS.max_duplicate_class_size)
+    _write_canonical_ids(canonical_ids)
+  else:
+    neighbor_indices, neighbor_distances = _find_neighbors()
+    canonical_ids = None
 
   data = _read_adjacency_indices()
-  user_user_csr = data['user_user_index']
+  user_user_csr = data_utils.to_scipy_csr(data['user_user_index'])
   user_label = data['user_label']
   train_indices = data['train_indices']
   valid_indices = data['valid_indices']
@@ -146,14 +468,15 @@ def main(unused_argv):
   del data
 
   fused_user_adjacency_matrix = data_utils.generate_fused_user_adjacency_matrix(
-      neighbor_indices, neighbor_distances, user_user_csr)
+      neighbor_indices, neighbor_distances, user_user_csr,
+      canonical_ids=canonical_ids)
   _write_fused_edges(fused_user_adjacency_matrix)
   del fused_user_adjacency_matrix
   del user_user_csr
 
   fused_node_labels = data_utils.generate_fused_node_labels(
       neighbor_indices, neighbor_distances, user_label, train_indices,
-      valid_indices, test_indices)
+      valid_indices, test_indices, canonical_ids=canonical_ids)
   _write_fused_nodes(fused_node_labels)
 
 
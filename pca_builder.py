@@ -4,8 +4,13 @@ Compute users' PCA features.
 Recompute group and institution features from the user PCA features.
 """
 
+import collections
+from concurrent import futures
 import pathlib
+import queue
+import threading
 import time
+from typing import NamedTuple
 
 from absl import app
 from absl import flags
@@ -21,6 +26,24 @@ _NUMBER_OF_USERS_TO_ESTIMATE_PCA_ON = 1000000  # None indicates all.
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('data_root', None, 'Data root directory')
+flags.DEFINE_integer('num_workers', 0,
+                     'Number of processes aggregating group features')
+flags.DEFINE_integer('num_projection_threads', 2,
+                     'Number of threads projecting blocks of user features')
+flags.DEFINE_enum('pca_dtype', 'f4', ['f4', 'f2'],
+                  'Dtype of the stored PCA features')
+flags.DEFINE_enum(
+    'pca_fit_mode', 'sample', ['sample', 'streaming'],
+    'Fits the PCA basis on a small in-memory sample, or by streaming the '
+    'covariance over all user features')
+flags.DEFINE_integer('num_principal_components', 129,
+                     'Number of principal components to keep')
+flags.DEFINE_float(
+    'pca_fit_fraction', 1.0,
+    'Fraction of users sampled in each block in `streaming` fit mode')
+flags.DEFINE_boolean(
+    'reuse_pca_basis', False,
+    'Projects onto the saved PCA basis, if it exists, instead of refitting')
 
 
 def _sample_vectors(vectors, num_samples, seed=0):
@@ -30,12 +53,24 @@ def _sample_vectors(vectors, num_samples, seed=0):
   return vectors[indices]
 
 
-def _pca(feat):
+class _PcaBasis(NamedTuple):
+  """Principal components (as columns), with the mean and variances."""
+  components: np.ndarray
+  mean: np.ndarray
+  variances: np.ndarray
+  num_samples: int
+
+
+def _pca_from_covariance(cov):
   """Returns evals (variances), evecs (rows are principal components)."""
-  cov = np.cov(feat.T)
   _, evals, evecs = np.linalg.svd(cov, full_matrices=True)
   return evals, evecs
 
+
+def _pca(feat):
+  """Returns evals (variances), evecs (rows are principal components)."""
+  return _pca_from_covariance(np.cov(feat.T))
+
 # Считывает numpy файл с эмбеддингами узлов 
 # (пример: raw/node_feat.npy processed/user/node_feat.npy)
 def _read_raw_user_features():
@@ -58,35 +93,189 @@ def _get_principal_components(features,
   sample = _sample_vectors(
       features[:_NUMBER_OF_USERS_TO_ESTIMATE_PCA_ON], num_samples, seed=seed)
   # Compute PCA basis.
-  _, evecs = _pca(sample)
-  return evecs[:num_principal_components].T.astype(dtype)
+  evals, evecs = _pca(sample)
+  return _PcaBasis(
+      components=evecs[:num_principal_components].T.astype(dtype),
+      mean=sample.mean(axis=0, dtype=np.float64),
+      variances=evals[:num_principal_components],
+      num_samples=num_samples)
+
+
+def _get_principal_components_streaming(features,
+                                        num_principal_components=129,
+                                        sample_fraction=1.0,
+                                        block_size=1000000,
+                                        seed=2,
+                                        dtype='f4'):
+  """Estimate PCA features from a covariance accumulated over all blocks.
+
+  Sums and outer products of the (optionally sub-sampled) features are
+  accumulated in float64, one block at a time, so memory does not depend on
+  the number of samples.
+
+  Args:
+    features: `[num_vectors, num_features]` array, typically memory-mapped.
+    num_principal_components: Number of components to keep.
+    sample_fraction: Fraction of vectors of each block used in the estimate.
+    block_size: Number of vectors per block.
+    seed: Seed of the sub-sampling.
+    dtype: Dtype of the components.
+
+  Returns:
+    A `_PcaBasis`.
+  """
+  rand = np.random.RandomState(seed=seed)
+  num_vectors, num_features = features.shape
+  num_samples = 0
+  total = np.zeros([num_features], dtype=np.float64)
+  outer_products = np.zeros([num_features, num_features], dtype=np.float64)
+  start_time = time.time()
+  for i_start in range(0, num_vectors, block_size):
+    block = np.asarray(features[i_start:i_start + block_size])
+    if sample_fraction < 1.0:
+      block = block[rand.random_sample(block.shape[0]) < sample_fraction]
+    block = block.astype(np.float64)
+    num_samples += block.shape[0]
+    total += block.sum(axis=0)
+    outer_products += block.T @ block
+    del block
+    logging.info('Covariance %d / %d. Elapsed time %.1f',
+                 min(i_start + block_size, num_vectors), num_vectors,
+                 time.time() - start_time)
+  mean = total / num_samples
+  cov = (outer_products - num_samples * np.outer(mean, mean)) / (
+      num_samples - 1)
+  evals, evecs = _pca_from_covariance(cov)
+  return _PcaBasis(
+      components=evecs[:num_principal_components].T.astype(dtype),
+      mean=mean,
+      variances=evals[:num_principal_components],
+      num_samples=num_samples)
+
+
+def _save_pca_basis(path, basis):
+  path.parent.mkdir(parents=True, exist_ok=True)
+  with open(path, 'wb') as fid:
+    np.savez(fid, **basis._asdict())
+
+
+def _load_pca_basis(path):
+  with np.load(path) as basis:
+    return _PcaBasis(
+        components=basis['components'],
+        mean=basis['mean'],
+        variances=basis['variances'],
+        num_samples=int(basis['num_samples']))
+
+
+def _read_blocks(features, block_size, block_queue):
+  """Reads blocks of features into `block_queue`, ending with `None`."""
+  try:
+    for i_start in range(0, features.shape[0], block_size):
+      block_queue.put((i_start, np.asarray(features[i_start:i_start +
+                                                    block_size])))
+  except Exception as e:  # pylint: disable=broad-except
+    block_queue.put(e)
+  block_queue.put(None)
+
+
+def _project_block(block, principal_components, output, i_start, dtype):
+  output[i_start:i_start + block.shape[0]] = np.dot(
+      block, principal_components).astype(dtype)
 
 
 def _project_features_onto_principal_components(features,
                                                 principal_components,
-                                                block_size=1000000):
-  """Apply PCA iteratively."""
+                                                block_size=1000000,
+                                                output_path=None,
+                                                dtype=None,
+                                                num_threads=1):
+  """Apply PCA iteratively.
+
+  A reader thread loads blocks of features while a pool of threads multiplies
+  them with the principal components, so disk reads overlap with the BLAS
+  matmuls. At most `num_threads + 1` blocks are held in memory.
+
+  Args:
+    features: `[num_vectors, num_features]` array, typically memory-mapped.
+    principal_components: `[num_features, num_principal_components]` array.
+    block_size: Number of vectors per block.
+    output_path: Optional `.npy` path, the output is then memory-mapped and
+      written incrementally instead of held in memory.
+    dtype: Output dtype, by default that of `principal_components`.
+    num_threads: Number of threads projecting blocks.
+
+  Returns:
+    The `[num_vectors, num_principal_components]` projected features.
+  """
   num_principal_components = principal_components.shape[1]
-  dtype = principal_components.dtype
+  if dtype is None:
+    dtype = principal_components.dtype
   num_vectors = features.shape[0]
-  num_features = features.shape[0]
-  num_blocks = (num_features - 1) // block_size + 1
-  pca_features = np.empty([num_vectors, num_principal_components], dtype=dtype)
-  # Loop through in blocks.
+  output_shape = (num_vectors, num_principal_components)
+  if output_path is None:
+    pca_features = np.empty(output_shape, dtype=dtype)
+  else:
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    pca_features = np.lib.format.open_memmap(
+        output_path, mode='w+', dtype=dtype, shape=output_shape)
+
+  block_queue = queue.Queue(maxsize=1)
+  reader = threading.Thread(
+      target=_read_blocks, args=(features, block_size, block_queue),
+      daemon=True)
+  reader.start()
   start_time = time.time()
-  for i in range(num_blocks):
-    i_start = i * block_size
-    i_end = (i + 1) * block_size
-    f = np.array(features[i_start:i_end].copy())
-    pca_features[i_start:i_end] = np.dot(f, principal_components).astype(dtype)
-    del f
+  pending = collections.deque()
+  num_done = 0
+
+  def wait_for_block():
+    nonlocal num_done
+    i_start, future = pending.popleft()
+    future.result()
+    num_done = min(i_start + block_size, num_vectors)
     elapsed_time = time.time() - start_time
-    time_left = elapsed_time / (i + 1) * (num_blocks - i - 1)
-    logging.info('Features %d / %d. Elapsed time %.1f. Time left: %.1f', i_end,
-                 num_vectors, elapsed_time, time_left)
+    time_left = elapsed_time / num_done * (num_vectors - num_done)
+    logging.info('Features %d / %d. Elapsed time %.1f. Time left: %.1f',
+                 num_done, num_vectors, elapsed_time, time_left)
+
+  with futures.ThreadPoolExecutor(num_threads) as executor:
+    while True:
+      item = block_queue.get()
+      if item is None:
+        break
+      if isinstance(item, Exception):
+        raise item
+      i_start, block = item
+      pending.append((i_start, executor.submit(
+          _project_block, block, principal_components, pca_features, i_start,
+          dtype)))
+      del block
+      if len(pending) >= num_threads:
+        wait_for_block()
+    while pending:
+      wait_for_block()
+  reader.join()
+  if output_path is not None:
+    pca_features.flush()
   return pca_features
 
 
+def _write_concatenated(path, arrays, block_size=1000000):
+  """Writes arrays concatenated along the first axis, block by block."""
+  path.parent.mkdir(parents=True, exist_ok=True)
+  output = np.lib.format.open_memmap(
+      path, mode='w+', dtype=arrays[0].dtype,
+      shape=(sum(a.shape[0] for a in arrays),) + arrays[0].shape[1:])
+  offset = 0
+  for array in arrays:
+    for i_start in range(0, array.shape[0], block_size):
+      block = array[i_start:i_start + block_size]
+      output[offset + i_start:offset + i_start + block.shape[0]] = block
+    offset += array.shape[0]
+  output.flush()
+
+
 def _read_adjacency_indices():
   # Get adjacencies.
   return data_utils.get_arrays(
@@ -97,55 +286,69 @@ def _read_adjacency_indices():
   )
 
 
-def _compute_group_pca_features(user_pca_features, index_arrays):
+def _compute_group_pca_features(user_pca_features, index_arrays, output_path):
   return data_utils.user_features_to_group_features(
-      index_arrays['group_user_index'], user_pca_features)
+      index_arrays['group_user_index'], user_pca_features,
+      output_path=output_path, num_workers=FLAGS.num_workers)
 
 
 def _compute_institution_pca_features(group_pca_features, index_arrays):
   return data_utils.group_features_to_institution_features(
       index_arrays['institution_group_index'], group_pca_features)
 
-
-def _write_array(path, array):
-  path.parent.mkdir(parents=True, exist_ok=True)
-  with open(path, 'wb') as fid:
-    np.save(fid, array)
-
 # Обработка эмбеддингов узлов Методом Главных Компонент
 # Всё вычисляется из первоначальных узлов
 def main(unused_argv):
   data_root = Path(FLAGS.data_root)
 
-  raw_user_features = _read_raw_user_features()   # читает "raw/node_feat.npy"
-  principal_components = _get_principal_components(raw_user_features)
-  # Схожий фрагмент
-  user_pca_features = _project_features_onto_principal_components(
-      raw_user_features, principal_components)
-  del raw_user_features
-  del principal_components
-
   user_pca_path = data_root / data_utils.PCA_USER_FEATURES_FILENAME
   group_pca_path = data_root / data_utils.PCA_GROUP_FEATURES_FILENAME
   institution_pca_path = (
       data_root / data_utils.PCA_INSTITUTION_FEATURES_FILENAME)
   merged_pca_path = data_root / data_utils.PCA_MERGED_FEATURES_FILENAME
-  _write_array(user_pca_path, user_pca_features)
+
+  pca_basis_path = data_root / data_utils.PCA_BASIS_FILENAME
+
+  raw_user_features = _read_raw_user_features()   # читает "raw/node_feat.npy"
+  if FLAGS.reuse_pca_basis and pca_basis_path.exists():
+    logging.info('Reusing PCA basis from %s', pca_basis_path)
+    pca_basis = _load_pca_basis(pca_basis_path)
+  else:
+    if FLAGS.pca_fit_mode == 'streaming':
+      pca_basis = _get_principal_components_streaming(
+          raw_user_features,
+          num_principal_components=FLAGS.num_principal_components,
+          sample_fraction=FLAGS.pca_fit_fraction)
+    else:
+      pca_basis = _get_principal_components(
+          raw_user_features,
+          num_principal_components=FLAGS.num_principal_components)
+    logging.info('Fitted PCA basis on %d samples', pca_basis.num_samples)
+    _save_pca_basis(pca_basis_path, pca_basis)
+  principal_components = pca_basis.components
+  # Схожий фрагмент
+  # Written incrementally to `user_pca_path`.
+  user_pca_features = _project_features_onto_principal_components(
+      raw_user_features, principal_components,
+      output_path=user_pca_path,
+      dtype=np.dtype(FLAGS.pca_dtype),
+      num_threads=FLAGS.num_projection_threads)
+  del raw_user_features
+  del principal_components
 
   # TODO: Сжать до получения инфы для пользователей сообществ
   # Схожий фрагмент
   # Compute group and institution features from user PCA features.
   index_arrays = _read_adjacency_indices()
+  # Written incrementally to `group_pca_path`.
   group_pca_features = _compute_group_pca_features(user_pca_features,
-                                                     index_arrays)
-  _write_array(group_pca_path, group_pca_features)
+                                                   index_arrays,
+                                                   group_pca_path)
 
   # Схожий фрагмент
-  merged_pca_features = np.concatenate(
-      [user_pca_features, group_pca_features],
-      axis=0)
+  _write_concatenated(merged_pca_path,
+                      [user_pca_features, group_pca_features])
   del group_pca_features
-  _write_array(merged_pca_path, merged_pca_features)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,338 @@
+"""Throughput metrics and profiles of the input pipeline stages."""
+
+import collections
+import contextlib
+import json
+import pathlib
+import threading
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    Optional, TypeVar)
+
+from absl import logging
+import numpy as np
+
+_T = TypeVar('_T')
+
+
+class StageMetrics:
+  """Counts the elements produced by a stage, and how long they were awaited.
+
+  The time spent waiting for the next element of a stage is the time its
+  consumer stalls on it, so comparing wait times shows the bottleneck.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._start_time = None
+    self._num_elements = 0
+    self._wait_time = 0.
+
+  def record(self, num_elements=1, wait_time=0.):
+    with self._lock:
+      if self._start_time is None:
+        self._start_time = time.time()
+      self._num_elements += num_elements
+      self._wait_time += wait_time
+
+  def get_stats(self) -> Dict[str, float]:
+    with self._lock:
+      elapsed_time = (time.time() - self._start_time
+                      if self._start_time is not None else 0.)
+      return dict(
+          num_elements=self._num_elements,
+          elements_per_second=(self._num_elements / elapsed_time
+                               if elapsed_time > 0 else 0.),
+          wait_time=self._wait_time)
+
+
+class QueueMetrics:
+  """Tracks the depth of a queue of ready elements each time it is read."""
+
+  def __init__(self, capacity):
+    self._lock = threading.Lock()
+    self._capacity = capacity
+    self._num_samples = 0
+    self._total_depth = 0
+    self._max_depth = 0
+    self._num_empty = 0
+
+  def record(self, depth):
+    with self._lock:
+      self._num_samples += 1
+      self._total_depth += depth
+      self._max_depth = max(self._max_depth, depth)
+      self._num_empty += depth == 0
+
+  def get_stats(self) -> Dict[str, float]:
+    with self._lock:
+      num_samples = max(self._num_samples, 1)
+      return dict(
+          capacity=self._capacity,
+          mean_depth=self._total_depth / num_samples,
+          max_depth=self._max_depth,
+          # Fraction of reads which had to wait for an element.
+          empty_fraction=self._num_empty / num_samples)
+
+
+class DistributionMetrics:
+  """Summarizes a value recorded once per element, e.g. the fill of batches.
+
+  Percentiles and histograms are over the `window_size` most recent values.
+  """
+
+  def __init__(self, window_size=10_000):
+    self._lock = threading.Lock()
+    self._count = 0
+    self._total = 0.
+    self._min = float('inf')
+    self._max = float('-inf')
+    self._recent_values = collections.deque(maxlen=window_size)
+
+  def record(self, value):
+    with self._lock:
+      self._count += 1
+      self._total += value
+      self._min = min(self._min, value)
+      self._max = max(self._max, value)
+      self._recent_values.append(value)
+
+  def record_all(self, values: Iterable[float]):
+    for value in values:
+      self.record(value)
+
+  def get_stats(self) -> Dict[str, float]:
+    with self._lock:
+      if not self._count:
+        return dict(count=0, total=0., mean=0., min=0., max=0., p50=0.,
+                    p90=0., p99=0.)
+      stats = dict(
+          count=self._count,
+          total=self._total,
+          mean=self._total / self._count,
+          min=self._min,
+          max=self._max)
+      recent_values = list(self._recent_values)
+    # Not holding the lock, which recording threads wait for.
+    p50, p90, p99 = np.percentile(recent_values, [50, 90, 99])
+    return dict(stats, p50=float(p50), p90=float(p90), p99=float(p99))
+
+  def get_histogram(self, num_bins=20) -> Dict[str, List[float]]:
+    """Returns the bin edges and counts of the recent values."""
+    with self._lock:
+      values = np.array(self._recent_values, dtype=np.float64)
+    counts, edges = np.histogram(values, bins=num_bins)
+    return dict(edges=edges.tolist(), counts=counts.tolist())
+
+
+_STAGES = collections.OrderedDict()
+_QUEUES = collections.OrderedDict()
+_DISTRIBUTIONS = collections.OrderedDict()
+# Functions returning stats of other parts of the pipeline, e.g. caches.
+_STATS_FNS = collections.OrderedDict()
+_STAGES_LOCK = threading.Lock()
+_last_log_time = time.time()
+_last_scalars = {}
+_last_scalars_time = float('-inf')
+
+
+def get_stage(name: str) -> StageMetrics:
+  """Returns the metrics of a stage, created on first use."""
+  with _STAGES_LOCK:
+    if name not in _STAGES:
+      _STAGES[name] = StageMetrics()
+    return _STAGES[name]
+
+
+def get_queue(name: str, capacity: int) -> QueueMetrics:
+  """Returns the metrics of a queue, created on first use."""
+  with _STAGES_LOCK:
+    if name not in _QUEUES:
+      _QUEUES[name] = QueueMetrics(capacity)
+    return _QUEUES[name]
+
+
+def get_distribution(name: str) -> DistributionMetrics:
+  """Returns the metrics of a distribution, created on first use."""
+  with _STAGES_LOCK:
+    if name not in _DISTRIBUTIONS:
+      _DISTRIBUTIONS[name] = DistributionMetrics()
+    return _DISTRIBUTIONS[name]
+
+
+@contextlib.contextmanager
+def timer(name: str):
+  """Records the time spent in the context in distribution `name`."""
+  start_time = time.time()
+  try:
+    yield
+  finally:
+    get_distribution(name).record(time.time() - start_time)
+
+
+def record_values(values: Mapping[str, Iterable[float]], prefix: str = ''):
+  """Records values collected elsewhere, e.g. in worker processes.
+
+  Args:
+    values: Values of every distribution.
+    prefix: Prefix of the names of the distributions.
+  """
+  for name, distribution_values in values.items():
+    get_distribution(prefix + name).record_all(distribution_values)
+
+
+def register_stats_fn(name: str, stats_fn: Callable[[], Dict[str, float]]):
+  """Registers a function returning stats to report along with the stages."""
+  with _STAGES_LOCK:
+    _STATS_FNS[name] = stats_fn
+
+
+def count_elements(iterable: Iterable[_T], name: str) -> Iterator[_T]:
+  """Yields the elements of `iterable`, recording them in stage `name`."""
+  stage = get_stage(name)
+  iterator = iter(iterable)
+  while True:
+    start_time = time.time()
+    try:
+      element = next(iterator)
+    except StopIteration:
+      return
+    stage.record(wait_time=time.time() - start_time)
+    yield element
+
+
+def get_stats() -> Dict[str, Dict[str, float]]:
+  """Returns the stats of all stages, in order of creation."""
+  with _STAGES_LOCK:
+    stages = list(_STAGES.items())
+  return {name: stage.get_stats() for name, stage in stages}
+
+
+def get_queue_stats() -> Dict[str, Dict[str, float]]:
+  """Returns the stats of all queues, in order of creation."""
+  with _STAGES_LOCK:
+    queues = list(_QUEUES.items())
+  return {name: queue.get_stats() for name, queue in queues}
+
+
+def get_distribution_stats() -> Dict[str, Dict[str, float]]:
+  """Returns the stats of all distributions, in order of creation."""
+  with _STAGES_LOCK:
+    distributions = list(_DISTRIBUTIONS.items())
+  return {name: distribution.get_stats()
+          for name, distribution in distributions}
+
+
+def get_registered_stats() -> Dict[str, Dict[str, float]]:
+  """Returns the stats of all registered stats functions."""
+  with _STAGES_LOCK:
+    stats_fns = list(_STATS_FNS.items())
+  return {name: stats_fn() for name, stats_fn in stats_fns}
+
+
+def get_scalars(prefix: str = 'input/') -> Dict[str, float]:
+  """Returns the main stats as flat scalars, e.g. for experiment logs."""
+  scalars = {}
+  for name, stats in get_stats().items():
+    scalars[f'{prefix}{name}/elements_per_second'] = (
+        stats['elements_per_second'])
+    scalars[f'{prefix}{name}/wait_time'] = stats['wait_time']
+  for name, stats in get_queue_stats().items():
+    scalars[f'{prefix}{name}/mean_depth'] = stats['mean_depth']
+    scalars[f'{prefix}{name}/empty_fraction'] = stats['empty_fraction']
+  for name, stats in get_distribution_stats().items():
+    for key in ('mean', 'p50', 'p90', 'max'):
+      scalars[f'{prefix}{name}/{key}'] = stats[key]
+  for name, stats in get_registered_stats().items():
+    for key, value in stats.items():
+      scalars[f'{prefix}{name}/{key}'] = value
+  return scalars
+
+
+def maybe_get_scalars(interval_secs: float = 10.,
+                      prefix: str = 'input/') -> Dict[str, float]:
+  """Returns `get_scalars`, only computed again every `interval_secs`.
+
+  Computing the scalars takes the percentiles of every distribution, so
+  callers at every step, e.g. the training loop, get the last ones instead.
+
+  Args:
+    interval_secs: Minimum time between computations.
+    prefix: Prefix of the names of the scalars.
+  """
+  global _last_scalars, _last_scalars_time
+  if time.time() - _last_scalars_time >= interval_secs:
+    _last_scalars_time = time.time()
+    _last_scalars = get_scalars(prefix)
+  return dict(_last_scalars)
+
+
+def get_report() -> Dict[str, Any]:
+  """Returns all stats, with histograms of the distributions."""
+  with _STAGES_LOCK:
+    distributions = list(_DISTRIBUTIONS.items())
+  return dict(
+      time=time.time(),
+      stages=get_stats(),
+      queues=get_queue_stats(),
+      distributions={
+          name: dict(distribution.get_stats(),
+                     histogram=distribution.get_histogram())
+          for name, distribution in distributions},
+      other=get_registered_stats())
+
+
+def write_report(path: str):
+  """Writes the report of `get_report` as JSON."""
+  path = pathlib.Path(path)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  # Readers never see a partial report.
+  temp_path = path.with_name(path.name + '.tmp')
+  with temp_path.open('w') as fid:
+    json.dump(get_report(), fid, indent=2)
+  temp_path.replace(path)
+
+
+def reset():
+  global _last_scalars, _last_scalars_time
+  _last_scalars = {}
+  _last_scalars_time = float('-inf')
+  with _STAGES_LOCK:
+    _STAGES.clear()
+    _QUEUES.clear()
+    _DISTRIBUTIONS.clear()
+    _STATS_FNS.clear()
+
+
+def log_stats():
+  for name, stats in get_stats().items():
+    logging.info('Input stage %s: %d elements, %.1f elements/s, waited %.1fs',
+                 name, stats['num_elements'], stats['elements_per_second'],
+                 stats['wait_time'])
+  for name, stats in get_queue_stats().items():
+    logging.info('Input queue %s: mean depth %.1f / %d, max %d, empty %.0f%%',
+                 name, stats['mean_depth'], stats['capacity'],
+                 stats['max_depth'], 100 * stats['empty_fraction'])
+  for name, stats in get_distribution_stats().items():
+    logging.info('Input %s: mean %.3g, p50 %.3g, p90 %.3g, max %.3g over %d',
+                 name, stats['mean'], stats['p50'], stats['p90'],
+                 stats['max'], stats['count'])
+  for name, stats in get_registered_stats().items():
+    logging.info('Input %s: %s', name, ', '.join(
+        f'{key} {value:.3g}' for key, value in stats.items()))
+
+
+def maybe_log_stats(interval_secs: float = 60.,
+                    report_path: Optional[str] = None):
+  """Logs the stats if they were not logged in the last `interval_secs`.
+
+  Args:
+    interval_secs: Minimum time between logs.
+    report_path: If set, the report is also written to this path.
+  """
+  global _last_log_time
+  if time.time() - _last_log_time >= interval_secs:
+    _last_log_time = time.time()
+    log_stats()
+    if report_path:
+      write_report(report_path)
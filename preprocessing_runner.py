@@ -0,0 +1,338 @@
+"""Runs the preprocessing stages, skipping the ones which are up to date.
+
+Every stage is one of the preprocessing scripts, with the files it reads and
+writes. Stages depend on the stages writing their inputs, and stages which do
+not depend on each other run concurrently. A stage is up to date when it
+completed after its inputs were last modified, so re-running after a failure
+only runs the failed stage and the stages after it.
+
+Usage:
+
+python3 preprocessing_runner.py --data_root="mag_data"
+"""
+
+import concurrent.futures
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+from typing import NamedTuple, Tuple
+
+from absl import app
+from absl import flags
+from absl import logging
+
+# pylint: disable=g-bad-import-order
+import data_utils
+
+Path = pathlib.Path
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('data_root', None, 'Data root directory')
+flags.DEFINE_integer('max_concurrent_stages', 2,
+                     'Maximum number of stages running at the same time')
+flags.DEFINE_list('stages', None,
+                  'Stages to run if not up to date. Defaults to all stages')
+flags.DEFINE_list('force', [], 'Stages to run even if up to date')
+flags.DEFINE_multi_string(
+    'stage_flag', [],
+    'Extra flag passed to a stage, as `<stage>:<flag>`, e.g. '
+    '`neighbor_builder:--num_workers=8`')
+flags.DEFINE_string(
+    'groups_dir', None,
+    'If set, the raw group dumps are first parsed with `group_dump_parser.py` '
+    'and mapped to dense ids with `id_index_builder.py`, with the node inputs '
+    'in `raw/raw_ids`')
+flags.DEFINE_boolean('dry_run', False,
+                     'Only logs which stages would run')
+
+flags.mark_flags_as_required(['data_root'])
+
+# Completion stamps and report of the runs.
+_STAGE_STAMPS_DIR = data_utils.PREPROCESSED_DIR / 'stages'
+_REPORT_FILENAME = data_utils.PREPROCESSED_DIR / 'preprocessing_report.json'
+
+
+class _Stage(NamedTuple):
+  name: str
+  script: str
+  inputs: Tuple[Path, ...]
+  outputs: Tuple[Path, ...]
+  arguments: Tuple[str, ...] = ()
+
+
+def _get_csr_manifest(filename):
+  return (data_utils.get_csr_arrays_directory(filename) /
+          data_utils.CSR_MANIFEST_FILENAME)
+
+
+def _get_extra_flags(stage_name):
+  return [flag.split(':', 1)[1] for flag in FLAGS.stage_flag
+          if flag.split(':', 1)[0] == stage_name]
+
+
+def _get_flag_value(stage_flags, name, default):
+  """Returns the value of a flag in a list of flags, the last one winning."""
+  value = default
+  for flag in stage_flags:
+    if flag == f'--{name}':
+      value = True
+    elif flag == f'--no{name}':
+      value = False
+    elif flag.startswith(f'--{name}='):
+      value = flag.split('=', 1)[1]
+      if value.lower() in ('true', 'false'):
+        value = value.lower() == 'true'
+  return value
+
+
+def _get_stages():
+  """Returns the preprocessing stages, with paths relative to `data_root`.
+
+  Outputs depend on the flags stages run with, including `--stage_flag`.
+  """
+  edges = (data_utils.EDGES_GROUP_USER, data_utils.EDGES_USER_GROUP)
+  csr_builder_arguments = ('--noskip_existing',)
+  streaming = _get_flag_value(
+      csr_builder_arguments + tuple(_get_extra_flags('csr_builder')),
+      'streaming', False)
+  if streaming:
+    # The raw CSR layout is written directly, and later stages depend on the
+    # manifests instead of `.npz` files.
+    edges = tuple(map(_get_csr_manifest, edges))
+  csr_stages = (
+      _Stage(
+          name='csr_builder',
+          script='csr_builder.py',
+          inputs=(data_utils.RAW_GROUP_USER_EDGES_FILENAME,),
+          outputs=edges,
+          arguments=csr_builder_arguments),
+  )
+  if not streaming:
+    csr_stages += (
+        _Stage(
+            name='csr_converter',
+            script='csr_converter.py',
+            inputs=edges,
+            outputs=tuple(map(_get_csr_manifest, edges)),
+            arguments=('--noskip_existing',) + tuple(
+                f'--matrices={filename}' for filename in edges)),
+    )
+  if _get_flag_value(_get_extra_flags('neighbor_builder'),
+                     'duplicate_detection', 'hashing') == 'hashing':
+    duplicate_outputs = (data_utils.CANONICAL_USER_IDS_FILENAME,)
+  else:
+    duplicate_outputs = (data_utils.NEIGHBOR_INDICES_FILENAME,
+                         data_utils.NEIGHBOR_DISTANCES_FILENAME)
+  fused_edges = (data_utils.FUSED_USER_EDGES_FILENAME,
+                 data_utils.FUSED_USER_EDGES_T_FILENAME)
+  indices = (data_utils.TRAIN_INDEX_FILENAME, data_utils.VALID_INDEX_FILENAME,
+             data_utils.TEST_INDEX_FILENAME)
+  k_fold_splits = tuple(
+      data_utils.K_FOLD_SPLITS_DIR / f'{split}_idx_{i}_{num_splits}.npy'
+      for num_splits in [data_utils.NUM_K_FOLD_SPLITS]
+      for i in range(num_splits)
+      for split in ('train', 'valid'))
+  if FLAGS.groups_dir:
+    # Node inputs indexed by VK id are remapped with the edges.
+    node_inputs = (data_utils.RAW_NODE_FEATURES_FILENAME,
+                   data_utils.RAW_NODE_LABELS_FILENAME,
+                   data_utils.RAW_NODE_YEAR_FILENAME) + indices
+    # Absolute paths are kept as is.
+    parser_stages = (
+        _Stage(
+            name='group_dump_parser',
+            script='group_dump_parser.py',
+            inputs=tuple(sorted(
+                p.resolve() for p in Path(FLAGS.groups_dir).iterdir()
+                if p.is_file())),
+            outputs=(data_utils.RAW_GROUP_USER_RAW_ID_EDGES_FILENAME,),
+            arguments=(f'--groups_dir={FLAGS.groups_dir}',)),
+        _Stage(
+            name='id_index_builder',
+            script='id_index_builder.py',
+            inputs=((data_utils.RAW_GROUP_USER_RAW_ID_EDGES_FILENAME,) +
+                    tuple(dict.fromkeys(map(
+                        data_utils.get_raw_id_input_filename, node_inputs)))),
+            outputs=((data_utils.RAW_GROUP_IDS_FILENAME,
+                      data_utils.RAW_USER_IDS_FILENAME,
+                      data_utils.RAW_GROUP_USER_EDGES_FILENAME) +
+                     tuple(dict.fromkeys(node_inputs)))),
+    )
+  else:
+    parser_stages = ()
+  return parser_stages + csr_stages + (
+      _Stage(
+          name='generate_validation_splits',
+          script='generate_validation_splits.py',
+          inputs=(data_utils.RAW_NODE_YEAR_FILENAME,) + indices,
+          outputs=k_fold_splits,
+          arguments=('--output_dir={data_root}/' +
+                     str(data_utils.K_FOLD_SPLITS_DIR),)),
+      _Stage(
+          name='pca_builder',
+          script='pca_builder.py',
+          inputs=(data_utils.RAW_NODE_FEATURES_FILENAME,
+                  data_utils.RAW_NODE_YEAR_FILENAME) + indices + edges,
+          outputs=(data_utils.PCA_BASIS_FILENAME,
+                   data_utils.PCA_USER_FEATURES_FILENAME,
+                   data_utils.PCA_GROUP_FEATURES_FILENAME,
+                   data_utils.PCA_MERGED_FEATURES_FILENAME),
+          arguments=('--noreuse_pca_basis',)),
+      _Stage(
+          name='neighbor_builder',
+          script='neighbor_builder.py',
+          inputs=(data_utils.PCA_USER_FEATURES_FILENAME,
+                  data_utils.RAW_NODE_YEAR_FILENAME) + indices + edges,
+          outputs=((data_utils.FUSED_NODE_LABELS_FILENAME,) + fused_edges +
+                   duplicate_outputs)),
+      _Stage(
+          name='fused_csr_converter',
+          script='csr_converter.py',
+          inputs=fused_edges,
+          outputs=tuple(map(_get_csr_manifest, fused_edges)),
+          arguments=('--noskip_existing',) + tuple(
+              f'--matrices={filename}' for filename in fused_edges)),
+  )
+
+
+def _get_dependencies(stages):
+  """Returns the names of the stages writing the inputs of every stage."""
+  writers = {output: stage.name for stage in stages for output in stage.outputs}
+  return {
+      stage.name: {writers[path] for path in stage.inputs if path in writers}
+      for stage in stages}
+
+
+def _get_stamp_path(stage):
+  return Path(FLAGS.data_root) / _STAGE_STAMPS_DIR / f'{stage.name}.done'
+
+
+def _is_up_to_date(stage):
+  """Whether the stage completed after its inputs were last modified."""
+  data_root = Path(FLAGS.data_root)
+  stamp_path = _get_stamp_path(stage)
+  if not stamp_path.exists():
+    return False
+  if not all((data_root / path).exists() for path in stage.outputs):
+    return False
+  stamp_time = stamp_path.stat().st_mtime
+  return all((data_root / path).stat().st_mtime <= stamp_time
+             for path in stage.inputs if (data_root / path).exists())
+
+
+def _get_command(stage):
+  script_dir = Path(__file__).resolve().parent
+  stage_flags = _get_extra_flags(stage.name)
+  return [sys.executable, str(script_dir / stage.script),
+          f'--data_root={FLAGS.data_root}'] + [
+              flag.format(data_root=FLAGS.data_root)
+              for flag in stage.arguments] + stage_flags
+
+
+def _run_stage(stage):
+  """Runs a stage, returning its wall time and peak resident memory."""
+  stamp_path = _get_stamp_path(stage)
+  if stamp_path.exists():
+    stamp_path.unlink()
+  command = _get_command(stage)
+  logging.info('Running %s: %s', stage.name, ' '.join(command))
+  start_time = time.time()
+  process = subprocess.Popen(command)
+  # Waits for this process only, to get its own resource usage.
+  _, status, rusage = os.wait4(process.pid, 0)
+  process.returncode = os.waitstatus_to_exitcode(status)
+  stats = dict(
+      wall_time=time.time() - start_time,
+      # Kilobytes on Linux.
+      peak_rss_bytes=rusage.ru_maxrss * 1024,
+      return_code=process.returncode)
+  if process.returncode == 0:
+    stamp_path.parent.mkdir(parents=True, exist_ok=True)
+    stamp_path.touch()
+  return stats
+
+
+def _write_report(report):
+  path = Path(FLAGS.data_root) / _REPORT_FILENAME
+  path.parent.mkdir(parents=True, exist_ok=True)
+  with path.open('w') as fid:
+    json.dump(report, fid, indent=2)
+
+
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+
+  stages = {stage.name: stage for stage in _get_stages()}
+  unknown_stages = set(FLAGS.stages or []) | set(FLAGS.force)
+  unknown_stages -= set(stages)
+  if unknown_stages:
+    raise app.UsageError(f'Unknown stages: {sorted(unknown_stages)}')
+  dependencies = _get_dependencies(stages.values())
+  selected = set(FLAGS.stages or stages)
+
+  report = {}
+  pending = [name for name in stages if name in selected]
+  finished = set(stages) - selected
+  running = {}
+  failed = False
+  with concurrent.futures.ThreadPoolExecutor(
+      FLAGS.max_concurrent_stages) as executor:
+    while pending or running:
+      # Starts the stages whose dependencies are finished. Skipped stages may
+      # make other stages ready, so repeat until no stage can start.
+      num_pending = None
+      while num_pending != len(pending):
+        num_pending = len(pending)
+        for name in list(pending):
+          if failed or len(running) >= FLAGS.max_concurrent_stages:
+            break
+          if not dependencies[name] <= finished:
+            continue
+          pending.remove(name)
+          stage = stages[name]
+          if name not in FLAGS.force and _is_up_to_date(stage):
+            logging.info('%s is up to date: skipping.', name)
+            report[name] = dict(status='skipped')
+            finished.add(name)
+          elif FLAGS.dry_run:
+            logging.info('Would run %s: %s', name,
+                         ' '.join(_get_command(stage)))
+            report[name] = dict(status='dry_run')
+            finished.add(name)
+          else:
+            running[executor.submit(_run_stage, stage)] = name
+      if not running:
+        if pending and not failed:
+          raise ValueError(f'Stages {pending} have unmet dependencies.')
+        break
+
+      done, _ = concurrent.futures.wait(
+          running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        name = running.pop(future)
+        stats = future.result()
+        stats['status'] = 'ok' if stats['return_code'] == 0 else 'failed'
+        report[name] = stats
+        logging.info('%s %s in %.1fs, peak RSS %.2f GiB', name,
+                     stats['status'], stats['wall_time'],
+                     stats['peak_rss_bytes'] / 2**30)
+        if stats['return_code'] == 0:
+          finished.add(name)
+        else:
+          failed = True
+        _write_report(report)
+
+  if not FLAGS.dry_run:
+    _write_report(report)
+  if failed:
+    raise RuntimeError('Preprocessing failed, see ' +
+                       str(Path(FLAGS.data_root) / _REPORT_FILENAME))
+
+
+if __name__ == '__main__':
+  app.run(main)
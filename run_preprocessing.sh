@@ -28,16 +28,7 @@ PREPROCESSED_DIR="${DATA_ROOT}"/preprocessed
 # Create preprocessed directory to move all files to it.
 mkdir -p "${PREPROCESSED_DIR}"
 
-# Run the CSR edge builder.
-python "${SCRIPT_DIR}"/csr_builder.py --data_root="${DATA_ROOT}"
-
-# Run the PCA feature builder.
-python "${SCRIPT_DIR}"/pca_builder.py --data_root="${DATA_ROOT}"
-
-# Run the neighbor-finder/fuser builder.
-python "${SCRIPT_DIR}"/neighbor_builder.py --data_root="${DATA_ROOT}"
-
-# Run the validation split generator.
-python "${SCRIPT_DIR}"/generate_validation_splits.py \
-  --data_root="${DATA_ROOT}" \
-  --output_dir="${DATA_ROOT}/k_fold_splits"
+# Run the preprocessing stages which are not up to date: CSR edge builder,
+# PCA feature builder, neighbor-finder/fuser builder, CSR conversion to the
+# memory-mappable raw layout and validation split generator.
+python "${SCRIPT_DIR}"/preprocessing_runner.py --data_root="${DATA_ROOT}" "$@"
@@ -2,6 +2,7 @@
 """Utilities for subsampling the MAG dataset."""
 
 import collections
+from typing import List, Sequence
 
 import jraph
 import numpy as np
@@ -9,7 +10,8 @@ import numpy as np
 
 def get_or_sample_row(node_id: int,
                       nb_neighbours: int,
-                      csr_matrix, remove_duplicates: bool):
+                      csr_matrix, remove_duplicates: bool,
+                      rng=np.random):
   """Either obtain entire row or a subsampled set of neighbours."""
   if node_id + 1 >= csr_matrix.indptr.shape[0]:
     lo = 0
@@ -23,26 +25,120 @@ def get_or_sample_row(node_id: int,
     neighbours = csr_matrix.indices[lo:hi]
   elif hi - lo < 5 * nb_neighbours:  # For small surroundings, sample directly
     nb_neighbours = min(nb_neighbours, hi - lo)
-    inds = lo + np.random.choice(hi - lo, size=(nb_neighbours,), replace=False)
+    inds = lo + rng.choice(hi - lo, size=(nb_neighbours,), replace=False)
     neighbours = csr_matrix.indices[inds]
   else:  # Otherwise, do not slice -- sample indices instead
     # To extend GraphSAGE ("uniform w/ replacement"), modify this call
-    inds = np.random.randint(lo, hi, size=(nb_neighbours,))
+    inds = rng.randint(lo, hi, size=(nb_neighbours,))
     if remove_duplicates:
       inds = np.unique(inds)
     neighbours = csr_matrix.indices[inds]
   return neighbours
 
 
-def get_neighbours(node_id: int,
-                   node_type: int,
-                   neighbour_type: int,
-                   nb_neighbours: int,
-                   remove_duplicates: bool,
-                   group_institution_csr, institution_group_csr,
-                   group_user_csr, user_group_csr,
-                   user_user_csr, user_user_transpose_csr):
-  """Fetch the edge indices from one node to corresponding neighbour type."""
+def _expand_ranges(starts, counts):
+  """Returns (segment id, position) pairs enumerating `[start, start+count)`."""
+  counts = np.asarray(counts, dtype=np.int64)
+  segment_ids = np.repeat(np.arange(counts.shape[0]), counts)
+  segment_offsets = np.cumsum(counts) - counts
+  positions = (np.arange(segment_ids.shape[0], dtype=np.int64) -
+               segment_offsets[segment_ids] +
+               np.asarray(starts, dtype=np.int64)[segment_ids])
+  return segment_ids, positions
+
+
+def _first_in_segment(segment_ids):
+  """Boolean mask of the first element of each run in a sorted id array."""
+  is_first = np.ones(segment_ids.shape[0], dtype=bool)
+  is_first[1:] = segment_ids[1:] != segment_ids[:-1]
+  return is_first
+
+
+def sample_rows(node_ids,
+                nb_neighbours: int,
+                csr_matrix,
+                remove_duplicates: bool,
+                rng=np.random):
+  """Vectorized `get_or_sample_row` over an array of nodes.
+
+  Each row is sampled with the same rules as `get_or_sample_row`: rows with
+  at most `nb_neighbours` entries are taken whole, rows with fewer than
+  `5 * nb_neighbours` entries are sampled without replacement, and larger rows
+  are sampled with replacement (optionally removing duplicates).
+
+  Args:
+    node_ids: Array of row ids to sample from.
+    nb_neighbours: Number of neighbours to sample per row.
+    csr_matrix: Adjacency, only `indptr` and `indices` are accessed.
+    remove_duplicates: Whether to deduplicate rows sampled with replacement.
+    rng: `np.random.RandomState` to sample with, the global one by default.
+
+  Returns:
+    A tuple `(rows, neighbours)`, where `rows` holds the position in `node_ids`
+    each sampled neighbour belongs to. Outputs are grouped by row, in order.
+  """
+  node_ids = np.asarray(node_ids, dtype=np.int64)
+  indptr = csr_matrix.indptr
+  in_range = node_ids + 1 < indptr.shape[0]
+  safe_ids = np.where(in_range, node_ids, 0)
+  lo = np.where(in_range, indptr[safe_ids], 0).astype(np.int64)
+  hi = np.where(in_range, indptr[safe_ids + 1], 0).astype(np.int64)
+  degree = hi - lo
+  rows = np.arange(node_ids.shape[0])
+
+  sampled_rows = []
+  sampled_inds = []
+
+  # Small neighbourhoods are taken whole.
+  take_all = degree <= nb_neighbours
+  segment_ids, inds = _expand_ranges(lo[take_all], degree[take_all])
+  sampled_rows.append(rows[take_all][segment_ids])
+  sampled_inds.append(inds)
+
+  # For small surroundings, sample directly without replacement by keeping
+  # the `nb_neighbours` entries with the smallest random keys in each row.
+  sample_direct = (degree > nb_neighbours) & (degree < 5 * nb_neighbours)
+  segment_ids, inds = _expand_ranges(lo[sample_direct], degree[sample_direct])
+  order = np.lexsort((rng.random_sample(segment_ids.shape[0]), segment_ids))
+  segment_ids = segment_ids[order]
+  inds = inds[order]
+  rank = np.arange(segment_ids.shape[0]) - np.searchsorted(
+      segment_ids, segment_ids)
+  keep = rank < nb_neighbours
+  sampled_rows.append(rows[sample_direct][segment_ids[keep]])
+  sampled_inds.append(inds[keep])
+
+  # Otherwise, do not slice -- sample indices instead.
+  sample_indices = degree >= 5 * nb_neighbours
+  sample_indices &= ~take_all
+  segment_ids = np.repeat(
+      np.arange(np.count_nonzero(sample_indices)), nb_neighbours)
+  inds = rng.randint(lo[sample_indices][segment_ids],
+                    hi[sample_indices][segment_ids],
+                    dtype=np.int64)
+  if remove_duplicates:
+    order = np.lexsort((inds, segment_ids))
+    segment_ids = segment_ids[order]
+    inds = inds[order]
+    keep = _first_in_segment(segment_ids) | np.concatenate(
+        [[True], inds[1:] != inds[:-1]])
+    segment_ids = segment_ids[keep]
+    inds = inds[keep]
+  sampled_rows.append(rows[sample_indices][segment_ids])
+  sampled_inds.append(inds)
+
+  sampled_rows = np.concatenate(sampled_rows)
+  sampled_inds = np.concatenate(sampled_inds)
+  order = np.argsort(sampled_rows, kind='stable')
+  return sampled_rows[order], csr_matrix.indices[sampled_inds[order]]
+
+
+def _select_csr(node_type: int,
+                neighbour_type: int,
+                group_institution_csr, institution_group_csr,
+                group_user_csr, user_group_csr,
+                user_user_csr, user_user_transpose_csr):
+  """Returns the adjacency from one node type to a neighbour type."""
   if node_type == 0 and neighbour_type == 0:
     csr = user_user_transpose_csr  # Citing
   elif node_type == 0 and neighbour_type == 1:
@@ -57,7 +153,25 @@ def get_neighbours(node_id: int,
     csr = institution_group_csr
   else:
     raise ValueError('Non-existent edge type requested')
-  return get_or_sample_row(node_id, nb_neighbours, csr, remove_duplicates)
+  return csr
+
+
+def get_neighbours(node_id: int,
+                   node_type: int,
+                   neighbour_type: int,
+                   nb_neighbours: int,
+                   remove_duplicates: bool,
+                   group_institution_csr, institution_group_csr,
+                   group_user_csr, user_group_csr,
+                   user_user_csr, user_user_transpose_csr,
+                   rng=np.random):
+  """Fetch the edge indices from one node to corresponding neighbour type."""
+  csr = _select_csr(node_type, neighbour_type,
+                    group_institution_csr, institution_group_csr,
+                    group_user_csr, user_group_csr,
+                    user_user_csr, user_user_transpose_csr)
+  return get_or_sample_row(node_id, nb_neighbours, csr, remove_duplicates,
+                           rng=rng)
 
 
 def get_senders(neighbour_type: int,
@@ -93,7 +207,8 @@ def subsample_graph(user_id: int,
                     max_edges=None,
                     user_years=None,
                     remove_future_nodes=False,
-                    deduplicate_nodes=False) -> jraph.GraphsTuple:
+                    deduplicate_nodes=False,
+                    rng=np.random) -> jraph.GraphsTuple:
   """Subsample a graph around given user ID."""
   if user_years is not None:
     root_user_year = user_years[user_id]
@@ -145,6 +260,7 @@ def subsample_graph(user_id: int,
             user_group_csr,
             user_user_csr,
             user_user_transpose_csr,
+            rng=rng,
         )
 
         if sampled_neighbors is not None:
@@ -235,3 +351,293 @@ def subsample_graph(user_id: int,
                            globals=np.array([0], dtype=np.int16),
                            n_node=sub_n_node.astype(dtype=np.int32),
                            n_edge=sub_n_edge.astype(dtype=np.int32))
+
+
+_EDGE_TYPE_FEATURES = np.stack([
+    np.stack([make_edge_type_feature(node_type, neighbour_type)
+              for neighbour_type in range(4)])
+    for node_type in range(3)
+]).reshape(12, 7).astype(np.float16)
+
+
+def _exclusive_cumsum_per_segment(values, segment_ids):
+  """Exclusive cumsum of `values`, restarting at each run of `segment_ids`."""
+  values = values.astype(np.int64)
+  exclusive = np.cumsum(values) - values
+  return exclusive - exclusive[np.searchsorted(segment_ids, segment_ids)]
+
+
+def _sample_candidates(depth, frontier_root, frontier_index, frontier_type,
+                       csrs, max_nb_neighbours_per_type, deduplicate_nodes,
+                       user_years, root_years, rng):
+  """Samples neighbours of every frontier node, in BFS processing order."""
+  frontier_pos = []
+  neighbour_types = []
+  neighbours = []
+  for node_type in range(3):
+    is_node_type = frontier_type == node_type
+    if not np.any(is_node_type):
+      continue
+    node_pos = np.nonzero(is_node_type)[0]
+    for neighbour_type in range(4):
+      nb_neighbours = max_nb_neighbours_per_type[depth][node_type][neighbour_type]  # pylint:disable=line-too-long
+      if nb_neighbours <= 0:
+        continue
+      csr = _select_csr(node_type, neighbour_type, *csrs)
+      rows, sampled = sample_rows(frontier_index[node_pos], nb_neighbours, csr,
+                                  deduplicate_nodes, rng=rng)
+      pos = node_pos[rows]
+      if root_years is not None and neighbour_type in [0, 3]:
+        is_past = user_years[sampled] <= root_years[frontier_root[pos]]
+        pos = pos[is_past]
+        sampled = sampled[is_past]
+      frontier_pos.append(pos)
+      neighbour_types.append(np.full(pos.shape[0], neighbour_type, np.int64))
+      neighbours.append(sampled.astype(np.int64))
+  if not frontier_pos:
+    return (np.zeros([0], np.int64),) * 3
+  frontier_pos = np.concatenate(frontier_pos)
+  neighbour_types = np.concatenate(neighbour_types)
+  neighbours = np.concatenate(neighbours)
+  # Expand each frontier node in turn, going through neighbour types in order.
+  order = np.lexsort((neighbour_types, frontier_pos))
+  return frontier_pos[order], neighbour_types[order], neighbours[order]
+
+
+def subsample_graphs(user_ids: Sequence[int],
+                     group_institution_csr,
+                     institution_group_csr,
+                     group_user_csr,
+                     user_group_csr,
+                     user_user_csr,
+                     user_user_transpose_csr,
+                     max_nb_neighbours_per_type,
+                     max_nodes=None,
+                     max_edges=None,
+                     user_years=None,
+                     remove_future_nodes=False,
+                     deduplicate_nodes=False,
+                     rng=np.random) -> List[jraph.GraphsTuple]:
+  """Subsample graphs around a batch of user IDs.
+
+  Batched equivalent of `subsample_graph`: every hop is expanded for all roots
+  at once with array operations over the CSR `indptr`/`indices`. Neighbour
+  sampling, node deduplication, future node removal and node/edge budgets
+  follow the same rules as the per-root breadth-first search, so the graphs
+  only differ from `subsample_graph` in the random draws.
+
+  Args:
+    user_ids: Array of root user ids.
+    group_institution_csr: Group to institution adjacency.
+    institution_group_csr: Institution to group adjacency.
+    group_user_csr: Group to user adjacency.
+    user_group_csr: User to group adjacency.
+    user_user_csr: User to user adjacency.
+    user_user_transpose_csr: Transposed user to user adjacency.
+    max_nb_neighbours_per_type: Number of neighbours to sample, indexed by
+      `[depth][node_type][neighbour_type]`.
+    max_nodes: Optional node budget per subgraph.
+    max_edges: Optional edge budget per subgraph.
+    user_years: Optional array of years, indexed by user id.
+    remove_future_nodes: Whether to drop users more recent than the root.
+    deduplicate_nodes: Whether to merge repeated nodes of the same type.
+    rng: `np.random.RandomState` to sample with, the global one by default.
+
+  Returns:
+    A list with one `jraph.GraphsTuple` per root, in the format produced by
+    `subsample_graph`, ready for `batching_utils.dynamically_batch`.
+  """
+  user_ids = np.asarray(user_ids, dtype=np.int64)
+  num_roots = user_ids.shape[0]
+  csrs = (group_institution_csr, institution_group_csr,
+          group_user_csr, user_group_csr,
+          user_user_csr, user_user_transpose_csr)
+  if remove_future_nodes and user_years is not None:
+    root_years = user_years[user_ids]
+  else:
+    root_years = None
+
+  # Nodes and edges of all subgraphs, accumulated hop by hop.
+  roots = np.arange(num_roots, dtype=np.int64)
+  zeros = np.zeros([num_roots], dtype=np.int64)
+  node_roots = [roots]
+  node_indices = [user_ids]
+  node_types = [zeros]
+  node_depths = [zeros]
+  node_subgraph_indices = [zeros]
+  edge_roots = []
+  edge_senders = []
+  edge_receivers = []
+  edge_types = []
+
+  num_nodes_in_subgraph = np.ones([num_roots], dtype=np.int64)
+  num_edges_in_subgraph = np.zeros([num_roots], dtype=np.int64)
+  reached_node_budget = np.zeros([num_roots], dtype=bool)
+  reached_edge_budget = np.zeros([num_roots], dtype=bool)
+
+  # Nodes to expand, sorted by root and then by order of insertion.
+  frontier_root = roots
+  frontier_index = user_ids
+  frontier_type = zeros
+  frontier_subgraph_index = zeros
+
+  max_depth = len(max_nb_neighbours_per_type)
+  for depth in range(max_depth):
+    is_active = ~reached_edge_budget[frontier_root]
+    frontier_root = frontier_root[is_active]
+    frontier_index = frontier_index[is_active]
+    frontier_type = frontier_type[is_active]
+    frontier_subgraph_index = frontier_subgraph_index[is_active]
+    if not frontier_root.shape[0]:
+      break
+
+    frontier_pos, neighbour_type, neighbour_index = _sample_candidates(
+        depth, frontier_root, frontier_index, frontier_type, csrs,
+        max_nb_neighbours_per_type, deduplicate_nodes, user_years, root_years,
+        rng)
+    num_candidates = frontier_pos.shape[0]
+    if not num_candidates:
+      break
+    candidate_root = frontier_root[frontier_pos]
+    candidate_type = neighbour_type % 3
+
+    # Group candidates with existing nodes by (root, type, node id), ordered
+    # by insertion time. Existing nodes have their subgraph index as time.
+    existing_root = np.concatenate(node_roots)
+    num_existing = existing_root.shape[0]
+    entry_root = np.concatenate([existing_root, candidate_root])
+    entry_type = np.concatenate(node_types + [candidate_type])
+    entry_index = np.concatenate(node_indices + [neighbour_index])
+    entry_time = np.concatenate(
+        node_subgraph_indices +
+        [np.arange(num_candidates, dtype=np.int64) + 2**40])
+    order = np.lexsort((entry_time, entry_index, entry_type, entry_root))
+    sorted_root = entry_root[order]
+    sorted_type = entry_type[order]
+    sorted_index = entry_index[order]
+    starts_group = _first_in_segment(sorted_root)
+    starts_group[1:] |= sorted_type[1:] != sorted_type[:-1]
+    starts_group[1:] |= sorted_index[1:] != sorted_index[:-1]
+    group_id = np.cumsum(starts_group) - 1
+    is_candidate = order >= num_existing
+    candidate_order = order[is_candidate] - num_existing
+
+    # A candidate creates a new node unless it is deduplicated.
+    if deduplicate_nodes:
+      is_new = np.zeros([num_candidates], dtype=bool)
+      is_new[candidate_order] = starts_group[is_candidate]
+    else:
+      is_new = np.ones([num_candidates], dtype=bool)
+
+    # Apply the node budget in processing order.
+    num_new_before = _exclusive_cumsum_per_segment(is_new, candidate_root)
+    num_nodes_before = num_nodes_in_subgraph[candidate_root]
+    is_added = is_new & ~reached_node_budget[candidate_root]
+    if max_nodes is not None:
+      is_added &= ~((num_new_before >= 1) &
+                    (num_nodes_before + num_new_before >= max_nodes))
+      # The node filling the budget is kept, but not connected nor expanded.
+      fills_budget = is_added & (
+          num_nodes_before + num_new_before + 1 >= max_nodes)
+    else:
+      fills_budget = np.zeros([num_candidates], dtype=bool)
+    subgraph_index = num_nodes_before + num_new_before
+
+    # Other candidates connect to the latest node added with the same key.
+    sorted_value = np.full([order.shape[0]], -1, dtype=np.int64)
+    sorted_value[~is_candidate] = np.concatenate(node_subgraph_indices)[
+        order[~is_candidate]]
+    sorted_value[is_candidate] = np.where(
+        is_added[candidate_order], subgraph_index[candidate_order], -1)
+    group_base = group_id * 2**32
+    latest = np.maximum.accumulate(
+        np.where(sorted_value >= 0, group_base + sorted_value, -1))
+    latest = np.concatenate([[-1], latest[:-1]])
+    latest = np.where(latest >= group_base, latest - group_base, -1)
+    existing_subgraph_index = np.zeros([num_candidates], dtype=np.int64)
+    existing_subgraph_index[candidate_order] = latest[is_candidate]
+
+    has_edge = np.where(is_added, ~fills_budget, existing_subgraph_index >= 0)
+    sender = np.where(is_added, subgraph_index, existing_subgraph_index)
+
+    # Apply the edge budget: stop right after the edge filling the budget.
+    is_processed = np.ones([num_candidates], dtype=bool)
+    if max_edges is not None:
+      num_edges_before = (num_edges_in_subgraph[candidate_root] +
+                          _exclusive_cumsum_per_segment(has_edge,
+                                                        candidate_root))
+      is_first = _first_in_segment(candidate_root)
+      is_processed = is_first | (num_edges_before < max_edges)
+      fills_edge_budget = is_processed & (
+          num_edges_before + has_edge >= max_edges)
+      reached_edge_budget[candidate_root[fills_edge_budget]] = True
+    is_added &= is_processed
+    has_edge &= is_processed
+    reached_node_budget[candidate_root[fills_budget & is_processed]] = True
+    num_nodes_in_subgraph += np.bincount(
+        candidate_root[is_added], minlength=num_roots)
+    num_edges_in_subgraph += np.bincount(
+        candidate_root[has_edge], minlength=num_roots)
+
+    node_roots.append(candidate_root[is_added])
+    node_indices.append(neighbour_index[is_added])
+    node_types.append(candidate_type[is_added])
+    node_depths.append(np.full([np.count_nonzero(is_added)], depth + 1,
+                               dtype=np.int64))
+    node_subgraph_indices.append(subgraph_index[is_added])
+    edge_roots.append(candidate_root[has_edge])
+    edge_senders.append(sender[has_edge])
+    edge_receivers.append(frontier_subgraph_index[frontier_pos[has_edge]])
+    edge_types.append(
+        (frontier_type[frontier_pos] * 4 + neighbour_type)[has_edge])
+
+    # Only newly created nodes are expanded further.
+    expand = is_added & ~fills_budget
+    frontier_root = candidate_root[expand]
+    frontier_index = neighbour_index[expand]
+    frontier_type = candidate_type[expand]
+    frontier_subgraph_index = subgraph_index[expand]
+
+  # Stitch the graphs together.
+  node_roots = np.concatenate(node_roots)
+  order = np.lexsort((np.concatenate(node_subgraph_indices), node_roots))
+  split_nodes = np.cumsum(num_nodes_in_subgraph)[:-1]
+  sub_nodes = np.split(np.concatenate(node_indices)[order], split_nodes)
+  types = np.split(np.concatenate(node_types)[order], split_nodes)
+  depths = np.split(np.concatenate(node_depths)[order], split_nodes)
+
+  if edge_roots:
+    edge_roots = np.concatenate(edge_roots)
+    order = np.argsort(edge_roots, kind='stable')
+    sub_senders = np.concatenate(edge_senders)[order]
+    sub_receivers = np.concatenate(edge_receivers)[order]
+    sub_edges = _EDGE_TYPE_FEATURES[np.concatenate(edge_types)[order]]
+  else:
+    sub_senders = np.zeros([0], dtype=np.int64)
+    sub_receivers = np.zeros([0], dtype=np.int64)
+    sub_edges = np.zeros([0, 7], dtype=np.float16)
+  split_edges = np.cumsum(num_edges_in_subgraph)[:-1]
+  sub_senders = np.split(sub_senders.astype(np.int32), split_edges)
+  sub_receivers = np.split(sub_receivers.astype(np.int32), split_edges)
+  sub_edges = np.split(sub_edges, split_edges)
+
+  if max_nodes is not None:
+    assert np.all(num_nodes_in_subgraph <= max_nodes)
+  if max_edges is not None:
+    assert np.all(num_edges_in_subgraph <= max_edges)
+
+  graphs = []
+  for i in range(num_roots):
+    graphs.append(jraph.GraphsTuple(
+        nodes={
+            'index': sub_nodes[i].astype(np.int32),
+            'type': types[i].astype(np.int16),
+            'depth': depths[i].astype(np.int16),
+        },
+        edges=sub_edges[i],
+        senders=sub_senders[i],
+        receivers=sub_receivers[i],
+        globals=np.array([0], dtype=np.int16),
+        n_node=np.array([num_nodes_in_subgraph[i]], dtype=np.int32),
+        n_edge=np.array([num_edges_in_subgraph[i]], dtype=np.int32)))
+  return graphs
@@ -0,0 +1,129 @@
+"""Synthetic graphs with the layout of the arrays of `data_utils.get_arrays`.
+
+Users and groups have power-law degree distributions, like the VK graph, so
+benchmarks on these graphs see the same skew as on the full dataset without
+needing it.
+"""
+
+from typing import Dict
+
+import numpy as np
+import scipy.sparse as sp
+
+# pylint: disable=g-bad-import-order
+import data_utils
+
+
+def power_law_ids(rand, num_ids, size, exponent=1.5):
+  """Draws ids with a Zipf-like popularity distribution."""
+  ids = rand.zipf(exponent, size=size) - 1
+  return rand.permutation(num_ids)[ids % num_ids]
+
+
+def build_csr(senders, receivers, shape):
+  return sp.csr_matrix(
+      (np.ones_like(senders, dtype=bool), (senders, receivers)), shape=shape)
+
+
+def build_adjacencies(rand, num_users, num_groups, num_user_user_edges,
+                      num_group_user_edges) -> Dict[str, sp.csr_matrix]:
+  """Returns adjacencies with skewed degree distributions.
+
+  Args:
+    rand: `np.random.RandomState`.
+    num_users: Number of users.
+    num_groups: Number of groups.
+    num_user_user_edges: Number of user->user edges, before deduplication.
+    num_group_user_edges: Number of group->user edges, before deduplication.
+
+  Returns:
+    Adjacencies keyed as in `data_utils.get_arrays`. There are no
+    institutions.
+  """
+  user_user = build_csr(
+      rand.randint(num_users, size=num_user_user_edges),
+      power_law_ids(rand, num_users, num_user_user_edges),
+      (num_users, num_users))
+  group_user = build_csr(
+      power_law_ids(rand, num_groups, num_group_user_edges),
+      rand.randint(num_users, size=num_group_user_edges),
+      (num_groups, num_users))
+  empty = sp.csr_matrix((num_groups, 1), dtype=bool)
+  return dict(
+      group_institution_index=empty,
+      institution_group_index=empty.T.tocsr(),
+      group_user_index=group_user,
+      user_group_index=group_user.T.tocsr(),
+      user_user_index=user_user,
+      user_user_index_t=user_user.T.tocsr(),
+  )
+
+
+def get_sampler_adjacencies(arrays):
+  """Returns the adjacencies of `arrays` as arguments of `sub_sampler`."""
+  return dict(
+      group_institution_csr=arrays["group_institution_index"],
+      institution_group_csr=arrays["institution_group_index"],
+      group_user_csr=arrays["group_user_index"],
+      user_group_csr=arrays["user_group_index"],
+      user_user_csr=arrays["user_user_index"],
+      user_user_transpose_csr=arrays["user_user_index_t"],
+  )
+
+
+def build_arrays(rand, num_users, num_groups, num_user_user_edges,
+                 num_group_user_edges, labeled_fraction=0.1,
+                 feature_dim=129, compact_adjacencies=False):
+  """Returns synthetic arrays with the keys of `data_utils.get_arrays`.
+
+  Args:
+    rand: `np.random.RandomState`.
+    num_users: Number of users.
+    num_groups: Number of groups.
+    num_user_user_edges: Number of user->user edges, before deduplication.
+    num_group_user_edges: Number of group->user edges, before deduplication.
+    labeled_fraction: Fraction of users with a label, split 8:1:1 into the
+      train, valid and test indices.
+    feature_dim: Size of the node features.
+    compact_adjacencies: Whether to convert adjacencies with
+      `data_utils.compact_csr`, as `get_arrays` does.
+
+  Returns:
+    Arrays of the users followed by the groups. `data_utils` node counts must
+    be set to the same sizes, see `set_dataset_sizes`.
+  """
+  arrays = build_adjacencies(rand, num_users, num_groups, num_user_user_edges,
+                             num_group_user_edges)
+  if compact_adjacencies:
+    arrays = {key: data_utils.compact_csr(csr) for key, csr in arrays.items()}
+
+  labeled_users = rand.permutation(num_users)[:int(labeled_fraction *
+                                                   num_users)]
+  num_train = labeled_users.shape[0] * 8 // 10
+  num_valid = labeled_users.shape[0] // 10
+  user_label = np.full(num_users, -1, dtype=np.float32)
+  user_label[labeled_users] = rand.randint(
+      data_utils.NUM_CLASSES, size=labeled_users.shape[0])
+  arrays.update(
+      user_year=rand.randint(1950, 2021, size=num_users).astype(np.int16),
+      user_label=user_label,
+      train_indices=np.sort(labeled_users[:num_train]),
+      valid_indices=np.sort(labeled_users[num_train:num_train + num_valid]),
+      test_indices=np.sort(labeled_users[num_train + num_valid:]),
+      bert_pca_129=rand.standard_normal(
+          (num_users + num_groups, feature_dim)).astype(np.float16),
+  )
+  return arrays
+
+
+def set_dataset_sizes(num_users, num_groups):
+  """Sets the node counts of `data_utils` to those of a synthetic graph.
+
+  Node indices of groups are offset by the number of users, and unlabeled
+  roots are drawn among all users, so the input pipeline reads these counts.
+  """
+  data_utils.NUM_USERS = num_users
+  data_utils.NUM_GROUPS = num_groups
+  data_utils.NUM_NODES = num_users + num_groups
+  data_utils.OFFSETS.update(user=0, group=num_users)
+  data_utils.SIZES.update(user=num_users, group=num_groups)